@@ -1,8 +1,11 @@
 # app.py - Railway Optimized Version
 import os
-from flask import Flask, request, jsonify, render_template_string, send_from_directory, Response
+from flask import Flask, request, jsonify, render_template, send_from_directory, send_file
+import jinja2
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
+from telebot.apihelper import ApiTelegramException
+from telebot.formatting import escape_markdown
 import json
 import logging
 from datetime import datetime, timedelta
@@ -15,6 +18,31 @@ from werkzeug.utils import secure_filename
 import urllib.parse
 import hashlib
 import threading
+import sqlite3
+import sys
+import zlib
+import bisect
+import shutil
+from collections import deque, OrderedDict
+from collections.abc import Mapping, Sequence
+import copy
+import weakref
+import queue
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+import heapq
+import itertools
+import atexit
+import mmap
+import struct
+import gzip
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # ==================== 1. RAILWAY CONFIGURATION ====================
 BOT_TOKEN = os.environ.get('BOT_TOKEN', '8559128386:AAHYe9utD824SQh5UD1vQ1H8M9WNPGw_m_w')
@@ -27,6 +55,10 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data")
 STATIC_DIR = os.path.join(BASE_DIR, "static")
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
+SNAPSHOT_DIR = os.path.join(DATA_DIR, "snapshots")
+USERS_DIR = os.path.join(DATA_DIR, "users")
+PFP_DIR = os.path.join(DATA_DIR, "pfp")
+ASSETS_DIR = os.path.join(STATIC_DIR, "assets")
 
 # File Paths
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
@@ -34,156 +66,2505 @@ SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json")
 WITHDRAWALS_FILE = os.path.join(DATA_DIR, "withdrawals.json")
 GIFTS_FILE = os.path.join(DATA_DIR, "gifts.json")
 LEADERBOARD_FILE = os.path.join(DATA_DIR, "leaderboard.json")
+DB_FILE = os.path.join(DATA_DIR, "bot.db")
+LEDGER_FILE = os.path.join(DATA_DIR, "ledger.log")
+GENERATIONS_FILE = os.path.join(DATA_DIR, "generations.bin")
+LOCK_FILE = os.path.join(DATA_DIR, "store.lock")
 
-# Global cache with lock for thread safety
+# Legacy JSON path -> cache key
+STORE_KEYS = {
+    USERS_FILE: 'users',
+    SETTINGS_FILE: 'settings',
+    WITHDRAWALS_FILE: 'withdrawals',
+    GIFTS_FILE: 'gifts',
+    LEADERBOARD_FILE: 'leaderboard'
+}
+
+# Stores that live in SQLite tables (legacy JSON path -> table)
+TABLE_STORES = {
+    USERS_FILE: 'users',
+    SETTINGS_FILE: 'settings',
+    WITHDRAWALS_FILE: 'withdrawals',
+    GIFTS_FILE: 'gifts'
+}
+
+DEFAULT_SETTINGS = {
+    "bot_name": "CYBER EARN ULTIMATE",
+    "min_withdrawal": 100.0,
+    "welcome_bonus": 50.0,
+    "channels": [],
+    "admins": [],
+    "auto_withdraw": False,
+    "bots_disabled": False,
+    "ignore_device_check": False,
+    "withdraw_disabled": False,
+    "logo_filename": "logo_default.png",
+    "min_refer_reward": 10.0,
+    "max_refer_reward": 50.0,
+    "app_name": "Cyber Earn",
+    "disable_channel_verification": False,
+    "auto_accept_private": False,
+    "hide_verify_button": False
+}
+
+# Global cache with lock for thread safety. Every store has its own entry:
+# the data, a version bumped on each change, and the stamp of the backing
+# file when it was loaded (a changed stamp means someone else rewrote it).
+# Each user shard gets its own entry too ('users:00', 'users:01', ...).
+# Loads run outside cache_lock under the entry's own load lock, so one
+# thread reads a store while the others wait for it instead of for every
+# cache in the process.
 cache_lock = threading.Lock()
-CACHE = {
-    'settings': None,
-    'users': None,
-    'withdrawals': None,
-    'gifts': None,
-    'leaderboard': None,
-    'last_update': 0
+CACHE = {}
+CACHE_STATS = {}
+CACHE_LOADS = {}
+
+def register_cache(key):
+    CACHE.setdefault(key, {'data': None, 'version': 0, 'stamp': None})
+    CACHE_LOADS.setdefault(key, threading.Lock())
+    CACHE_STATS.setdefault(key, {'hits': 0, 'misses': 0, 'reloads': 0, 'invalidations': 0})
+
+for _key in ('settings', 'withdrawals', 'gifts', 'leaderboard', 'bot_meta'):
+    register_cache(_key)
+
+# Number of user shard files for a new store (changing it later needs `python app.py reshard N`)
+USER_SHARDS = int(os.environ.get('USER_SHARDS', 16))
+# How long a transaction waits for a user lock before reporting a conflict
+USER_LOCK_TIMEOUT = float(os.environ.get('USER_LOCK_TIMEOUT', 5))
+USER_TXN_RETRIES = int(os.environ.get('USER_TXN_RETRIES', 3))
+
+# Ledger compaction (records in the log segment / seconds between compactions)
+LEDGER_COMPACT_RECORDS = int(os.environ.get('LEDGER_COMPACT_RECORDS', 1000))
+LEDGER_COMPACT_INTERVAL = int(os.environ.get('LEDGER_COMPACT_INTERVAL', 300))
+LEDGER_FSYNC = os.environ.get('LEDGER_FSYNC', '1') == '1'
+
+# Write-behind: seconds between group commits / pending writes that force one early
+FLUSH_INTERVAL = float(os.environ.get('FLUSH_INTERVAL', 0.5))
+FLUSH_MAX_PENDING = int(os.environ.get('FLUSH_MAX_PENDING', 500))
+
+# Several worker processes share data/ (gunicorn sets WEB_CONCURRENCY);
+# turns on cross-process locks. Needs fcntl, so POSIX only.
+MULTI_PROCESS = fcntl is not None and (
+    int(os.environ.get('WEB_CONCURRENCY', 1)) > 1 or os.environ.get('MULTI_PROCESS') == '1'
+)
+
+# Webhook updates: worker threads / max updates waiting / optional secret Telegram echoes back
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 4))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 1000))
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+# How many recent update_ids are remembered to drop Telegram redeliveries
+UPDATE_DEDUP_WINDOW = int(os.environ.get('UPDATE_DEDUP_WINDOW', 10000))
+
+# Outbound Bot API calls: pooled connections / parallel calls / timeouts in seconds
+TG_POOL_SIZE = int(os.environ.get('TG_POOL_SIZE', 32))
+TG_CONCURRENCY = int(os.environ.get('TG_CONCURRENCY', 16))
+TG_CONNECT_TIMEOUT = float(os.environ.get('TG_CONNECT_TIMEOUT', 5))
+TG_READ_TIMEOUT = float(os.environ.get('TG_READ_TIMEOUT', 15))
+
+# Outgoing messages: bot-wide msgs/s / seconds between messages to one chat / retries
+SEND_RATE = float(os.environ.get('SEND_RATE', 30))
+CHAT_SEND_INTERVAL = float(os.environ.get('CHAT_SEND_INTERVAL', 1.0))
+GROUP_SEND_INTERVAL = float(os.environ.get('GROUP_SEND_INTERVAL', 3.0))
+SEND_RETRIES = int(os.environ.get('SEND_RETRIES', 3))
+
+# Broadcast jobs: users per batch / seconds before a dead worker's job is taken over
+BROADCAST_BATCH = int(os.environ.get('BROADCAST_BATCH', 30))
+BROADCAST_LEASE = int(os.environ.get('BROADCAST_LEASE', 60))
+
+# Admin notifications: seconds between digests / events that force one early /
+# event kinds sent straight away (new_user, withdraw, contact)
+ADMIN_DIGEST_INTERVAL = float(os.environ.get('ADMIN_DIGEST_INTERVAL', 60))
+ADMIN_DIGEST_MAX = int(os.environ.get('ADMIN_DIGEST_MAX', 50))
+ADMIN_NOTIFY_IMMEDIATE = set(filter(None, os.environ.get('ADMIN_NOTIFY_IMMEDIATE', 'contact').split(',')))
+
+# Periodic jobs (seconds between runs)
+GIFT_EXPIRY_INTERVAL = int(os.environ.get('GIFT_EXPIRY_INTERVAL', 60))
+LEADERBOARD_INTERVAL = int(os.environ.get('LEADERBOARD_INTERVAL', 60))
+SEEN_UPDATES_PRUNE_INTERVAL = int(os.environ.get('SEEN_UPDATES_PRUNE_INTERVAL', 300))
+# Seconds before a failed run is retried (capped at the task's interval)
+TASK_RETRY_DELAY = int(os.environ.get('TASK_RETRY_DELAY', 30))
+
+# Channel membership cache (seconds a "member" / "not a member" answer is trusted)
+MEMBERSHIP_TTL = int(os.environ.get('MEMBERSHIP_TTL', 600))
+MEMBERSHIP_NEGATIVE_TTL = int(os.environ.get('MEMBERSHIP_NEGATIVE_TTL', 30))
+
+# Seconds between refreshes of the bot's identity and channel info
+BOT_METADATA_INTERVAL = int(os.environ.get('BOT_METADATA_INTERVAL', 3600))
+
+# Profile photo cache: disk budget in MB / seconds before a photo is fetched
+# again / wanted thumbnail width in px
+PFP_CACHE_MB = int(os.environ.get('PFP_CACHE_MB', 50))
+PFP_TTL = int(os.environ.get('PFP_TTL', 86400))
+PFP_SIZE = int(os.environ.get('PFP_SIZE', 160))
+
+# Response compression: smallest body worth compressing (bytes) / gzip level /
+# brotli quality / serve the prebuilt .gz/.br bundles instead of compressing them per request
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+STATIC_PRECOMPRESSED = os.environ.get('STATIC_PRECOMPRESSED', '1') == '1'
+
+# Database snapshots (seconds between snapshots / generations kept)
+SNAPSHOT_INTERVAL = int(os.environ.get('SNAPSHOT_INTERVAL', 600))
+SNAPSHOT_GENERATIONS = int(os.environ.get('SNAPSHOT_GENERATIONS', 5))
+
+# Logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# App Setup
+# /static is served by serve_static (Flask's own static route would shadow it)
+app = Flask(__name__, static_folder=None)
+app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+
+# Initialize Bot
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+
+# Ensure Directories
+for d in [DATA_DIR, STATIC_DIR, UPLOAD_FOLDER, SNAPSHOT_DIR, PFP_DIR, ASSETS_DIR]:
+    os.makedirs(d, exist_ok=True)
+
+# Initialize default files
+def init_default_files():
+    # Workers starting side by side take turns at recovery and migration
+    with init_lock:
+        restore_db_if_corrupt()
+        init_db()
+        init_user_shards()
+        migrate_json_to_db()
+        ledger_recover()
+        
+        # Fill in any settings keys that are missing from the table
+        conn = get_db()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
+                [(k, json.dumps(v, ensure_ascii=False)) for k, v in DEFAULT_SETTINGS.items()]
+            )
+        
+        default_files = {
+            LEADERBOARD_FILE: {"last_updated": "2000-01-01", "data": []}
+        }
+        
+        for filepath, default_data in default_files.items():
+            if not os.path.exists(filepath):
+                atomic_write_json(filepath, default_data)
+                logger.info(f"Created default file: {filepath}")
+
+# ==================== 2. DATA MANAGEMENT (SQLITE) ====================
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS withdrawals (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    tx_id TEXT,
+    user_id TEXT,
+    status TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_withdrawals_user_id ON withdrawals(user_id);
+CREATE INDEX IF NOT EXISTS idx_withdrawals_tx_id ON withdrawals(tx_id);
+CREATE TABLE IF NOT EXISTS gifts (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    code TEXT UNIQUE,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS seen_updates (
+    update_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS admin_digest (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    at TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    status TEXT NOT NULL,
+    cursor TEXT NOT NULL DEFAULT '',
+    owner INTEGER,
+    lease REAL NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+"""
+
+db_local = threading.local()
+
+def get_db(path=DB_FILE):
+    """Per-thread SQLite connection (WAL mode so readers don't block the writer)"""
+    if getattr(db_local, 'pid', None) != os.getpid():
+        # Connections must not be shared with a forked parent
+        db_local.conns = {}
+        db_local.pid = os.getpid()
+    conn = db_local.conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Commits are grouped by the flusher, so each one can afford a full fsync
+        conn.execute("PRAGMA synchronous=FULL")
+        db_local.conns[path] = conn
+    return conn
+
+def close_db_connections():
+    for conn in getattr(db_local, 'conns', {}).values():
+        conn.close()
+    db_local.conns = {}
+
+def init_db():
+    get_db().executescript(DB_SCHEMA)
+
+def dump_row(data):
+    return json.dumps(data, ensure_ascii=False)
+
+def user_row(uid, user_data):
+    return (
+        str(uid),
+        user_data.get('refer_code'),
+        user_data.get('device_id'),
+        user_data.get('username'),
+        dump_row(user_data)
+    )
+
+def read_table(table):
+    """Materialize a table in the same shape the old JSON file had"""
+    conn = get_db()
+    if table == 'settings':
+        return {k: json.loads(v) for k, v in conn.execute("SELECT key, value FROM settings")}
+    if table in ('withdrawals', 'gifts'):
+        return [json.loads(data) for (data,) in conn.execute(f"SELECT data FROM {table} ORDER BY seq")]
+    raise ValueError(f"Unknown table: {table}")
+
+def write_table(table, data, conn):
+    """Replace a whole table (bulk path only, caller owns the transaction)"""
+    if table == 'settings':
+        conn.executemany(
+            "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+            [(k, dump_row(v)) for k, v in data.items()]
+        )
+    elif table == 'withdrawals':
+        conn.execute("DELETE FROM withdrawals")
+        conn.executemany(
+            "INSERT INTO withdrawals (tx_id, user_id, status, data) VALUES (?, ?, ?, ?)",
+            [(w.get('tx_id'), w.get('user_id'), w.get('status'), dump_row(w)) for w in data]
+        )
+    elif table == 'gifts':
+        conn.execute("DELETE FROM gifts")
+        conn.executemany(
+            "INSERT INTO gifts (code, data) VALUES (?, ?)",
+            [(g.get('code'), dump_row(g)) for g in data]
+        )
+    else:
+        raise ValueError(f"Unknown table: {table}")
+
+def migrate_json_to_db():
+    """One-shot import of the legacy data/*.json files"""
+    conn = get_db()
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+        return
+    
+    migrated = []
+    with conn:
+        for filepath, table in TABLE_STORES.items():
+            if not os.path.exists(filepath):
+                continue
+            with open(filepath, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if table == 'users':
+                write_user_shards(data)
+            else:
+                write_table(table, data, conn)
+            migrated.append(filepath)
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)",
+            (datetime.now().isoformat(),)
+        )
+    
+    # Keep the old files around as a backup, but out of the way
+    for filepath in migrated:
+        os.replace(filepath, filepath + ".migrated")
+        logger.info(f"Migrated {filepath} into {DB_FILE}")
+
+# Cached data is handed out read-only. Records are never changed in place:
+# writers build a new record and publish it, so a reader holding a record
+# always sees one consistent version of it without copying anything.
+class FrozenDict(dict):
+    """Read-only dict returned by the cache (still a dict for json/jinja)"""
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("cached data is read-only, use the update_* functions")
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    setdefault = pop = popitem = clear = update = _readonly
+    
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+class ListView(Sequence):
+    """Read-only view of the first n records of a cached list store. Those
+    lists only ever grow by appends, so the view stays consistent without
+    copying the records"""
+    __slots__ = ('_data', '_len')
+    
+    def __init__(self, data, length):
+        self._data = data
+        self._len = length
+    
+    def __len__(self):
+        return self._len
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(self._data[j] for j in range(*i.indices(self._len)))
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError("list view index out of range")
+        return self._data[i]
+    
+    def __iter__(self):
+        return itertools.islice(self._data, self._len)
+    
+    def __repr__(self):
+        return f"ListView({list(self)!r})"
+
+def freeze(obj):
+    if isinstance(obj, FrozenDict):
+        return obj
+    if isinstance(obj, dict):
+        return FrozenDict((k, freeze(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, ListView)):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+def thaw(obj):
+    """Mutable deep copy of cached data"""
+    if isinstance(obj, dict):
+        return {k: thaw(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple, ListView)):
+        return [thaw(v) for v in obj]
+    return obj
+
+def store_stamp(filepath, slot=None):
+    """Identity of the data behind a store: inode plus the store's generation
+    for databases, inode plus mtime/size for JSON files"""
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    if slot is not None:
+        # Our own writes go through the cache; a replaced file or a write
+        # from another worker process is what matters
+        return (st.st_ino, effective_generation(slot))
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def invalidate_cache(cache_key):
+    with cache_lock:
+        entry = CACHE[cache_key]
+        if entry['data'] is not None:
+            entry['data'] = None
+            CACHE_STATS[cache_key]['invalidations'] += 1
+        entry['version'] += 1
+
+def cache_version(cache_key):
+    if cache_key == 'users':
+        return sum(CACHE[shard_key(i)]['version'] for i in range(SHARDS['count']))
+    return CACHE[cache_key]['version']
+
+def cached_hit(cache_key, stamp):
+    """The cached data if it is still current, else None (caller holds cache_lock)"""
+    entry = CACHE[cache_key]
+    if entry['data'] is not None and entry['stamp'] == stamp:
+        CACHE_STATS[cache_key]['hits'] += 1
+        return snapshot_view(entry['data'])
+    return None
+
+def cached_load(cache_key, stamp, loader):
+    with cache_lock:
+        view = cached_hit(cache_key, stamp)
+    if view is not None:
+        return view
+    
+    with CACHE_LOADS[cache_key]:
+        # Whoever held the load lock before us may have loaded it already
+        with cache_lock:
+            view = cached_hit(cache_key, stamp)
+            if view is not None:
+                return view
+            entry = CACHE[cache_key]
+            CACHE_STATS[cache_key]['misses' if entry['data'] is None else 'reloads'] += 1
+            version = entry['version']
+        
+        data = freeze(loader())
+        if isinstance(data, tuple):
+            data = list(data)
+        with cache_lock:
+            # An invalidation during the load means the data may be stale: hand
+            # it to this caller but leave the entry for the next load
+            if entry['version'] == version:
+                entry['data'] = data
+                entry['stamp'] = stamp
+                entry['version'] += 1
+        return snapshot_view(data)
+
+def load_json_cached(filepath, default, cache_key=None):
+    try:
+        if filepath == USERS_FILE:
+            # Shards load lazily when a user in them is touched
+            return USERS_VIEW
+        
+        table = TABLE_STORES.get(filepath)
+        if filepath == WITHDRAWALS_FILE:
+            if cache_key:
+                return load_ledger_cached()
+            return snapshot_view(freeze(ledger_records()))
+        elif table:
+            def loader():
+                # Pending writes must reach the table before we read it back
+                flush_writes()
+                return read_table(table)
+            stamp = (DB_FILE, 'db')
+        elif os.path.exists(filepath):
+            def loader():
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            stamp = (filepath, None)
+        else:
+            return default
+        
+        if cache_key:
+            return cached_load(cache_key, store_stamp(*stamp), loader)
+        return snapshot_view(freeze(loader()))
+    except Exception as e:
+        logger.error(f"Error loading {filepath}: {e}")
+        return default
+
+def snapshot_view(data):
+    # Maps are shared as-is (read-only); list stores grow in place on
+    # append, so readers get a view bounded to the records present right now
+    return ListView(data, len(data)) if isinstance(data, list) else data
+
+def save_json(filepath, data):
+    try:
+        table = TABLE_STORES.get(filepath)
+        if filepath == USERS_FILE:
+            flush_writes()
+            write_user_shards(data, replace=True)
+            for i in range(SHARDS['count']):
+                invalidate_cache(shard_key(i))
+            return True
+        elif filepath == WITHDRAWALS_FILE:
+            ledger_replace(data)
+        elif table == 'settings':
+            mark_dirty('settings', value=dict(data))
+        elif table:
+            flush_writes()
+            conn = get_db()
+            with conn:
+                write_table(table, data, conn)
+            bump_generation('db')
+        else:
+            atomic_write_json(filepath, data)
+        
+        cache_key = STORE_KEYS.get(filepath)
+        if cache_key and table:
+            invalidate_cache(cache_key)
+        elif cache_key:
+            # We just wrote the file, so keep what we wrote as the cached copy
+            with cache_lock:
+                entry = CACHE[cache_key]
+                entry['data'] = freeze(data)
+                entry['stamp'] = store_stamp(filepath)
+                entry['version'] += 1
+        
+        return True
+    except Exception as e:
+        logger.error(f"Error saving {filepath}: {e}")
+        return False
+
+def cache_stats():
+    with cache_lock:
+        stats = {}
+        for key, entry in CACHE.items():
+            stats[key] = dict(CACHE_STATS[key])
+            stats[key]['version'] = entry['version']
+            stats[key]['loaded'] = entry['data'] is not None
+        return stats
+
+def save_gift(gift):
+    try:
+        mark_dirty('gifts', gift.get('code'), gift)
+        invalidate_cache('gifts')
+        return True
+    except Exception as e:
+        logger.error(f"Error saving gift {gift.get('code')}: {e}")
+        return False
+
+def delete_gift(code):
+    try:
+        mark_dirty('gifts', code, None)
+        invalidate_cache('gifts')
+        return True
+    except Exception as e:
+        logger.error(f"Error deleting gift {code}: {e}")
+        return False
+
+def update_gift(code, fn):
+    """Read-modify-write one gift under its lock (across processes too).
+    fn gets the current record (None if there is none) and returns the new
+    one, or None to leave it; returns what fn returned. The write is
+    committed before the lock is released, so the next caller sees it."""
+    with gift_lock(code):
+        # Queued writes for this gift must land before we read it back
+        flush_writes()
+        row = get_db().execute("SELECT data FROM gifts WHERE code = ?", (code,)).fetchone()
+        gift = fn(json.loads(row[0]) if row else None)
+        if gift is None:
+            return None
+        conn = get_db()
+        with conn:
+            conn.execute("UPDATE gifts SET data = ? WHERE code = ?", (dump_row(gift), code))
+        bump_generation('db')
+        invalidate_cache('gifts')
+        return gift
+
+def get_settings():
+    current = load_json_cached(SETTINGS_FILE, None, 'settings')
+    if current is None or any(k not in current for k in DEFAULT_SETTINGS):
+        merged = copy.deepcopy(DEFAULT_SETTINGS)
+        merged.update(current or {})
+        return freeze(merged)
+    return current
+
+def update_settings(changes):
+    s = dict(get_settings())
+    s.update(changes)
+    return save_json(SETTINGS_FILE, s)
+
+def is_admin(user_id):
+    s = get_settings()
+    uid = str(user_id)
+    return uid == str(ADMIN_ID) or uid in s.get('admins', [])
+
+# ==================== 3. PROCESS COHERENCE ====================
+# Worker processes share data/ but each keeps its own cache. Every store has
+# a generation counter in GENERATIONS_FILE (mmap'd, so reading one is a
+# memory load); writers bump it after committing and cache stamps include
+# it, so other processes notice and reload. Bumps made by this process don't
+# count: its cache already has those writes.
+# In MULTI_PROCESS mode the thread locks that guard read-modify-write (the
+# ledger, user transactions, startup) also take a byte-range lock in
+# LOCK_FILE, which excludes the other processes as well.
+GEN_SLOTS = 256
+GEN_INDEX = {'db': 0, 'ledger': 1, 'segment': 2}      # user shard i uses slot 16 + i
+LOCK_OFFSETS = {'init': 0, 'ledger': 1, 'tasks': 16, 'gifts': 64}     # periodic task i uses 16 + i
+GIFT_LOCK_STRIPES = 64
+USER_LOCK_BASE = 1 << 10
+USER_LOCK_SPAN = 1 << 24
+LOCK_WAIT_BASE = 1 << 32     # byte LOCK_WAIT_BASE + offset: "another worker is waiting for offset"
+
+gen_lock = threading.Lock()
+range_guard = threading.Lock()
+COHERENCE = {
+    'map': None,
+    'gen_fd': None,
+    'lock_fd': None,
+    'local': {},        # slot -> {'start', 'gen'}: run of bumps all made by this process
+    'ranges': {},       # lock offset -> {'lock', 'owner', 'depth', 'refs'} while threads here hold or wait for it
+    'bumps': 0,
+    'lock_waits': 0
 }
 
-# Logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+def open_coherence_files():
+    fd = os.open(GENERATIONS_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    if os.fstat(fd).st_size < GEN_SLOTS * 8:
+        os.ftruncate(fd, GEN_SLOTS * 8)
+    COHERENCE['gen_fd'] = fd
+    COHERENCE['map'] = mmap.mmap(fd, GEN_SLOTS * 8)
+    COHERENCE['lock_fd'] = os.open(LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+
+def gen_slot(slot):
+    if isinstance(slot, int):
+        return 16 + slot
+    return GEN_INDEX[slot]
+
+def shared_generation(slot):
+    return struct.unpack_from('<Q', COHERENCE['map'], gen_slot(slot) * 8)[0]
+
+def effective_generation(slot):
+    """Generation for cache stamps, with this process's own bumps folded away"""
+    i = gen_slot(slot)
+    current = struct.unpack_from('<Q', COHERENCE['map'], i * 8)[0]
+    run = COHERENCE['local'].get(i)
+    if run and run['gen'] == current:
+        return run['start']
+    return current
+
+def bump_generation(slot):
+    """Announce a committed write to a store; returns the new generation"""
+    i = gen_slot(slot)
+    with gen_lock:
+        if MULTI_PROCESS:
+            fcntl.lockf(COHERENCE['gen_fd'], fcntl.LOCK_EX, 8, i * 8)
+        try:
+            old = struct.unpack_from('<Q', COHERENCE['map'], i * 8)[0]
+            struct.pack_into('<Q', COHERENCE['map'], i * 8, old + 1)
+        finally:
+            if MULTI_PROCESS:
+                fcntl.lockf(COHERENCE['gen_fd'], fcntl.LOCK_UN, 8, i * 8)
+        run = COHERENCE['local'].get(i)
+        if run and run['gen'] == old:
+            run['gen'] = old + 1
+        else:
+            # Someone else wrote since our last bump, start a new run
+            COHERENCE['local'][i] = {'start': old, 'gen': old + 1}
+        COHERENCE['bumps'] += 1
+    return old + 1
+
+def other_worker_waiting(offset):
+    """Whether another process has flagged that it is waiting for offset"""
+    try:
+        fcntl.lockf(COHERENCE['lock_fd'], fcntl.LOCK_EX | fcntl.LOCK_NB, 1, LOCK_WAIT_BASE + offset)
+    except OSError:
+        return True
+    fcntl.lockf(COHERENCE['lock_fd'], fcntl.LOCK_UN, 1, LOCK_WAIT_BASE + offset)
+    return False
+
+def range_lock(offset, timeout=-1):
+    """Cross-process lock on one byte of LOCK_FILE, re-entrant for the thread
+    holding it. Other threads of this process queue on a thread lock and then
+    take the byte themselves, so it is released between holders; while
+    another worker is waiting we let it go first instead of grabbing the byte
+    straight back."""
+    deadline = None if timeout is None or timeout < 0 else time.time() + timeout
+    me = threading.get_ident()
+    with range_guard:
+        state = COHERENCE['ranges'].setdefault(offset, {'lock': threading.Lock(), 'owner': None, 'depth': 0, 'refs': 0})
+        if state['owner'] == me:
+            state['depth'] += 1
+            return True
+        state['refs'] += 1
+    if not state['lock'].acquire(timeout=-1 if deadline is None else max(0.0, deadline - time.time())):
+        range_forget(offset, state)
+        return False
+    
+    waiting = False
+    try:
+        polite = other_worker_waiting(offset)
+        while True:
+            if not polite:
+                try:
+                    fcntl.lockf(COHERENCE['lock_fd'], fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+                    state['owner'] = me
+                    state['depth'] = 1
+                    return True
+                except OSError:
+                    pass
+            if not waiting:
+                fcntl.lockf(COHERENCE['lock_fd'], fcntl.LOCK_SH, 1, LOCK_WAIT_BASE + offset)
+                waiting = True
+            if deadline is not None and time.time() >= deadline:
+                state['lock'].release()
+                range_forget(offset, state)
+                return False
+            polite = False
+            COHERENCE['lock_waits'] += 1
+            time.sleep(0.005)
+    finally:
+        if waiting:
+            fcntl.lockf(COHERENCE['lock_fd'], fcntl.LOCK_UN, 1, LOCK_WAIT_BASE + offset)
+
+def range_forget(offset, state):
+    # Offsets nobody here holds or waits for are dropped (there is one per user)
+    with range_guard:
+        state['refs'] -= 1
+        if not state['refs']:
+            del COHERENCE['ranges'][offset]
+
+def range_unlock(offset):
+    with range_guard:
+        state = COHERENCE['ranges'][offset]
+        state['depth'] -= 1
+        if state['depth']:
+            return
+        state['owner'] = None
+    fcntl.lockf(COHERENCE['lock_fd'], fcntl.LOCK_UN, 1, offset)
+    state['lock'].release()
+    range_forget(offset, state)
+
+class ProcessLock:
+    """Thread lock that also excludes other worker processes in MULTI_PROCESS mode"""
+    def __init__(self, offset, lock=None):
+        self.offset = offset
+        self.lock = lock or threading.Lock()
+    
+    def acquire(self, timeout=-1):
+        if not self.lock.acquire(timeout=timeout):
+            return False
+        if MULTI_PROCESS and not range_lock(self.offset, timeout):
+            self.lock.release()
+            return False
+        return True
+    
+    def release(self):
+        if MULTI_PROCESS:
+            range_unlock(self.offset)
+        self.lock.release()
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    def __exit__(self, *exc):
+        self.release()
+
+def user_lock_offset(uid):
+    return USER_LOCK_BASE + zlib.crc32(str(uid).encode()) % USER_LOCK_SPAN
+
+def gift_lock(code):
+    return GIFT_LOCKS[zlib.crc32(str(code).encode()) % GIFT_LOCK_STRIPES]
+
+def coherence_stats():
+    with gen_lock:
+        return {
+            'multi_process': MULTI_PROCESS,
+            'pid': os.getpid(),
+            'bumps': COHERENCE['bumps'],
+            'lock_waits': COHERENCE['lock_waits'],
+            'generations': {name: shared_generation(name) for name in GEN_INDEX}
+        }
+
+open_coherence_files()
+init_lock = ProcessLock(LOCK_OFFSETS['init'])
+GIFT_LOCKS = [ProcessLock(LOCK_OFFSETS['gifts'] + i) for i in range(GIFT_LOCK_STRIPES)]
+
+# ==================== 4. USER SHARDS ====================
+# Users live in USERS_DIR as a fixed set of SQLite files picked by a hash of
+# the user id, so a lookup or a write only ever touches one small file and
+# its cache entry. manifest.json records how many shards the set was built
+# with; changing that is an offline job (`python app.py reshard N`).
+USER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    refer_code TEXT,
+    device_id TEXT,
+    username TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_users_refer_code ON users(refer_code);
+CREATE INDEX IF NOT EXISTS idx_users_device_id ON users(device_id);
+"""
+
+SHARDS = {'count': 0}
+
+def shard_name(i):
+    return f"shard-{i:02d}.db"
+
+def shard_path(i, users_dir=USERS_DIR):
+    return os.path.join(users_dir, shard_name(i))
+
+def shard_key(i):
+    return f"users:{i:02d}"
+
+def shard_for(uid, count=None):
+    # crc32 rather than hash(): it must not change between processes
+    return zlib.crc32(str(uid).encode()) % (count or SHARDS['count'])
+
+def read_shard_manifest(users_dir=USERS_DIR):
+    try:
+        with open(os.path.join(users_dir, "manifest.json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def build_user_shards(count, users):
+    """Write a complete shard set beside USERS_DIR, then swap it in"""
+    new_dir = USERS_DIR + ".new"
+    shutil.rmtree(new_dir, ignore_errors=True)
+    os.makedirs(new_dir)
+    
+    buckets = [[] for _ in range(count)]
+    for uid, u in users.items():
+        buckets[shard_for(uid, count)].append(user_row(uid, u))
+    for i, rows in enumerate(buckets):
+        path = shard_path(i, new_dir)
+        conn = sqlite3.connect(path)
+        try:
+            conn.executescript(USER_SCHEMA)
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO users (user_id, refer_code, device_id, username, data) VALUES (?, ?, ?, ?, ?)",
+                    rows
+                )
+        finally:
+            conn.close()
+        with open(path, 'rb') as f:
+            os.fsync(f.fileno())
+    atomic_write_json(os.path.join(new_dir, "manifest.json"), {
+        'shards': count,
+        'users': len(users),
+        'created': datetime.now().isoformat()
+    })
+    
+    if os.path.exists(USERS_DIR):
+        os.replace(USERS_DIR, f"{USERS_DIR}.old-{int(time.time())}")
+    os.replace(new_dir, USERS_DIR)
+    fsync_dir(DATA_DIR)
+
+def init_user_shards():
+    manifest = read_shard_manifest()
+    if manifest is None and read_shard_manifest(USERS_DIR + ".new"):
+        # A reshard finished writing but stopped before the swap
+        os.replace(USERS_DIR + ".new", USERS_DIR)
+        manifest = read_shard_manifest()
+    if manifest is None:
+        # First start with shards: move users out of the single database
+        conn = get_db()
+        users = {}
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone():
+            users = {uid: json.loads(data) for uid, data in conn.execute("SELECT user_id, data FROM users")}
+        build_user_shards(USER_SHARDS, users)
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS users")
+        logger.info(f"Moved {len(users)} users into {USER_SHARDS} shards")
+        manifest = read_shard_manifest()
+    
+    SHARDS['count'] = manifest['shards']
+    if SHARDS['count'] != USER_SHARDS:
+        logger.warning(f"{USERS_DIR} has {SHARDS['count']} shards, USER_SHARDS={USER_SHARDS} is ignored until `python app.py reshard {USER_SHARDS}`")
+    for i in range(SHARDS['count']):
+        get_db(shard_path(i)).executescript(USER_SCHEMA)
+        register_cache(shard_key(i))
+
+def write_user_shards(users, replace=False):
+    """Upsert {uid: record} grouped by shard; replace=True empties every shard first"""
+    buckets = {}
+    for uid, u in users.items():
+        buckets.setdefault(shard_for(uid), []).append(user_row(uid, u))
+    shards = range(SHARDS['count']) if replace else sorted(buckets)
+    for i in shards:
+        conn = get_db(shard_path(i))
+        with conn:
+            if replace:
+                conn.execute("DELETE FROM users")
+            conn.executemany(
+                "INSERT OR REPLACE INTO users (user_id, refer_code, device_id, username, data) VALUES (?, ?, ?, ?, ?)",
+                buckets.get(i, [])
+            )
+        bump_generation(i)
+
+def read_user_shard(i):
+    conn = get_db(shard_path(i))
+    return {uid: json.loads(data) for uid, data in conn.execute("SELECT user_id, data FROM users")}
+
+def load_user_shard(i):
+    def loader():
+        # Pending writes must reach the shard before we read it back
+        flush_writes()
+        users = read_user_shard(i)
+        reindex_shard(i, users)
+        return users
+    return cached_load(shard_key(i), store_stamp(shard_path(i), i), loader)
+
+# In-memory secondary indexes (value -> set of uids), kept in step with the
+# cache under cache_lock: a shard is reindexed whenever it is (re)loaded and
+# save_user moves single entries. USER_INDEX['keys'] remembers what each
+# shard contributed so a reload can take exactly that back out.
+INDEX_FIELDS = ('refer_code', 'device_id', 'username')
+USER_INDEX = {field: {} for field in INDEX_FIELDS}
+USER_INDEX['keys'] = {}     # shard -> {uid: (refer_code, device_id, username)}
+USER_INDEX['check'] = {'last': None, 'problems': 0, 'repairs': 0}
+
+def index_key(field, value):
+    if value is None or value == '':
+        return None
+    # Telegram usernames are case-insensitive
+    return str(value).lower() if field == 'username' else str(value)
+
+def index_user(shard, uid, record):
+    """Move one user's index entries to match record (None removes them); caller holds cache_lock"""
+    keys = USER_INDEX['keys'].setdefault(shard, {})
+    old = keys.pop(uid, (None,) * len(INDEX_FIELDS))
+    new = (None,) * len(INDEX_FIELDS) if record is None else tuple(index_key(f, record.get(f)) for f in INDEX_FIELDS)
+    for field, before, after in zip(INDEX_FIELDS, old, new):
+        if before == after:
+            continue
+        if before is not None:
+            uids = USER_INDEX[field].get(before)
+            if uids:
+                uids.discard(uid)
+                if not uids:
+                    del USER_INDEX[field][before]
+        if after is not None:
+            USER_INDEX[field].setdefault(after, set()).add(uid)
+    if record is not None:
+        keys[uid] = new
+
+def reindex_shard(i, users):
+    for uid in list(USER_INDEX['keys'].get(i, {})):
+        index_user(i, uid, None)
+    for uid, u in users.items():
+        index_user(i, uid, u)
+
+def find_users(field, value):
+    """uids whose `field` equals value, without scanning any records"""
+    # Loading is a no-op for shards already cached and indexed
+    for i in range(SHARDS['count']):
+        load_user_shard(i)
+    key = index_key(field, value)
+    with cache_lock:
+        return set(USER_INDEX[field].get(key, ())) if key is not None else set()
+
+def find_user(field, value):
+    uids = find_users(field, value)
+    return min(uids) if uids else None
+
+def check_user_index(repair=True):
+    """Compare the indexes with the cached records; returns the mismatches found"""
+    problems = []
+    for i in range(SHARDS['count']):
+        users = load_user_shard(i)
+        with cache_lock:
+            keys = USER_INDEX['keys'].get(i, {})
+            found = len(problems)
+            for uid in set(users) | set(keys):
+                expected = None if uid not in users else tuple(index_key(f, users[uid].get(f)) for f in INDEX_FIELDS)
+                if expected != keys.get(uid):
+                    problems.append(f"shard {i} user {uid}: indexed {keys.get(uid)}, stored {expected}")
+                for field, value in zip(INDEX_FIELDS, expected or ()):
+                    if value is not None and uid not in USER_INDEX[field].get(value, ()):
+                        problems.append(f"{field} {value!r} is missing {uid}")
+            if len(problems) > found and repair:
+                USER_INDEX['keys'].pop(i, None)
+                reindex_shard(i, users)
+    
+    with cache_lock:
+        # Every uid an index points to must still carry that value
+        for pos, field in enumerate(INDEX_FIELDS):
+            for value, uids in list(USER_INDEX[field].items()):
+                for uid in list(uids):
+                    indexed = USER_INDEX['keys'].get(shard_for(uid), {}).get(uid)
+                    if indexed is None or indexed[pos] != value:
+                        problems.append(f"{field} {value!r} points to {uid} which does not have it")
+                        if repair:
+                            uids.discard(uid)
+                if not uids:
+                    del USER_INDEX[field][value]
+        USER_INDEX['check'] = {
+            'last': datetime.now().isoformat(),
+            'problems': len(problems),
+            'repairs': USER_INDEX['check']['repairs'] + (1 if problems and repair else 0)
+        }
+    for problem in problems[:20]:
+        logger.error(f"User index mismatch: {problem}")
+    return problems
+
+def index_stats():
+    with cache_lock:
+        stats = {field: len(USER_INDEX[field]) for field in INDEX_FIELDS}
+        stats['indexed_shards'] = len(USER_INDEX['keys'])
+        stats['check'] = dict(USER_INDEX['check'])
+        return stats
+
+class UsersView(Mapping):
+    """Read-only {uid: user} over all shards; a shard loads when first touched"""
+    def __getitem__(self, uid):
+        return load_user_shard(shard_for(uid))[str(uid)]
+    
+    def __contains__(self, uid):
+        return str(uid) in load_user_shard(shard_for(uid))
+    
+    def __iter__(self):
+        for i in range(SHARDS['count']):
+            yield from load_user_shard(i)
+    
+    def __len__(self):
+        return sum(len(load_user_shard(i)) for i in range(SHARDS['count']))
+    
+    def items(self):
+        for i in range(SHARDS['count']):
+            yield from load_user_shard(i).items()
+    
+    def values(self):
+        for i in range(SHARDS['count']):
+            yield from load_user_shard(i).values()
+
+USERS_VIEW = UsersView()
+
+# Row-level writes: cost grows with the change, not with the number of users
+def save_users(records):
+    """Publish new versions of {uid: record} together (one flush batch)"""
+    records = {str(uid): freeze(data) for uid, data in records.items()}
+    mark_dirty('users', items=records)
+    
+    # Write-through so the cached shard stays valid. Replacing a value
+    # never disturbs readers iterating the map; adding a key would, so a
+    # new user gets a fresh map (copy-on-write) instead.
+    with cache_lock:
+        for uid, record in records.items():
+            entry = CACHE[shard_key(shard_for(uid))]
+            users = entry['data']
+            if users is not None:
+                if uid not in users:
+                    users = FrozenDict(users)
+                    entry['data'] = users
+                dict.__setitem__(users, uid, record)
+                # An unloaded shard is reindexed as a whole when it loads
+                index_user(shard_for(uid), uid, record)
+            entry['version'] += 1
+    return records
+
+def save_user(uid, user_data):
+    """Publish a new version of one user record"""
+    try:
+        return save_users({uid: user_data})[str(uid)]
+    except Exception as e:
+        logger.error(f"Error saving user {uid}: {e}")
+        return None
+
+def get_user(uid):
+    return load_user_shard(shard_for(uid)).get(str(uid))
+
+def update_user(uid, changes):
+    """Apply changes to one user under its lock; returns the new record"""
+    def apply(txn):
+        if txn.get(uid) is None:
+            return None
+        txn.update(uid, changes)
+        return True
+    if run_user_transaction([uid], apply) is None:
+        return None
+    return get_user(uid)
+
+def reshard_users(count, source=None):
+    """Offline: rebuild the shard set with `count` shards, from the current
+    shards or from a users.json export"""
+    if source:
+        with open(source, 'r', encoding='utf-8') as f:
+            users = json.load(f)
+    else:
+        flush_writes()
+        users = {}
+        for i in range(SHARDS['count']):
+            users.update(read_user_shard(i))
+    close_db_connections()
+    build_user_shards(count, users)
+    logger.info(f"Resharded {len(users)} users into {count} shards (previous set kept as {USERS_DIR}.old-*)")
+
+# ==================== 5. USER TRANSACTIONS ====================
+# Read-modify-write of user records happens inside a transaction that holds
+# a lock per user (taken in sorted order, so two transactions can't
+# deadlock, and users that aren't involved never wait). Changes are staged
+# on copies and published together on commit. Records are replaced, never
+# mutated, so a record that is no longer the object the transaction started
+# from means someone wrote around the lock: that is a conflict and the
+# whole transaction is retried.
+class TransactionConflict(Exception):
+    pass
+
+user_locks_guard = threading.Lock()
+USER_LOCKS = weakref.WeakValueDictionary()     # uid -> lock, dropped once unused
+TXN_STATS = {'commits': 0, 'conflicts': 0, 'retries': 0, 'lock_wait_ms': 0.0}
+
+def user_lock(uid):
+    with user_locks_guard:
+        lock = USER_LOCKS.get(uid)
+        if lock is None:
+            lock = threading.Lock()
+            USER_LOCKS[uid] = lock
+        return lock
+
+class UserTransaction:
+    def __init__(self, uids):
+        self.base = {uid: get_user(uid) for uid in uids}
+        self.records = {uid: None if rec is None else dict(rec) for uid, rec in self.base.items()}
+        self.changed = set()
+    
+    def _record(self, uid):
+        uid = str(uid)
+        if uid not in self.records:
+            raise KeyError(f"user {uid} is not part of this transaction")
+        if self.records[uid] is None:
+            raise KeyError(f"user {uid} does not exist")
+        return uid, self.records[uid]
+    
+    def get(self, uid):
+        """Current (staged) record, None if the user doesn't exist"""
+        uid = str(uid)
+        if uid not in self.records:
+            raise KeyError(f"user {uid} is not part of this transaction")
+        return self.records[uid]
+    
+    def create(self, uid, record):
+        uid = str(uid)
+        if self.get(uid) is not None:
+            raise KeyError(f"user {uid} already exists")
+        self.records[uid] = dict(record)
+        self.changed.add(uid)
+    
+    def update(self, uid, changes):
+        uid, record = self._record(uid)
+        record.update(changes)
+        self.changed.add(uid)
+    
+    def add(self, uid, field, delta):
+        """Atomic delta on a numeric field; returns the new value"""
+        uid, record = self._record(uid)
+        record[field] = float(record.get(field, 0)) + delta
+        self.changed.add(uid)
+        return record[field]
+    
+    def append(self, uid, field, value):
+        uid, record = self._record(uid)
+        record[field] = list(record.get(field, [])) + [value]
+        self.changed.add(uid)
+    
+    def commit(self):
+        for uid, base in self.base.items():
+            if get_user(uid) is not base:
+                raise TransactionConflict(f"user {uid} changed during the transaction")
+        if self.changed:
+            save_users({uid: self.records[uid] for uid in self.changed})
+
+def run_user_transaction(uids, fn, retries=None):
+    """Lock the users, run fn(txn) and commit what it staged; returns fn's result.
+    
+    If fn raises, nothing is written. TransactionConflict is raised once the
+    retries are used up (lock timeouts count as conflicts too).
+    """
+    uids = sorted({str(uid) for uid in uids})
+    retries = USER_TXN_RETRIES if retries is None else retries
+    for attempt in range(retries + 1):
+        held = []
+        ranges = []
+        try:
+            started = time.time()
+            for uid in uids:
+                lock = user_lock(uid)
+                if not lock.acquire(timeout=USER_LOCK_TIMEOUT):
+                    raise TransactionConflict(f"timed out waiting for user {uid}")
+                held.append(lock)
+            if MULTI_PROCESS:
+                for offset in sorted({user_lock_offset(uid) for uid in uids}):
+                    if not range_lock(offset, max(0.0, started + USER_LOCK_TIMEOUT - time.time())):
+                        raise TransactionConflict(f"timed out waiting for another worker on {uids}")
+                    ranges.append(offset)
+            TXN_STATS['lock_wait_ms'] += (time.time() - started) * 1000
+            
+            txn = UserTransaction(uids)
+            result = fn(txn)
+            txn.commit()
+            if ranges and txn.changed and not flush_barrier(USER_LOCK_TIMEOUT):
+                # Other workers read the shard, not our cache
+                logger.error(f"User transaction on {uids} not flushed before unlock")
+            TXN_STATS['commits'] += 1
+            return result
+        except TransactionConflict as e:
+            TXN_STATS['conflicts'] += 1
+            if attempt == retries:
+                logger.error(f"User transaction gave up on {uids}: {e}")
+                raise
+            TXN_STATS['retries'] += 1
+        finally:
+            for offset in reversed(ranges):
+                range_unlock(offset)
+            for lock in reversed(held):
+                lock.release()
+        time.sleep(random.uniform(0.005, 0.05) * (attempt + 1))
+
+def txn_stats():
+    stats = dict(TXN_STATS)
+    stats['lock_wait_ms'] = round(stats['lock_wait_ms'], 2)
+    with user_locks_guard:
+        stats['live_locks'] = len(USER_LOCKS)
+    return stats
+
+# ==================== 6. WRITE-BEHIND FLUSHER ====================
+# Mutations only mark rows dirty. A background flusher folds everything that
+# piled up into one transaction (and one ledger fsync) per FLUSH_INTERVAL,
+# or sooner once FLUSH_MAX_PENDING writes are waiting or a barrier asks.
+write_cond = threading.Condition()
+flush_lock = threading.Lock()
+WRITE_BEHIND = {
+    'users': {},        # uid -> record
+    'gifts': {},        # code -> record, None means delete
+    'updates': {},      # update_id -> True, webhook updates already accepted
+    'settings': None,   # whole settings dict
+    'ledger': False,    # ledger segment needs an fsync
+    'marked': 0,        # logical writes accepted
+    'flushed': 0,       # logical writes made durable
+    'urgent': False,
+    'thread': None,
+    'pid': None,
+    'stats': {
+        'logical_writes': 0,
+        'physical_writes': 0,
+        'last_batch': 0,
+        'max_batch': 0,
+        'last_flush_ms': 0.0,
+        'errors': 0
+    }
+}
+
+def ensure_flusher():
+    """Start the flusher thread (again after a fork, threads don't survive it)"""
+    t = WRITE_BEHIND['thread']
+    if t is None or not t.is_alive() or WRITE_BEHIND['pid'] != os.getpid():
+        WRITE_BEHIND['pid'] = os.getpid()
+        WRITE_BEHIND['thread'] = threading.Thread(target=flusher_loop, name="flusher", daemon=True)
+        WRITE_BEHIND['thread'].start()
+
+def mark_dirty(store, key=None, value=None, items=None):
+    """Queue a write; items={key: value} queues several rows into the same flush"""
+    with write_cond:
+        if store == 'ledger':
+            WRITE_BEHIND['ledger'] = True
+        elif store == 'settings':
+            WRITE_BEHIND['settings'] = value
+        else:
+            WRITE_BEHIND[store].update(items if items is not None else {key: value})
+        count = len(items) if items is not None else 1
+        WRITE_BEHIND['marked'] += count
+        WRITE_BEHIND['stats']['logical_writes'] += count
+        ensure_flusher()
+        if WRITE_BEHIND['marked'] - WRITE_BEHIND['flushed'] >= FLUSH_MAX_PENDING:
+            WRITE_BEHIND['urgent'] = True
+            write_cond.notify_all()
+        return WRITE_BEHIND['marked']
+
+def flusher_loop():
+    while True:
+        with write_cond:
+            if not WRITE_BEHIND['urgent']:
+                write_cond.wait(FLUSH_INTERVAL)
+            WRITE_BEHIND['urgent'] = False
+        flush_writes()
+
+def flush_writes():
+    """Write out everything marked so far as one physical write"""
+    with flush_lock:
+        with write_cond:
+            target = WRITE_BEHIND['marked']
+            batch = target - WRITE_BEHIND['flushed']
+            if batch == 0:
+                return 0
+            users, WRITE_BEHIND['users'] = WRITE_BEHIND['users'], {}
+            gifts, WRITE_BEHIND['gifts'] = WRITE_BEHIND['gifts'], {}
+            updates, WRITE_BEHIND['updates'] = WRITE_BEHIND['updates'], {}
+            settings, WRITE_BEHIND['settings'] = WRITE_BEHIND['settings'], None
+            ledger, WRITE_BEHIND['ledger'] = WRITE_BEHIND['ledger'], False
+        
+        started = time.time()
+        try:
+            if users:
+                # One transaction per touched shard
+                write_user_shards(users)
+            if gifts or settings:
+                conn = get_db()
+                with conn:
+                    for code, gift in gifts.items():
+                        if gift is None:
+                            conn.execute("DELETE FROM gifts WHERE code = ?", (code,))
+                        else:
+                            conn.execute(
+                                "INSERT INTO gifts (code, data) VALUES (?, ?) ON CONFLICT(code) DO UPDATE SET data = excluded.data",
+                                (code, dump_row(gift))
+                            )
+                    if settings:
+                        write_table('settings', settings, conn)
+                bump_generation('db')
+            if updates:
+                conn = get_db()
+                with conn:
+                    conn.executemany("INSERT OR IGNORE INTO seen_updates (update_id) VALUES (?)", [(u,) for u in updates])
+            if ledger:
+                ledger_sync()
+        except Exception as e:
+            logger.error(f"Flush error: {e}")
+            # Put the batch back unless something newer was marked meanwhile
+            with write_cond:
+                for uid, u in users.items():
+                    WRITE_BEHIND['users'].setdefault(uid, u)
+                for code, gift in gifts.items():
+                    WRITE_BEHIND['gifts'].setdefault(code, gift)
+                WRITE_BEHIND['updates'].update(updates)
+                if WRITE_BEHIND['settings'] is None:
+                    WRITE_BEHIND['settings'] = settings
+                WRITE_BEHIND['ledger'] = WRITE_BEHIND['ledger'] or ledger
+                WRITE_BEHIND['stats']['errors'] += 1
+            return 0
+        
+        with write_cond:
+            WRITE_BEHIND['flushed'] = target
+            stats = WRITE_BEHIND['stats']
+            stats['physical_writes'] += 1
+            stats['last_batch'] = batch
+            stats['max_batch'] = max(stats['max_batch'], batch)
+            stats['last_flush_ms'] = round((time.time() - started) * 1000, 2)
+            write_cond.notify_all()
+        return batch
+
+def flush_barrier(timeout=5.0):
+    """Block until every write accepted so far is durable, False on timeout"""
+    with write_cond:
+        target = WRITE_BEHIND['marked']
+        if WRITE_BEHIND['flushed'] >= target:
+            return True
+        ensure_flusher()
+        WRITE_BEHIND['urgent'] = True
+        write_cond.notify_all()
+        return write_cond.wait_for(lambda: WRITE_BEHIND['flushed'] >= target, timeout)
+
+def write_stats():
+    with write_cond:
+        stats = dict(WRITE_BEHIND['stats'])
+        stats['pending'] = WRITE_BEHIND['marked'] - WRITE_BEHIND['flushed']
+    physical = stats['physical_writes']
+    stats['writes_per_flush'] = round(stats['logical_writes'] / physical, 2) if physical else 0
+    return stats
+
+atexit.register(flush_writes)
+
+# ==================== 7. SNAPSHOTS ====================
+# Files are never rewritten in place: write a temp file, fsync it, then
+# rename over the target. bot.db and the user shards are copied together
+# into a generation directory under SNAPSHOT_DIR by the 'snapshot'
+# periodic task (one worker at a time), keeping SNAPSHOT_GENERATIONS of
+# them. The store generations at the last snapshot are kept in the meta
+# table, so a run that finds them unchanged skips the copy.
+SNAPSHOTS = {
+    'last': None,
+    'last_ms': 0.0,
+    'count': 0,
+    'errors': 0
+}
+
+def fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+def atomic_write_json(filepath, data):
+    tmp = f"{filepath}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filepath)
+        fsync_dir(os.path.dirname(filepath))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def db_is_valid(path, table=None):
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            if conn.execute("PRAGMA quick_check").fetchone()[0] != 'ok':
+                return False
+            if table:
+                conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+            return True
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.error(f"Database check failed for {path}: {e}")
+        return False
+
+def list_snapshots():
+    """Snapshot generation directories, newest first"""
+    names = [n for n in os.listdir(SNAPSHOT_DIR) if n.startswith("gen-") and not n.endswith(".tmp")]
+    return [os.path.join(SNAPSHOT_DIR, n) for n in sorted(names, reverse=True)]
+
+def copy_file_durable(src, dst):
+    tmp = dst + ".restore"
+    with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    os.replace(tmp, dst)
+    fsync_dir(os.path.dirname(dst))
+
+def restore_users_dir():
+    """The whole shard set is gone: bring back the newest complete one"""
+    for gen in list_snapshots():
+        gen_users = os.path.join(gen, "users")
+        manifest = read_shard_manifest(gen_users)
+        if manifest and all(db_is_valid(shard_path(i, gen_users), 'users') for i in range(manifest['shards'])):
+            tmp = USERS_DIR + ".restore"
+            shutil.rmtree(tmp, ignore_errors=True)
+            shutil.copytree(gen_users, tmp)
+            for name in os.listdir(tmp):
+                with open(os.path.join(tmp, name), 'rb') as f:
+                    os.fsync(f.fileno())
+            os.replace(tmp, USERS_DIR)
+            fsync_dir(DATA_DIR)
+            logger.warning(f"Restored {USERS_DIR} from {gen}")
+            return True
+    return False
+
+def restore_db_if_corrupt():
+    """Startup check: every damaged database file (bot.db or a user shard) is
+    replaced by its copy from the newest generation that has a good one"""
+    restored = False
+    manifest = read_shard_manifest()
+    if manifest is None and not os.path.exists(USERS_DIR + ".new"):
+        restored = restore_users_dir()
+        manifest = read_shard_manifest()
+    
+    targets = [(DB_FILE, "bot.db", 'settings')]
+    if manifest:
+        targets += [(shard_path(i), os.path.join("users", shard_name(i)), 'users') for i in range(manifest['shards'])]
+    
+    for path, rel, table in targets:
+        if os.path.exists(path) and db_is_valid(path):
+            continue
+        if not os.path.exists(path) and path == DB_FILE:
+            # Fresh install, nothing to restore
+            continue
+        
+        source = None
+        for gen in list_snapshots():
+            if table == 'users':
+                # Shard files only fit a set with the same shard count
+                gen_manifest = read_shard_manifest(os.path.join(gen, "users"))
+                if not gen_manifest or gen_manifest['shards'] != manifest['shards']:
+                    continue
+            candidate = os.path.join(gen, rel)
+            if os.path.exists(candidate) and db_is_valid(candidate, table):
+                source = candidate
+                break
+        if not source:
+            logger.error(f"{path} is damaged or missing and there is no good snapshot to restore")
+            continue
+        
+        if os.path.exists(path):
+            os.replace(path, f"{path}.corrupt-{int(time.time())}")
+        # A leftover WAL belongs to the damaged file, never replay it onto the snapshot
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        copy_file_durable(source, path)
+        logger.warning(f"Restored {path} from {source}")
+        restored = True
+    return restored
+
+def snapshot_db():
+    """Copy bot.db and every user shard into a new snapshot generation"""
+    started = time.time()
+    tmp = None
+    try:
+        # Make the snapshot include everything accepted so far
+        flush_writes()
+        compact_ledger()
+        fingerprint = snapshot_fingerprint()
+        
+        path = os.path.join(SNAPSHOT_DIR, f"gen-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}")
+        tmp = path + ".tmp"
+        os.makedirs(os.path.join(tmp, "users"))
+        files = [(get_db(), os.path.join(tmp, "bot.db"))]
+        files += [(get_db(shard_path(i)), shard_path(i, os.path.join(tmp, "users"))) for i in range(SHARDS['count'])]
+        for src, target in files:
+            dst = sqlite3.connect(target)
+            try:
+                src.backup(dst)
+            finally:
+                dst.close()
+            with open(target, 'rb') as f:
+                os.fsync(f.fileno())
+        shutil.copy(os.path.join(USERS_DIR, "manifest.json"), os.path.join(tmp, "users", "manifest.json"))
+        fsync_dir(os.path.join(tmp, "users"))
+        fsync_dir(tmp)
+        os.replace(tmp, path)
+        fsync_dir(SNAPSHOT_DIR)
+        
+        for old in list_snapshots()[SNAPSHOT_GENERATIONS:]:
+            shutil.rmtree(old, ignore_errors=True)
+        
+        conn = get_db()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('snapshot_fingerprint', ?)", (dump_row(fingerprint),))
+        SNAPSHOTS['last'] = datetime.now().isoformat()
+        SNAPSHOTS['last_ms'] = round((time.time() - started) * 1000, 2)
+        SNAPSHOTS['count'] += 1
+        return path
+    except Exception as e:
+        SNAPSHOTS['errors'] += 1
+        logger.error(f"Snapshot error: {e}")
+        if tmp and os.path.exists(tmp):
+            shutil.rmtree(tmp, ignore_errors=True)
+        return None
+
+def snapshot_fingerprint():
+    """Generations of every store; equal fingerprints mean nothing was written in between"""
+    return [shared_generation(name) for name in sorted(GEN_INDEX)] + [shared_generation(i) for i in range(SHARDS['count'])]
+
+def run_snapshot():
+    """Periodic task: a new generation unless nothing changed since the last one"""
+    flush_writes()
+    row = get_db().execute("SELECT value FROM meta WHERE key = 'snapshot_fingerprint'").fetchone()
+    if row and json.loads(row[0]) == snapshot_fingerprint():
+        return None
+    path = snapshot_db()
+    if path is None:
+        raise RuntimeError("snapshot failed")
+    check_user_index()
+    return os.path.basename(path)
+
+def snapshot_stats():
+    stats = {k: SNAPSHOTS[k] for k in ('last', 'last_ms', 'count', 'errors')}
+    stats['generations'] = len(list_snapshots())
+    return stats
+
+# ==================== 8. TRANSACTION LEDGER ====================
+# Withdrawals, bonuses and gift rewards are appended as JSON lines to the
+# active log segment and kept in memory until compaction folds them into
+# the withdrawals table. An append is one line write, whatever the ledger size.
+# Other worker processes append to the same segment; LEDGER['gen'] is the
+# ledger generation our tail reflects and LEDGER['offset'] how far into the
+# segment we have read, so newer entries are read from there on. The
+# 'segment' generation changes when compaction or a rewrite truncates it.
+ledger_lock = ProcessLock(LOCK_OFFSETS['ledger'], threading.RLock())
+LEDGER = {
+    'file': None,
+    'pid': None,
+    'gen': None,
+    'epoch': None,    # 'segment' generation the offset belongs to
+    'offset': 0,
+    'next_seq': 1,
+    'tail': {},       # seq -> record not yet compacted
+    'updates': {},    # seq -> changes for records already in the table
+    'last_compact': time.time(),
+    'compacting': False
+}
+
+def ledger_file():
+    if LEDGER['file'] is None or LEDGER['pid'] != os.getpid():
+        LEDGER['file'] = open(LEDGER_FILE, 'a', encoding='utf-8')
+        LEDGER['pid'] = os.getpid()
+    return LEDGER['file']
+
+def ledger_write(entry):
+    f = ledger_file()
+    line = json.dumps(entry, ensure_ascii=False) + "\n"
+    f.write(line)
+    f.flush()
+    LEDGER['offset'] += len(line.encode('utf-8'))
+    if LEDGER_FSYNC:
+        # The fsync itself is grouped by the flusher
+        mark_dirty('ledger')
+
+def ledger_sync():
+    with ledger_lock:
+        f = ledger_file()
+    os.fsync(f.fileno())
+
+def ledger_apply(entry):
+    """Apply one log entry to the in-memory tail"""
+    seq = entry['seq']
+    if entry['op'] == 'add':
+        LEDGER['tail'][seq] = entry['record']
+    elif entry['op'] == 'update':
+        if seq in LEDGER['tail']:
+            LEDGER['tail'][seq].update(entry['changes'])
+        else:
+            LEDGER['updates'].setdefault(seq, {}).update(entry['changes'])
+    LEDGER['next_seq'] = max(LEDGER['next_seq'], seq + 1)
+
+def ledger_table_max_seq(conn):
+    row = conn.execute(
+        "SELECT MAX(m) FROM (SELECT MAX(seq) AS m FROM withdrawals UNION ALL SELECT seq FROM sqlite_sequence WHERE name = 'withdrawals')"
+    ).fetchone()
+    return row[0] or 0
+
+def ledger_read_segment():
+    """Log entries past LEDGER['offset'], advancing it (caller holds ledger_lock)"""
+    entries = []
+    if not os.path.exists(LEDGER_FILE):
+        return entries
+    with open(LEDGER_FILE, 'rb') as f:
+        f.seek(LEDGER['offset'])
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            LEDGER['offset'] += len(line)
+            if not line.strip():
+                continue
+            try:
+                entries.append(json.loads(line))
+            except Exception as e:
+                # Only the last line can be torn by a crash mid-append
+                logger.error(f"Skipping bad ledger line: {e}")
+    return entries
+
+def ledger_reload():
+    """Rebuild the in-memory tail from the table and the active segment"""
+    with ledger_lock:
+        LEDGER['gen'] = shared_generation('ledger')
+        LEDGER['epoch'] = shared_generation('segment')
+        LEDGER['offset'] = 0
+        LEDGER['tail'] = {}
+        LEDGER['updates'] = {}
+        LEDGER['next_seq'] = ledger_table_max_seq(get_db()) + 1
+        for entry in ledger_read_segment():
+            ledger_apply(entry)
+
+def ledger_catch_up():
+    """Pick up what other processes wrote (caller holds ledger_lock)"""
+    gen = shared_generation('ledger')
+    if LEDGER['epoch'] != shared_generation('segment'):
+        # Compacted or rewritten elsewhere: what we had not read yet is gone
+        # from the segment, so start over from the table
+        missed = LEDGER['gen'] != gen
+        ledger_reload()
+        if missed:
+            invalidate_cache('withdrawals')
+        return
+    if LEDGER['gen'] == gen:
+        return
+    entries = ledger_read_segment()
+    for entry in entries:
+        ledger_apply(entry)
+    LEDGER['gen'] = gen
+    index_ledger_entries(entries)
+
+def ledger_recover():
+    """Replay the active segment after a restart, then compact it"""
+    with ledger_lock:
+        ledger_reload()
+        compact_ledger()
+
+def compact_ledger(raise_errors=False):
+    """Fold the log segment into the withdrawals table and truncate it;
+    errors are logged (and re-raised with raise_errors)"""
+    with ledger_lock:
+        try:
+            ledger_catch_up()
+            if not LEDGER['tail'] and not LEDGER['updates']:
+                return 0
+            
+            conn = get_db()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO withdrawals (seq, tx_id, user_id, status, data) VALUES (?, ?, ?, ?, ?)",
+                    [(seq, w.get('tx_id'), w.get('user_id'), w.get('status'), dump_row(w)) for seq, w in LEDGER['tail'].items()]
+                )
+                for seq, changes in LEDGER['updates'].items():
+                    row = conn.execute("SELECT data FROM withdrawals WHERE seq = ?", (seq,)).fetchone()
+                    if not row:
+                        continue
+                    record = json.loads(row[0])
+                    record.update(changes)
+                    conn.execute(
+                        "UPDATE withdrawals SET status = ?, data = ? WHERE seq = ?",
+                        (record.get('status'), dump_row(record), seq)
+                    )
+            
+            # Everything is in the table now, so the segment can start over
+            count = len(LEDGER['tail']) + len(LEDGER['updates'])
+            f = ledger_file()
+            f.seek(0)
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+            
+            # The records themselves are unchanged, only where they live
+            LEDGER['tail'] = {}
+            LEDGER['updates'] = {}
+            LEDGER['offset'] = 0
+            LEDGER['epoch'] = bump_generation('segment')
+            logger.info(f"Compacted {count} ledger entries")
+            return count
+        except Exception as e:
+            logger.error(f"Ledger compaction error: {e}")
+            if raise_errors:
+                raise
+            return 0
+        finally:
+            LEDGER['last_compact'] = time.time()
+
+def background_compaction():
+    try:
+        compact_ledger()
+    finally:
+        LEDGER['compacting'] = False
+
+def maybe_compact_ledger():
+    """Kick off a background compaction once the segment is big (the
+    ledger_compaction task takes care of old ones)"""
+    pending = len(LEDGER['tail']) + len(LEDGER['updates'])
+    if LEDGER['compacting'] or not pending:
+        return
+    if pending >= LEDGER_COMPACT_RECORDS:
+        LEDGER['compacting'] = True
+        threading.Thread(target=background_compaction, daemon=True).start()
+
+def ledger_rows():
+    """(seq, record) for the full ledger in append order"""
+    with ledger_lock:
+        ledger_catch_up()
+        rows = []
+        for seq, data in get_db().execute("SELECT seq, data FROM withdrawals ORDER BY seq"):
+            record = json.loads(data)
+            if seq in LEDGER['updates']:
+                record.update(LEDGER['updates'][seq])
+            rows.append((seq, record))
+        rows.extend(LEDGER['tail'].items())
+        return rows
+
+def ledger_records():
+    """Full ledger in append order (same list shape as the old withdrawals.json)"""
+    return [record for _, record in ledger_rows()]
+
+# Index over the cached withdrawals list: seq -> position in the list, and
+# user_id -> that user's seqs in ascending order. The list is loaded once
+# and then patched in place from each log entry, ours or another worker's
+# (under ledger_lock, then cache_lock), so it never needs a full reload
+# unless it was invalidated.
+LEDGER_INDEX = {'by_seq': {}, 'by_user': {}}
+
+def index_ledger_record(index, seq, record, pos):
+    index['by_seq'][seq] = pos
+    seqs = index['by_user'].setdefault(str(record.get('user_id')), [])
+    if seqs and seqs[-1] > seq:
+        # Appends from two workers can land out of order, keep the list sorted anyway
+        bisect.insort(seqs, seq)
+    else:
+        seqs.append(seq)
+
+def index_ledger_entries(entries):
+    """Apply log entries to the cached list and its index (caller holds ledger_lock)"""
+    with cache_lock:
+        entry = CACHE['withdrawals']
+        # Bumped even when nothing is cached, see cached_load
+        entry['version'] += 1
+        records = entry['data']
+        if records is None:
+            return
+        for item in entries:
+            seq = item['seq']
+            pos = LEDGER_INDEX['by_seq'].get(seq)
+            if item['op'] == 'add' and pos is None:
+                index_ledger_record(LEDGER_INDEX, seq, item['record'], len(records))
+                records.append(freeze(item['record']))
+            elif item['op'] == 'update':
+                if pos is None:
+                    # Not in the list we have, so the list is wrong: load it again
+                    entry['data'] = None
+                    return
+                record = thaw(records[pos])
+                record.update(item['changes'])
+                records[pos] = freeze(record)
+        entry['stamp'] = store_stamp(DB_FILE, 'ledger')
+
+def load_ledger_cached():
+    """The cached ledger list, caught up with every worker's writes"""
+    with ledger_lock:
+        ledger_catch_up()
+        stamp = store_stamp(DB_FILE, 'ledger')
+        with cache_lock:
+            entry = CACHE['withdrawals']
+            if entry['data'] is not None and entry['stamp'] == stamp:
+                CACHE_STATS['withdrawals']['hits'] += 1
+                return snapshot_view(entry['data'])
+            CACHE_STATS['withdrawals']['misses' if entry['data'] is None else 'reloads'] += 1
+        
+        # Holding ledger_lock keeps every writer out until the list is installed
+        index = {'by_seq': {}, 'by_user': {}}
+        records = []
+        for pos, (seq, record) in enumerate(ledger_rows()):
+            index_ledger_record(index, seq, record, pos)
+            records.append(freeze(record))
+        with cache_lock:
+            LEDGER_INDEX.update(index)
+            entry['data'] = records
+            entry['stamp'] = stamp
+            entry['version'] += 1
+        return snapshot_view(records)
+
+def user_history(uid, limit=10, before=None):
+    """One user's records newest first, only those with seq < before; returns (page, next cursor)"""
+    for _ in range(3):
+        stamp = store_stamp(DB_FILE, 'ledger')
+        with cache_lock:
+            entry = CACHE['withdrawals']
+            records = entry['data']
+            if records is not None and entry['stamp'] == stamp:
+                CACHE_STATS['withdrawals']['hits'] += 1
+                seqs = LEDGER_INDEX['by_user'].get(str(uid), [])
+                end = bisect.bisect_left(seqs, before) if before is not None else len(seqs)
+                start = max(0, end - limit)
+                page = [records[LEDGER_INDEX['by_seq'][seq]] for seq in reversed(seqs[start:end])]
+                return page, (seqs[start] if start > 0 else None)
+        # Missing or behind another worker: catch up (or load), then look again
+        load_ledger_cached()
+    return [], None
+
+def ledger_replace(records):
+    """Bulk rewrite of the whole ledger (admin/maintenance only)"""
+    with ledger_lock:
+        conn = get_db()
+        with conn:
+            write_table('withdrawals', records, conn)
+        f = ledger_file()
+        f.seek(0)
+        f.truncate()
+        LEDGER['tail'] = {}
+        LEDGER['updates'] = {}
+        LEDGER['next_seq'] = ledger_table_max_seq(conn) + 1
+        LEDGER['offset'] = 0
+        LEDGER['epoch'] = bump_generation('segment')
+        LEDGER['gen'] = bump_generation('ledger')
+
+def add_withdrawal(record):
+    try:
+        with ledger_lock:
+            ledger_catch_up()
+            seq = LEDGER['next_seq']
+            ledger_write({'op': 'add', 'seq': seq, 'record': record})
+            ledger_apply({'op': 'add', 'seq': seq, 'record': record})
+            LEDGER['gen'] = bump_generation('ledger')
+            index_ledger_entries([{'op': 'add', 'seq': seq, 'record': record}])
+            maybe_compact_ledger()
+        return True
+    except Exception as e:
+        logger.error(f"Error adding withdrawal {record.get('tx_id')}: {e}")
+        return False
+
+def update_withdrawal(tx_id, changes, status='pending'):
+    """Update the first record with this tx_id and status, returns the new record or None"""
+    try:
+        with ledger_lock:
+            ledger_catch_up()
+            found = None
+            for seq, data in get_db().execute("SELECT seq, data FROM withdrawals WHERE tx_id = ? ORDER BY seq", (tx_id,)):
+                record = json.loads(data)
+                record.update(LEDGER['updates'].get(seq, {}))
+                if record.get('status') == status:
+                    found = (seq, record)
+                    break
+            if not found:
+                for seq, record in LEDGER['tail'].items():
+                    if record.get('tx_id') == tx_id and record.get('status') == status:
+                        found = (seq, dict(record))
+                        break
+            if not found:
+                return None
+            
+            seq, record = found
+            entry = {'op': 'update', 'seq': seq, 'changes': changes}
+            ledger_write(entry)
+            ledger_apply(entry)
+            LEDGER['gen'] = bump_generation('ledger')
+            index_ledger_entries([entry])
+            record.update(changes)
+            maybe_compact_ledger()
+        return record
+    except Exception as e:
+        logger.error(f"Error updating withdrawal {tx_id}: {e}")
+        return None
+
+init_default_files()
+
+# ==================== 9. TELEGRAM CLIENT ====================
+# Every Bot API call goes through one keep-alive connection pool (telebot
+# would otherwise keep a session per thread) with the configured timeouts.
+# tg_submit/tg_gather run calls on a small thread pool, so fan-outs and
+# channel checks overlap their round trips instead of queueing behind
+# each other.
+TG_CLIENT = {
+    'session': None,
+    'executor': None,
+    'pid': None,
+    'stats': {'calls': 0, 'errors': 0, 'total_ms': 0.0}
+}
+tg_lock = threading.Lock()
+
+def telegram_client():
+    """(session, executor) for this process; sockets and threads aren't shared across a fork"""
+    with tg_lock:
+        if TG_CLIENT['pid'] != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=TG_POOL_SIZE, pool_block=True)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            TG_CLIENT['session'] = session
+            TG_CLIENT['executor'] = ThreadPoolExecutor(max_workers=TG_CONCURRENCY, thread_name_prefix="telegram")
+            TG_CLIENT['pid'] = os.getpid()
+        return TG_CLIENT['session'], TG_CLIENT['executor']
+
+def telegram_request(method, url, **kwargs):
+    """telebot request hook"""
+    started = time.time()
+    failed = False
+    try:
+        return telegram_client()[0].request(method, url, **kwargs)
+    except Exception:
+        failed = True
+        raise
+    finally:
+        with tg_lock:
+            stats = TG_CLIENT['stats']
+            stats['calls'] += 1
+            stats['errors'] += failed
+            stats['total_ms'] += (time.time() - started) * 1000
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = telegram_request
+telebot.apihelper.CONNECT_TIMEOUT = TG_CONNECT_TIMEOUT
+telebot.apihelper.READ_TIMEOUT = TG_READ_TIMEOUT
+
+def tg_submit(fn, *args, **kwargs):
+    """Run a Bot API call in the background; returns a Future"""
+    return telegram_client()[1].submit(fn, *args, **kwargs)
 
-# App Setup
-app = Flask(__name__, static_folder=STATIC_DIR)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+def tg_gather(calls):
+    """Run [(fn, args, kwargs), ...] concurrently; results in order, exceptions returned in place"""
+    futures = [tg_submit(fn, *args, **kwargs) for fn, args, kwargs in calls]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return results
 
-# Initialize Bot
-bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+def telegram_stats():
+    with tg_lock:
+        stats = dict(TG_CLIENT['stats'])
+    stats['avg_ms'] = round(stats.pop('total_ms') / stats['calls'], 2) if stats['calls'] else 0.0
+    stats['pool_size'] = TG_POOL_SIZE
+    stats['concurrency'] = TG_CONCURRENCY
+    return stats
 
-# Ensure Directories
-for d in [DATA_DIR, STATIC_DIR, UPLOAD_FOLDER]:
-    os.makedirs(d, exist_ok=True)
+# ==================== 10. OUTBOUND SCHEDULER ====================
+# Messages to users go through schedule_send instead of straight to
+# bot.send_*. One dispatcher thread hands them to the Telegram client pool
+# while staying under the flood limits: a bot-wide token bucket (SEND_RATE,
+# split between worker processes), a minimum gap between messages to the
+# same chat, and a pause for as long as Telegram says on a 429. Lanes are
+# served in priority order, so payouts and replies overtake a broadcast.
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK = 0, 1, 2
 
-# Initialize default files
-def init_default_files():
-    default_files = {
-        USERS_FILE: {},
-        SETTINGS_FILE: {
-            "bot_name": "CYBER EARN ULTIMATE",
-            "min_withdrawal": 100.0,
-            "welcome_bonus": 50.0,
-            "channels": [],
-            "admins": [],
-            "auto_withdraw": False,
-            "bots_disabled": False,
-            "ignore_device_check": False,
-            "withdraw_disabled": False,
-            "logo_filename": "logo_default.png",
-            "min_refer_reward": 10.0,
-            "max_refer_reward": 50.0,
-            "app_name": "Cyber Earn",
-            "disable_channel_verification": False,
-            "auto_accept_private": False,
-            "hide_verify_button": False
-        },
-        WITHDRAWALS_FILE: [],
-        GIFTS_FILE: [],
-        LEADERBOARD_FILE: {"last_updated": "2000-01-01", "data": []}
+SENDER = {
+    'lanes': [[], [], []],
+    'chat_next': {},
+    'tokens': 0.0,
+    'refilled': 0.0,
+    'hold_until': 0.0,
+    'seq': 0,
+    'inflight': 0,
+    'thread': None,
+    'pid': None,
+    'stats': {'queued': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'flood_waits': 0}
+}
+send_cond = threading.Condition()
+
+def process_send_rate():
+    """This process's share of the bot-wide rate"""
+    if MULTI_PROCESS:
+        return SEND_RATE / max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+    return SEND_RATE
+
+def chat_send_interval(chat_id):
+    return GROUP_SEND_INTERVAL if str(chat_id).startswith('-') else CHAT_SEND_INTERVAL
+
+def ensure_sender():
+    """Start the dispatcher (again after a fork)"""
+    with send_cond:
+        if SENDER['pid'] == os.getpid() and SENDER['thread'].is_alive():
+            return
+        if SENDER['pid'] != os.getpid():
+            SENDER['lanes'] = [[], [], []]
+            SENDER['chat_next'] = {}
+            SENDER['inflight'] = 0
+            SENDER['pid'] = os.getpid()
+        SENDER['thread'] = threading.Thread(target=send_dispatcher, name="sender", daemon=True)
+        SENDER['thread'].start()
+
+def schedule_send(method, chat_id, *args, priority=PRIORITY_NORMAL, **kwargs):
+    """Queue bot.<method>(chat_id, *args, **kwargs); returns a Future with the result"""
+    ensure_sender()
+    job = {
+        'method': method,
+        'chat_id': chat_id,
+        'args': args,
+        'kwargs': kwargs,
+        'priority': priority,
+        'attempts': 0,
+        'future': Future()
     }
+    with send_cond:
+        push_send_job(job, time.time())
+        SENDER['stats']['queued'] += 1
+    return job['future']
+
+def push_send_job(job, not_before):
+    SENDER['seq'] += 1
+    heapq.heappush(SENDER['lanes'][job['priority']], (not_before, SENDER['seq'], job))
+    send_cond.notify_all()
+
+def next_send_job(now):
+    """(job, 0) when one may go now, else (None, seconds to wait or None). Caller holds send_cond."""
+    if not any(SENDER['lanes']):
+        return None, None
+    if now < SENDER['hold_until']:
+        # No tokens build up during a flood wait
+        SENDER['refilled'] = now
+        return None, SENDER['hold_until'] - now
+    rate = process_send_rate()
+    SENDER['tokens'] = min(rate, SENDER['tokens'] + (now - SENDER['refilled']) * rate)
+    SENDER['refilled'] = now
+    if SENDER['tokens'] < 1:
+        return None, (1 - SENDER['tokens']) / rate
     
-    for filepath, default_data in default_files.items():
-        if not os.path.exists(filepath):
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(default_data, f, indent=4, ensure_ascii=False)
-            logger.info(f"Created default file: {filepath}")
+    chat_next = SENDER['chat_next']
+    wait = None
+    for lane in SENDER['lanes']:
+        while lane:
+            not_before, seq, job = lane[0]
+            ready = max(not_before, chat_next.get(job['chat_id'], 0))
+            if ready > now:
+                if ready > not_before:
+                    # Its chat is still cooling down; let the lane move on
+                    heapq.heapreplace(lane, (ready, seq, job))
+                    continue
+                wait = ready - now if wait is None else min(wait, ready - now)
+                break
+            heapq.heappop(lane)
+            SENDER['tokens'] -= 1
+            if len(chat_next) > 10000:
+                SENDER['chat_next'] = chat_next = {c: t for c, t in chat_next.items() if t > now}
+            chat_next[job['chat_id']] = now + chat_send_interval(job['chat_id'])
+            return job, 0
+    return None, wait
 
-init_default_files()
+def send_dispatcher():
+    while True:
+        with send_cond:
+            job, wait = next_send_job(time.time())
+            if job is None:
+                send_cond.wait(wait)
+                continue
+            SENDER['inflight'] += 1
+        try:
+            tg_submit(deliver_send, job)
+        except RuntimeError:
+            # The pool is already shut down at interpreter exit
+            deliver_send(job)
 
-# ==================== 2. DATA MANAGEMENT (CACHED) ====================
-def load_json_cached(filepath, default, cache_key=None):
-    try:
-        with cache_lock:
-            # Use cache if available and recent (5 seconds)
-            if cache_key and CACHE[cache_key] and (time.time() - CACHE['last_update'] < 5):
-                return CACHE[cache_key].copy()  # Return copy to avoid mutation issues
-            
-            if os.path.exists(filepath):
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    if cache_key:
-                        CACHE[cache_key] = data
-                        CACHE['last_update'] = time.time()
-                    return data
-            return default
-    except Exception as e:
-        logger.error(f"Error loading {filepath}: {e}")
-        return default
+def send_retry_delay(job, e):
+    """Seconds until the job should be tried again, or None to give up"""
+    if isinstance(e, ApiTelegramException):
+        if e.error_code == 429:
+            return float((e.result_json or {}).get('parameters', {}).get('retry_after', 1))
+        if e.error_code == 400 and job['kwargs'].get('parse_mode') and "parse entities" in str(e.description):
+            # Markup broken by user-supplied text: better plain than lost
+            job['kwargs'].pop('parse_mode')
+            return 0.0
+        if e.error_code < 500:
+            # Blocked, unknown chat, bad markup: retrying won't help
+            return None
+    if job['attempts'] >= SEND_RETRIES:
+        return None
+    return float(2 ** job['attempts'])
 
-def save_json(filepath, data):
+def deliver_send(job):
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-        
-        # Invalidate cache
-        with cache_lock:
-            if 'settings' in filepath:
-                CACHE['settings'] = None
-            elif 'users' in filepath:
-                CACHE['users'] = None
-            elif 'withdrawals' in filepath:
-                CACHE['withdrawals'] = None
-            elif 'gifts' in filepath:
-                CACHE['gifts'] = None
-            CACHE['last_update'] = time.time()
-        
-        return True
+        result = getattr(bot, job['method'])(job['chat_id'], *job['args'], **job['kwargs'])
     except Exception as e:
-        logger.error(f"Error saving {filepath}: {e}")
-        return False
+        delay = send_retry_delay(job, e)
+        now = time.time()
+        with send_cond:
+            SENDER['inflight'] -= 1
+            if delay is None:
+                SENDER['stats']['failed'] += 1
+                send_cond.notify_all()
+            else:
+                if isinstance(e, ApiTelegramException) and e.error_code == 429:
+                    # Flood wait: everything pauses, not just this chat
+                    SENDER['stats']['flood_waits'] += 1
+                    SENDER['hold_until'] = max(SENDER['hold_until'], now + delay)
+                    SENDER['tokens'] = 0.0
+                else:
+                    job['attempts'] += 1
+                SENDER['stats']['retried'] += 1
+                SENDER['chat_next'][job['chat_id']] = max(SENDER['chat_next'].get(job['chat_id'], 0), now + delay)
+                push_send_job(job, now + delay)
+        if delay is None:
+            logger.error(f"Send Error {job['chat_id']}: {e}")
+            job['future'].set_exception(e)
+        return
+    with send_cond:
+        SENDER['inflight'] -= 1
+        SENDER['stats']['sent'] += 1
+        send_cond.notify_all()
+    job['future'].set_result(result)
 
-def get_settings():
-    with cache_lock:
-        if CACHE['settings'] and (time.time() - CACHE['last_update'] < 5):
-            return CACHE['settings'].copy()
-    
-    defaults = {
-        "bot_name": "CYBER EARN ULTIMATE",
-        "min_withdrawal": 100.0,
-        "welcome_bonus": 50.0,
-        "channels": [],
-        "admins": [],
-        "auto_withdraw": False,
-        "bots_disabled": False,
-        "ignore_device_check": False,
-        "withdraw_disabled": False,
-        "logo_filename": "logo_default.png",
-        "min_refer_reward": 10.0,
-        "max_refer_reward": 50.0,
-        "app_name": "Cyber Earn",
-        "disable_channel_verification": False,
-        "auto_accept_private": False,
-        "hide_verify_button": False
+def drain_sends(timeout=10.0):
+    """Wait a little for queued messages to go out"""
+    deadline = time.time() + timeout
+    if SENDER['pid'] != os.getpid():
+        return
+    with send_cond:
+        while (SENDER['inflight'] or any(SENDER['lanes'])) and time.time() < deadline:
+            send_cond.wait(deadline - time.time())
+
+def sender_stats():
+    with send_cond:
+        stats = dict(SENDER['stats'])
+        stats['pending'] = [len(lane) for lane in SENDER['lanes']]
+        stats['inflight'] = SENDER['inflight']
+        stats['flood_hold_s'] = round(max(0.0, SENDER['hold_until'] - time.time()), 2)
+    stats['rate'] = process_send_rate()
+    return stats
+
+atexit.register(drain_sends)
+
+# ==================== 11. BROADCAST JOBS ====================
+# A broadcast is a row in the broadcasts table: status, a cursor (the last
+# user id handled, users go out in sorted id order) and counters. A runner
+# thread in every process claims running jobs with a lease and feeds them
+# to the scheduler a batch at a time, saving the cursor after each batch,
+# so a restart resumes where it stopped (at most one batch goes out twice).
+# The lease is renewed while a batch waits on the scheduler. Photos are
+# uploaded once; later messages reuse Telegram's file_id.
+BROADCASTS = {
+    'thread': None,
+    'pid': None,
+    'targets': {}
+}
+broadcast_cond = threading.Condition()
+
+def ensure_broadcast_runner(wake=False):
+    """Start the runner (again after a fork); also picks up jobs a restart left running"""
+    with broadcast_cond:
+        t = BROADCASTS['thread']
+        if t is None or not t.is_alive() or BROADCASTS['pid'] != os.getpid():
+            BROADCASTS['pid'] = os.getpid()
+            BROADCASTS['targets'] = {}
+            BROADCASTS['thread'] = threading.Thread(target=broadcast_loop, name="broadcasts", daemon=True)
+            BROADCASTS['thread'].start()
+        if wake:
+            broadcast_cond.notify_all()
+
+def create_broadcast(text, image=None):
+    """Queue a broadcast to every user; image is a saved upload the job takes over"""
+    users = load_json_cached(USERS_FILE, {}, 'users')
+    data = {
+        'text': text,
+        'image': image,
+        'file_id': None,
+        'total': len(users),
+        'sent': 0,
+        'failed': 0,
+        'blocked': 0,
+        'created_at': datetime.now().isoformat(),
+        'finished_at': None
     }
-    current = load_json_cached(SETTINGS_FILE, defaults, 'settings')
-    for k, v in defaults.items():
-        if k not in current:
-            current[k] = v
-    with cache_lock:
-        CACHE['settings'] = current
-    return current.copy()
+    conn = get_db()
+    with conn:
+        job_id = conn.execute(
+            "INSERT INTO broadcasts (status, data) VALUES ('running', ?)", (dump_row(data),)
+        ).lastrowid
+    ensure_broadcast_runner(wake=True)
+    return job_id, data['total']
 
-def is_admin(user_id):
-    s = get_settings()
-    uid = str(user_id)
-    return uid == str(ADMIN_ID) or uid in s.get('admins', [])
+def broadcast_progress(row):
+    job_id, status, cursor, data = row
+    data = json.loads(data)
+    done = data['sent'] + data['failed'] + data['blocked']
+    return {
+        'id': job_id,
+        'status': status,
+        'photo': bool(data['image'] or data['file_id']),
+        'total': data['total'],
+        'sent': data['sent'],
+        'failed': data['failed'],
+        'blocked': data['blocked'],
+        'remaining': 0 if status in ('done', 'cancelled', 'failed') else max(0, data['total'] - done),
+        'error': data.get('error'),
+        'created_at': data['created_at'],
+        'finished_at': data['finished_at']
+    }
 
-# ==================== 3. UTILS ====================
-def safe_send_message(chat_id, text, reply_markup=None):
-    try:
-        bot.send_message(chat_id, text, parse_mode="Markdown", reply_markup=reply_markup)
-    except Exception as e:
-        logger.error(f"Send Error {chat_id}: {e}")
+def get_broadcast(job_id):
+    row = get_db().execute("SELECT id, status, cursor, data FROM broadcasts WHERE id = ?", (job_id,)).fetchone()
+    return broadcast_progress(row) if row else None
+
+def list_broadcasts(limit=20):
+    rows = get_db().execute("SELECT id, status, cursor, data FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [broadcast_progress(row) for row in rows]
+
+def set_broadcast_status(job_id, action):
+    """pause / resume / cancel; False if the job isn't in a state that allows it"""
+    allowed = {
+        'pause': ('paused', ('running',)),
+        'resume': ('running', ('paused',)),
+        'cancel': ('cancelled', ('running', 'paused'))
+    }
+    status, from_states = allowed[action]
+    conn = get_db()
+    with conn:
+        changed = conn.execute(
+            f"UPDATE broadcasts SET status = ? WHERE id = ? AND status IN ({','.join('?' * len(from_states))})",
+            (status, job_id) + from_states
+        ).rowcount
+        row = conn.execute("SELECT data FROM broadcasts WHERE id = ?", (job_id,)).fetchone()
+    if changed and status == 'cancelled':
+        # A runner mid-batch may still hold the file; it's only needed to upload once
+        image = json.loads(row[0])['image']
+        if image and os.path.exists(image):
+            os.remove(image)
+    if changed and status == 'running':
+        ensure_broadcast_runner(wake=True)
+    return bool(changed)
+
+def claim_broadcast():
+    """Id of a running job this process now holds the lease on, or None"""
+    now = time.time()
+    conn = get_db()
+    with conn:
+        row = conn.execute(
+            "SELECT id FROM broadcasts WHERE status = 'running' AND (owner IS NULL OR owner = ? OR lease < ?) ORDER BY id LIMIT 1",
+            (os.getpid(), now)
+        ).fetchone()
+        if row is None:
+            return None
+        claimed = conn.execute(
+            "UPDATE broadcasts SET owner = ?, lease = ? WHERE id = ? AND status = 'running' AND (owner IS NULL OR owner = ? OR lease < ?)",
+            (os.getpid(), now + BROADCAST_LEASE, row[0], os.getpid(), now)
+        ).rowcount
+    return row[0] if claimed else None
+
+def broadcast_loop():
+    while True:
+        try:
+            job_id = claim_broadcast()
+            if job_id is not None:
+                run_broadcast_batch(job_id)
+                continue
+        except Exception as e:
+            logger.error(f"Broadcast runner error: {e}")
+        with broadcast_cond:
+            broadcast_cond.wait(5.0)
+
+def renew_broadcast_lease(job_id):
+    """Extend our lease; False if another process has taken the job over"""
+    conn = get_db()
+    with conn:
+        return conn.execute(
+            "UPDATE broadcasts SET lease = ? WHERE id = ? AND owner = ?",
+            (time.time() + BROADCAST_LEASE, job_id, os.getpid())
+        ).rowcount > 0
+
+def wait_renewing(job_id, futures):
+    """Wait for a batch, renewing the lease meanwhile: a flood wait can hold
+    the scheduler longer than BROADCAST_LEASE"""
+    pending = futures
+    while pending:
+        _, pending = wait(pending, timeout=BROADCAST_LEASE / 3)
+        if pending and not renew_broadcast_lease(job_id):
+            logger.warning(f"Broadcast {job_id}: lease lost mid-batch")
+
+def fail_broadcast(job_id, data, reason):
+    data['error'] = reason
+    data['finished_at'] = datetime.now().isoformat()
+    BROADCASTS['targets'].pop(job_id, None)
+    conn = get_db()
+    with conn:
+        conn.execute(
+            "UPDATE broadcasts SET data = ?, status = CASE WHEN status = 'running' THEN 'failed' ELSE status END WHERE id = ? AND owner = ?",
+            (dump_row(data), job_id, os.getpid())
+        )
+    logger.error(f"Broadcast {job_id} failed: {reason}")
+
+def broadcast_outcome(future):
+    e = future.exception()
+    if e is None:
+        return 'sent'
+    if isinstance(e, ApiTelegramException) and e.error_code == 403:
+        return 'blocked'
+    return 'failed'
+
+def run_broadcast_batch(job_id):
+    conn = get_db()
+    status, cursor, data = conn.execute("SELECT status, cursor, data FROM broadcasts WHERE id = ?", (job_id,)).fetchone()
+    data = json.loads(data)
+    targets = BROADCASTS['targets'].get(job_id)
+    if targets is None:
+        targets = BROADCASTS['targets'][job_id] = sorted(str(uid) for uid in load_json_cached(USERS_FILE, {}, 'users'))
+    batch = targets[bisect.bisect_right(targets, cursor):][:BROADCAST_BATCH]
+    
+    outcomes = []
+    if data['image'] and not data['file_id']:
+        # Upload to one user at a time until Telegram hands back a file_id
+        try:
+            with open(data['image'], 'rb') as img:
+                idata = img.read()
+        except OSError as e:
+            # Gone with a redeploy's disk, or removed by a cancel
+            fail_broadcast(job_id, data, f"Photo unavailable: {e}")
+            return
+        while batch and not data['file_id']:
+            uid = batch.pop(0)
+            future = schedule_send('send_photo', uid, idata, caption=data['text'], priority=PRIORITY_BULK)
+            wait_renewing(job_id, [future])
+            outcomes.append(broadcast_outcome(future))
+            if future.exception() is None:
+                data['file_id'] = future.result().photo[-1].file_id
+            cursor = uid
+    if data['file_id']:
+        futures = [schedule_send('send_photo', uid, data['file_id'], caption=data['text'], priority=PRIORITY_BULK) for uid in batch]
+    else:
+        futures = [schedule_send('send_message', uid, data['text'], priority=PRIORITY_BULK) for uid in batch]
+    wait_renewing(job_id, futures)
+    outcomes += [broadcast_outcome(f) for f in futures]
+    for outcome in outcomes:
+        data[outcome] += 1
+    if batch:
+        cursor = batch[-1]
+    
+    finished = not outcomes
+    if finished:
+        data['finished_at'] = datetime.now().isoformat()
+        BROADCASTS['targets'].pop(job_id, None)
+    if (finished or data['file_id']) and data['image']:
+        if os.path.exists(data['image']):
+            os.remove(data['image'])
+        data['image'] = None
+    with conn:
+        # Counters are saved even if the job was paused meanwhile; only a
+        # finished job that's still running flips to done
+        conn.execute(
+            "UPDATE broadcasts SET cursor = ?, lease = ?, data = ?, status = CASE WHEN ? AND status = 'running' THEN 'done' ELSE status END WHERE id = ? AND owner = ?",
+            (cursor, time.time() + BROADCAST_LEASE, dump_row(data), finished, job_id, os.getpid())
+        )
+    if finished:
+        logger.info(f"Broadcast {job_id} done: {data['sent']} sent, {data['blocked']} blocked, {data['failed']} failed")
+
+def release_broadcasts():
+    """Hand this process's jobs back on shutdown so another worker resumes them right away"""
+    if BROADCASTS['pid'] != os.getpid():
+        return
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE broadcasts SET owner = NULL WHERE owner = ?", (os.getpid(),))
+
+def broadcast_stats():
+    counts = dict(get_db().execute("SELECT status, COUNT(*) FROM broadcasts GROUP BY status").fetchall())
+    return {status: counts.get(status, 0) for status in ('running', 'paused', 'done', 'cancelled', 'failed')}
+
+atexit.register(release_broadcasts)
+
+# ==================== 12. ADMIN DIGESTS ====================
+# Admin notifications are buffered and go out as one digest per admin every
+# ADMIN_DIGEST_INTERVAL seconds, or sooner once ADMIN_DIGEST_MAX events are
+# waiting. Kinds in ADMIN_NOTIFY_IMMEDIATE skip the buffer. Either way the
+# sending happens on the scheduler, never inside a request. The buffer is
+# the admin_digest table, shared by every worker process, and the
+# admin_digest task sends it, so there is one digest however many workers run.
+DIGEST = {
+    'stats': {'events': 0, 'immediate': 0, 'digests': 0}
+}
+digest_lock = threading.Lock()
+
+DIGEST_LABELS = {'new_user': "New users", 'withdraw': "Withdrawals", 'contact': "Messages"}
+# Longest entry kept in a digest; a message is at most 4096 characters
+DIGEST_ENTRY_MAX = 3500
+
+def admin_event(kind, text):
+    """Tell the admins about something; buffered unless kind is configured as immediate"""
+    if kind in ADMIN_NOTIFY_IMMEDIATE:
+        with digest_lock:
+            DIGEST['stats']['immediate'] += 1
+        notify_admins(text, reply_markup=admin_panel_markup(), priority=PRIORITY_HIGH)
+        return
+    conn = get_db()
+    with conn:
+        conn.execute(
+            "INSERT INTO admin_digest (at, kind, text) VALUES (?, ?, ?)",
+            (datetime.now().strftime('%H:%M'), kind, text)
+        )
+        pending = conn.execute("SELECT COUNT(*) FROM admin_digest").fetchone()[0]
+    with digest_lock:
+        DIGEST['stats']['events'] += 1
+    if pending % ADMIN_DIGEST_MAX == 0:
+        tg_submit(run_task, 'admin_digest', True)
+
+def admin_panel_markup():
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton("Open Admin Panel", url=f"{BASE_URL}/admin_panel?user_id={ADMIN_ID}"))
+    return markup
+
+def digest_entry(at, text):
+    if len(text) > DIGEST_ENTRY_MAX:
+        # A cut escape sequence would break the Markdown
+        text = text[:DIGEST_ENTRY_MAX].rstrip('\\') + "…"
+    return f"\n\n`{at}` {text}"
+
+def flush_admin_digest():
+    """Send whatever is buffered as one digest (split to fit Telegram's message
+    size); returns the number of events sent (admin_digest task)"""
+    conn = get_db()
+    with conn:
+        # Taking the rows and deleting them is one statement, so two workers
+        # flushing at once can't both send an event
+        events = sorted(conn.execute("DELETE FROM admin_digest RETURNING id, at, kind, text").fetchall())
+    if not events:
+        return 0
+    with digest_lock:
+        DIGEST['stats']['digests'] += 1
+    
+    counts = {}
+    for _, _, kind, _ in events:
+        counts[kind] = counts.get(kind, 0) + 1
+    summary = ", ".join(f"{DIGEST_LABELS.get(kind, kind)}: {n}" for kind, n in counts.items())
+    chunks = [f"📋 *Admin Digest* ({len(events)} events)\n{summary}"]
+    for _, at, _, text in events:
+        entry = digest_entry(at, text)
+        if len(chunks[-1]) + len(entry) > 4000:
+            chunks.append(entry.lstrip())
+        else:
+            chunks[-1] += entry
+    for chunk in chunks:
+        notify_admins(chunk, reply_markup=admin_panel_markup())
+    return len(events)
+
+def digest_stats():
+    with digest_lock:
+        stats = dict(DIGEST['stats'])
+    stats['pending'] = get_db().execute("SELECT COUNT(*) FROM admin_digest").fetchone()[0]
+    stats['immediate_kinds'] = sorted(ADMIN_NOTIFY_IMMEDIATE)
+    return stats
+
+atexit.register(flush_admin_digest)
+
+# ==================== 13. UTILS ====================
+def safe_send_message(chat_id, text, reply_markup=None, priority=PRIORITY_NORMAL):
+    """Queue a Markdown message; failures are logged by the scheduler"""
+    return schedule_send('send_message', chat_id, text, parse_mode="Markdown", reply_markup=reply_markup, priority=priority)
+
+def admin_ids(settings=None):
+    """Main admin plus the configured admins, without repeats"""
+    settings = settings or get_settings()
+    return list(dict.fromkeys([str(ADMIN_ID)] + [str(a) for a in settings.get('admins', [])]))
+
+def notify_admins(text, reply_markup=None, settings=None, priority=PRIORITY_NORMAL):
+    """safe_send_message to every admin"""
+    return [safe_send_message(adm, text, reply_markup=reply_markup, priority=priority) for adm in admin_ids(settings)]
 
 def get_user_full_name(user):
     name_parts = []
@@ -215,9 +2596,18 @@ def generate_device_fingerprint(ip, user_agent, other_data=""):
     data = f"{ip}|{user_agent}|{other_data}"
     return hashlib.md5(data.encode()).hexdigest()
 
+# Users cache version the leaderboard was last built from
+LEADERBOARD_SOURCE = {'version': None}
+
 def update_leaderboard():
     try:
+        # Nothing to recompute while the users store hasn't changed
+        current = load_json_cached(LEADERBOARD_FILE, None, 'leaderboard')
+        if current and LEADERBOARD_SOURCE['version'] == cache_version('users'):
+            return current
+        
         users = load_json_cached(USERS_FILE, {}, 'users')
+        users_version = cache_version('users')
         leaderboard = []
         for uid, user_data in users.items():
             leaderboard.append({
@@ -231,40 +2621,42 @@ def update_leaderboard():
         
         data = {"last_updated": datetime.now().isoformat(), "data": leaderboard}
         save_json(LEADERBOARD_FILE, data)
-        with cache_lock:
-            CACHE['leaderboard'] = data
+        LEADERBOARD_SOURCE['version'] = users_version
         return data
     except Exception as e:
         logger.error(f"Error updating leaderboard: {e}")
         return {"last_updated": datetime.now().isoformat(), "data": []}
 
-def check_gift_code_expiry():
-    gifts = load_json_cached(GIFTS_FILE, [], 'gifts')
-    updated = False
-    current_time = datetime.now()
+def gift_expired(gift, current_time=None):
+    """Past its expiry time or used up (cheap, for one code at a time)"""
+    if gift.get('expired', False):
+        return True
     
-    for gift in gifts[:]:
-        # Check expiry time
-        if "expiry" in gift:
-            try:
-                expiry_time = datetime.fromisoformat(gift["expiry"])
-                if expiry_time < current_time:
-                    gift["expired"] = True
-                    updated = True
-            except:
-                pass
-        
-        # Check if usage limit reached
-        if not gift.get('expired') and 'used_by' in gift and 'total_uses' in gift:
-            if len(gift['used_by']) >= gift['total_uses']:
-                gift["expired"] = True
-                updated = True
+    # Check expiry time
+    if "expiry" in gift:
+        try:
+            if datetime.fromisoformat(gift["expiry"]) < (current_time or datetime.now()):
+                return True
+        except:
+            pass
     
-    if updated:
-        save_json(GIFTS_FILE, gifts)
-    return gifts
+    # Check if usage limit reached
+    if 'used_by' in gift and 'total_uses' in gift:
+        if len(gift['used_by']) >= gift['total_uses']:
+            return True
+    return False
+
+def expire_gifts():
+    """Store the expired flag on gifts that ran out (periodic task)"""
+    current_time = datetime.now()
+    count = 0
+    for gift in load_json_cached(GIFTS_FILE, [], 'gifts'):
+        if not gift.get('expired') and gift_expired(gift, current_time):
+            if update_gift(gift['code'], lambda g: dict(g, expired=True) if g else None):
+                count += 1
+    return count
 
-def get_user_status(user_data, settings):
+def get_user_status(user_data, settings, uid=None):
     """Determine user status based on verification requirements"""
     if user_data.get('verified', False):
         # User is verified if they meet current requirements
@@ -274,18 +2666,22 @@ def get_user_status(user_data, settings):
         # Check channels if not disabled
         channels_ok = True
         if settings['channels'] and not settings.get('disable_channel_verification', False):
-            # Check if user has passed channel verification
-            last_check = user_data.get('last_channel_check')
-            if last_check:
-                try:
-                    last_check_time = datetime.fromisoformat(last_check)
-                    # Consider channel check valid for 5 minutes
-                    if (datetime.now() - last_check_time).total_seconds() > 300:
+            # What the membership cache knows wins (leaving a channel shows up
+            # here); otherwise the last passed check counts for MEMBERSHIP_TTL
+            known = [cached_membership(cid, uid) for cid in required_channels(settings)] if uid else []
+            if False in known:
+                channels_ok = False
+            elif not known or None in known:
+                last_check = user_data.get('last_channel_check')
+                if last_check:
+                    try:
+                        last_check_time = datetime.fromisoformat(last_check)
+                        if (datetime.now() - last_check_time).total_seconds() > MEMBERSHIP_TTL:
+                            channels_ok = False
+                    except:
                         channels_ok = False
-                except:
+                else:
                     channels_ok = False
-            else:
-                channels_ok = False
         
         return "verified" if device_ok and channels_ok else "pending"
     else:
@@ -300,19 +2696,458 @@ def datetime_from_isoformat(value):
 
 app.jinja_env.filters['fromisoformat'] = datetime_from_isoformat
 
-# ==================== 4. PRIVATE CHANNEL HANDLER ====================
+# ==================== 14. PERIODIC TASKS ====================
+# Maintenance that used to run inside requests runs here instead. One
+# scheduler thread per process checks the tasks every second; a task's
+# byte-range lock makes sure only one process runs it at a time, and its
+# run history in the meta table (key 'task:<name>') tells the others it
+# isn't due yet. History keeps the last TASK_HISTORY runs with duration.
+TASK_HISTORY = 20
+TASKS = {}
+TASK_RUNNER = {'thread': None, 'pid': None}
+tasks_lock = threading.Lock()
+
+def register_task(name, interval, fn):
+    TASKS[name] = {
+        'fn': fn,
+        'interval': interval,
+        'offset': LOCK_OFFSETS['tasks'] + len(TASKS),
+        'next_due': 0.0,
+        'lock': threading.Lock()
+    }
+
+def ensure_task_runner():
+    with tasks_lock:
+        t = TASK_RUNNER['thread']
+        if t is None or not t.is_alive() or TASK_RUNNER['pid'] != os.getpid():
+            TASK_RUNNER['pid'] = os.getpid()
+            TASK_RUNNER['thread'] = threading.Thread(target=task_loop, name="tasks", daemon=True)
+            TASK_RUNNER['thread'].start()
+
+def task_loop():
+    while True:
+        now = time.time()
+        for name, task in TASKS.items():
+            if task['next_due'] <= now:
+                run_task(name)
+        time.sleep(1.0)
+
+def task_history(name):
+    row = get_db().execute("SELECT value FROM meta WHERE key = ?", (f"task:{name}",)).fetchone()
+    return json.loads(row[0]) if row else {'runs': 0, 'errors': 0, 'history': []}
+
+def task_due(task, history):
+    """When a task should next run: an interval after a successful run,
+    TASK_RETRY_DELAY after a failed one"""
+    if history and not history[-1]['ok']:
+        return history[-1]['at'] + min(TASK_RETRY_DELAY, task['interval'])
+    return (history[-1]['at'] if history else 0) + task['interval']
+
+def run_task(name, force=False):
+    """Run a task if it's due and no other process is running it; returns its
+    history entry or None. force runs it regardless, after any run in progress."""
+    task = TASKS[name]
+    if not task['lock'].acquire(blocking=force):
+        return None
+    if MULTI_PROCESS and not range_lock(task['offset'], timeout=-1 if force else 0):
+        task['lock'].release()
+        task['next_due'] = time.time() + 1
+        return None
+    try:
+        info = task_history(name)
+        due = task_due(task, info['history'])
+        if not force and time.time() < due:
+            task['next_due'] = due
+            return None
+        
+        started = time.time()
+        try:
+            result = task['fn']()
+            entry = {'at': started, 'ms': 0.0, 'ok': True, 'result': result if isinstance(result, (int, float, str)) else None}
+        except Exception as e:
+            logger.error(f"Task {name} error: {e}")
+            entry = {'at': started, 'ms': 0.0, 'ok': False, 'result': str(e)}
+            info['errors'] += 1
+        entry['ms'] = round((time.time() - started) * 1000, 2)
+        entry['pid'] = os.getpid()
+        info['runs'] += 1
+        info['history'] = (info['history'] + [entry])[-TASK_HISTORY:]
+        conn = get_db()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"task:{name}", dump_row(info)))
+        task['next_due'] = task_due(task, info['history'])
+        return entry
+    finally:
+        if MULTI_PROCESS:
+            range_unlock(task['offset'])
+        task['lock'].release()
+
+def task_stats():
+    stats = {}
+    for name, task in TASKS.items():
+        info = task_history(name)
+        last = info['history'][-1] if info['history'] else None
+        stats[name] = {
+            'interval': task['interval'],
+            'runs': info['runs'],
+            'errors': info['errors'],
+            'last_run': datetime.fromtimestamp(last['at']).isoformat() if last else None,
+            'last_ms': last['ms'] if last else None,
+            'avg_ms': round(sum(h['ms'] for h in info['history']) / len(info['history']), 2) if info['history'] else None,
+            'history': info['history'][-5:]
+        }
+    return stats
+
+register_task('gift_expiry', GIFT_EXPIRY_INTERVAL, expire_gifts)
+register_task('leaderboard', LEADERBOARD_INTERVAL, lambda: len(update_leaderboard()['data']))
+register_task('ledger_compaction', LEDGER_COMPACT_INTERVAL, lambda: compact_ledger(raise_errors=True))
+register_task('snapshot', SNAPSHOT_INTERVAL, run_snapshot)
+register_task('admin_digest', ADMIN_DIGEST_INTERVAL, flush_admin_digest)
+
+# ==================== 15. BOT METADATA ====================
+# Facts that almost never change (the bot's id and username, each channel's
+# chat info and whether the bot is admin there) are fetched at boot and by
+# the bot_metadata task, stored in the meta table and served from the cache.
+# Hot paths read them from memory and never wait on Telegram for them;
+# my_chat_member updates keep bot_status current between refreshes.
+bot_meta_lock = threading.Lock()
+# A get_me on first use that nobody waits for (the lock is not held across it)
+BOT_IDENTITY = {'fetching': False, 'retry_at': 0.0}
+BOT_IDENTITY_RETRY = 30
+
+def refresh_bot_metadata():
+    """Fetch everything in one concurrent round and store it (periodic task)"""
+    me = bot.get_me()
+    channel_ids = [str(ch['id']) for ch in get_settings().get('channels', []) if ch.get('id')]
+    results = tg_gather(
+        [(bot.get_chat, (cid,), {}) for cid in channel_ids] +
+        [(bot.get_chat_member, (cid, me.id), {}) for cid in channel_ids]
+    )
+    chats, members = results[:len(channel_ids)], results[len(channel_ids):]
+    
+    channels = {}
+    for cid, chat, member in zip(channel_ids, chats, members):
+        info = {'title': None, 'type': None, 'username': None, 'bot_status': None}
+        if not isinstance(chat, Exception):
+            info.update(title=chat.title, type=chat.type, username=chat.username)
+        if not isinstance(member, Exception):
+            info['bot_status'] = member.status
+        channels[cid] = info
+    
+    with bot_meta_lock:
+        store_bot_metadata({
+            'bot': {'id': me.id, 'username': me.username, 'first_name': me.first_name},
+            'channels': channels,
+            'refreshed': datetime.now().isoformat()
+        })
+    return len(channels)
+
+def read_bot_metadata():
+    row = get_db().execute("SELECT value FROM meta WHERE key = 'bot_metadata'").fetchone()
+    return json.loads(row[0]) if row else {'bot': None, 'channels': {}, 'refreshed': None}
+
+def store_bot_metadata(data):
+    conn = get_db()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('bot_metadata', ?)", (dump_row(data),))
+    bump_generation('db')
+    invalidate_cache('bot_meta')
+
+def bot_metadata():
+    return cached_load('bot_meta', store_stamp(DB_FILE, 'db'), read_bot_metadata)
+
+def fallback_identity():
+    # The id is the token's prefix; the username is only a placeholder
+    prefix = BOT_TOKEN.split(':', 1)[0]
+    return {'id': int(prefix) if prefix.isdigit() else None, 'username': "telegram_bot", 'first_name': None}
+
+def bot_identity():
+    """{'id', 'username', 'first_name'}; asks Telegram if no refresh has
+    succeeded yet. Meanwhile, while another thread is asking and for
+    BOT_IDENTITY_RETRY seconds after a failure, a fallback is returned."""
+    me = bot_metadata()['bot']
+    if me:
+        return me
+    with bot_meta_lock:
+        if BOT_IDENTITY['fetching'] or time.time() < BOT_IDENTITY['retry_at']:
+            return fallback_identity()
+        BOT_IDENTITY['fetching'] = True
+    try:
+        me = bot.get_me()
+        identity = {'id': me.id, 'username': me.username, 'first_name': me.first_name}
+    except Exception as e:
+        logger.error(f"Error fetching bot identity: {e}")
+        identity = None
+    with bot_meta_lock:
+        BOT_IDENTITY['fetching'] = False
+        if identity is None:
+            BOT_IDENTITY['retry_at'] = time.time() + BOT_IDENTITY_RETRY
+            return fallback_identity()
+        data = read_bot_metadata()
+        if not data['bot']:
+            data['bot'] = identity
+            store_bot_metadata(data)
+        return data['bot']
+
+def bot_username():
+    return bot_identity()['username']
+
+def bot_id():
+    return bot_identity()['id']
+
+def channel_info(channel_id):
+    """Stored chat info and bot_status for a channel, None if not fetched yet"""
+    return bot_metadata()['channels'].get(str(channel_id))
+
+def update_channel_info(chat, bot_status):
+    """Record the bot's status in a chat (my_chat_member updates, live re-checks)"""
+    with bot_meta_lock:
+        data = read_bot_metadata()
+        info = data['channels'].setdefault(str(chat.id), {'title': None, 'type': None, 'username': None, 'bot_status': None})
+        info.update(title=chat.title, type=chat.type, username=chat.username, bot_status=bot_status)
+        store_bot_metadata(data)
+    return info
+
+@bot.my_chat_member_handler()
+def track_bot_status(update):
+    if update.chat.type != 'private':
+        update_channel_info(update.chat, update.new_chat_member.status)
+
+def refresh_bot_metadata_soon():
+    """Refresh in the background, e.g. after the channel list changed"""
+    tg_submit(run_task, 'bot_metadata', True)
+
+register_task('bot_metadata', BOT_METADATA_INTERVAL, refresh_bot_metadata)
+
+# ==================== 16. PROFILE PHOTOS ====================
+# /get_pfp serves thumbnails from PFP_DIR (<uid>-<file_unique_id>.jpg).
+# Telegram already keeps a few sizes of every photo, so the thumbnail is
+# the smallest one at least PFP_SIZE wide, nothing is resized here. An
+# in-memory LRU index (rebuilt from the directory at startup) keeps the
+# total under PFP_CACHE_MB; entries older than PFP_TTL are fetched again,
+# falling back to the old file if Telegram fails. Concurrent misses for a
+# uid share one upstream fetch. Users without a photo are remembered for
+# PFP_MISSING_TTL.
+PFP_MISSING_TTL = 3600
+PFP_MAX_AGE = 3600      # browser cache, revalidated with the ETag afterwards
+PFP = {
+    'index': OrderedDict(),     # uid -> {'path', 'etag', 'size', 'fetched'}; path None = no photo
+    'bytes': 0,
+    'loaded': False,
+    'inflight': {},
+    'stats': {'hits': 0, 'misses': 0, 'fetches': 0, 'evictions': 0, 'errors': 0}
+}
+pfp_lock = threading.Lock()
+
+def load_pfp_index():
+    """Rebuild the index from disk, oldest first (caller holds pfp_lock)"""
+    files = []
+    for name in os.listdir(PFP_DIR):
+        uid, _, rest = name.partition('-')
+        if not rest.endswith('.jpg'):
+            continue
+        path = os.path.join(PFP_DIR, name)
+        st = os.stat(path)
+        files.append((st.st_mtime, uid, {'path': path, 'etag': rest[:-4], 'size': st.st_size, 'fetched': st.st_mtime}))
+    for _, uid, entry in sorted(files):
+        PFP['index'][uid] = entry
+        PFP['bytes'] += entry['size']
+    PFP['loaded'] = True
+
+def pfp_forget(uid, remove_file=True):
+    """Drop a uid from the index (caller holds pfp_lock)"""
+    entry = PFP['index'].pop(uid, None)
+    if entry and entry['path']:
+        PFP['bytes'] -= entry['size']
+        if remove_file:
+            try:
+                os.remove(entry['path'])
+            except OSError:
+                pass
+
+def pfp_store(uid, entry):
+    """Index a fetched photo and evict least recently used ones over budget (caller holds pfp_lock)"""
+    old = PFP['index'].get(uid)
+    pfp_forget(uid, remove_file=bool(old and old['path'] != entry['path']))
+    PFP['index'][uid] = entry
+    PFP['bytes'] += entry['size']
+    while PFP['bytes'] > PFP_CACHE_MB * 1024 * 1024 and len(PFP['index']) > 1:
+        pfp_forget(next(iter(PFP['index'])))
+        PFP['stats']['evictions'] += 1
+
+def fetch_profile_photo(uid):
+    """Download the user's current thumbnail into PFP_DIR; index entry (path None if they have no photo)"""
+    photos = bot.get_user_profile_photos(uid, limit=1)
+    if not photos.total_count:
+        return {'path': None, 'etag': None, 'size': 0, 'fetched': time.time()}
+    sizes = sorted(photos.photos[0], key=lambda p: p.width)
+    thumb = next((p for p in sizes if p.width >= PFP_SIZE), sizes[-1])
+    path = os.path.join(PFP_DIR, f"{uid}-{thumb.file_unique_id}.jpg")
+    
+    # Same photo as last time: nothing to download
+    if not os.path.exists(path):
+        file_info = bot.get_file(thumb.file_id)
+        dl_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with telegram_client()[0].get(dl_url, stream=True, timeout=(TG_CONNECT_TIMEOUT, TG_READ_TIMEOUT)) as r:
+            r.raise_for_status()
+            with open(tmp, 'wb') as f:
+                for chunk in r.iter_content(64 * 1024):
+                    f.write(chunk)
+        os.replace(tmp, path)
+    else:
+        os.utime(path)
+    return {'path': path, 'etag': thumb.file_unique_id, 'size': os.path.getsize(path), 'fetched': time.time()}
+
+def get_profile_photo(uid):
+    """(path, etag) of the user's thumbnail, or None if they have none"""
+    with pfp_lock:
+        if not PFP['loaded']:
+            load_pfp_index()
+        entry = PFP['index'].get(uid)
+        ttl = PFP_MISSING_TTL if entry and entry['path'] is None else PFP_TTL
+        if entry and time.time() - entry['fetched'] < ttl and (entry['path'] is None or os.path.exists(entry['path'])):
+            PFP['index'].move_to_end(uid)
+            PFP['stats']['hits'] += 1
+            return (entry['path'], entry['etag']) if entry['path'] else None
+        
+        PFP['stats']['misses'] += 1
+        flight = PFP['inflight'].get(uid)
+        leader = flight is None
+        if leader:
+            flight = PFP['inflight'][uid] = threading.Event()
+    
+    if not leader:
+        # Someone is already fetching this uid
+        flight.wait(TG_CONNECT_TIMEOUT + TG_READ_TIMEOUT)
+        with pfp_lock:
+            entry = PFP['index'].get(uid)
+        return (entry['path'], entry['etag']) if entry and entry['path'] else None
+    
+    try:
+        fresh = fetch_profile_photo(uid)
+        with pfp_lock:
+            PFP['stats']['fetches'] += 1
+            pfp_store(uid, fresh)
+        entry = fresh
+    except Exception as e:
+        logger.error(f"PFP error: {e}")
+        with pfp_lock:
+            PFP['stats']['errors'] += 1
+            # Keep serving what we had until a refresh works
+            entry = PFP['index'].get(uid)
+            if entry and entry['path'] and not os.path.exists(entry['path']):
+                pfp_forget(uid, remove_file=False)
+                entry = None
+    finally:
+        with pfp_lock:
+            PFP['inflight'].pop(uid, None)
+        flight.set()
+    return (entry['path'], entry['etag']) if entry and entry['path'] else None
+
+def pfp_stats():
+    with pfp_lock:
+        stats = dict(PFP['stats'])
+        stats['entries'] = len(PFP['index'])
+        stats['mb'] = round(PFP['bytes'] / 1024 / 1024, 2)
+    return stats
+
+# ==================== 17. CHANNEL MEMBERSHIP ====================
+# get_chat_member answers are cached per (channel_id, user_id): members for
+# MEMBERSHIP_TTL, non-members only MEMBERSHIP_NEGATIVE_TTL so someone who just
+# joined isn't kept waiting. chat_member updates (sent for channels where
+# the bot is admin) overwrite entries as people join and leave; they reach
+# one worker, the others catch up when their entry expires. Misses for
+# several channels are asked concurrently.
+MEMBER_STATUSES = ('member', 'administrator', 'creator', 'restricted')
+MEMBERSHIP = {
+    'entries': {},
+    'stats': {'hits': 0, 'misses': 0, 'updates': 0}
+}
+membership_lock = threading.Lock()
+
+def remember_membership(channel_id, user_id, is_member):
+    ttl = MEMBERSHIP_TTL if is_member else MEMBERSHIP_NEGATIVE_TTL
+    now = time.time()
+    with membership_lock:
+        entries = MEMBERSHIP['entries']
+        if len(entries) > 50000:
+            MEMBERSHIP['entries'] = entries = {k: v for k, v in entries.items() if v[1] > now}
+        entries[(str(channel_id), str(user_id))] = (is_member, now + ttl)
+
+def cached_membership(channel_id, user_id):
+    """True/False from the cache, None if unknown or expired (never calls Telegram)"""
+    with membership_lock:
+        entry = MEMBERSHIP['entries'].get((str(channel_id), str(user_id)))
+    if entry is None or entry[1] < time.time():
+        return None
+    return entry[0]
+
+def check_memberships(user_id, channel_ids):
+    """{channel_id: is_member}; whatever isn't cached is fetched in one concurrent round"""
+    result = {}
+    misses = []
+    for channel_id in channel_ids:
+        cached = cached_membership(channel_id, user_id)
+        if cached is None:
+            misses.append(channel_id)
+        else:
+            result[channel_id] = cached
+    with membership_lock:
+        MEMBERSHIP['stats']['hits'] += len(result)
+        MEMBERSHIP['stats']['misses'] += len(misses)
+    
+    members = tg_gather([(bot.get_chat_member, (channel_id, user_id), {}) for channel_id in misses])
+    for channel_id, member in zip(misses, members):
+        if isinstance(member, ApiTelegramException):
+            # Telegram's answer (user not found, bot not in chat): not a member
+            result[channel_id] = False
+            remember_membership(channel_id, user_id, False)
+        elif isinstance(member, Exception):
+            # Network trouble says nothing about membership, don't cache it
+            result[channel_id] = False
+        else:
+            result[channel_id] = member.status in MEMBER_STATUSES
+            remember_membership(channel_id, user_id, result[channel_id])
+    return result
+
+def required_channels(settings):
+    """Ids of the channels a user must be in ([] when checks are off)"""
+    if settings.get('disable_channel_verification', False):
+        return []
+    return [ch['id'] for ch in settings.get('channels', []) if ch.get('id') and not ch.get('disabled', False)]
+
+@bot.chat_member_handler()
+def track_membership(update):
+    remember_membership(update.chat.id, update.new_chat_member.user.id, update.new_chat_member.status in MEMBER_STATUSES)
+    with membership_lock:
+        MEMBERSHIP['stats']['updates'] += 1
+
+def membership_stats():
+    with membership_lock:
+        stats = dict(MEMBERSHIP['stats'])
+        stats['entries'] = len(MEMBERSHIP['entries'])
+    return stats
+
+# ==================== 18. PRIVATE CHANNEL HANDLER ====================
 def handle_private_channel(channel_id, user_id, channel_name):
     """Handle private channel join requests"""
     try:
         # Check if user is already a member
-        member = bot.get_chat_member(channel_id, user_id)
-        if member.status in ['member', 'administrator', 'creator', 'restricted']:
+        if check_memberships(user_id, [channel_id])[channel_id]:
             return True, "Already a member"
         
         # Check if bot is admin in the channel
-        bot_member = bot.get_chat_member(channel_id, bot.get_me().id)
-        if bot_member.status not in ['administrator', 'creator']:
-            return False, f"Bot is not admin in {channel_name}"
+        info = channel_info(channel_id)
+        if not info or info['bot_status'] not in ['administrator', 'creator']:
+            # Stored status may predate the bot's promotion, ask once before refusing
+            try:
+                member = bot.get_chat_member(channel_id, bot_id())
+                info = update_channel_info(bot.get_chat(channel_id), member.status)
+            except ApiTelegramException:
+                info = None
+            if not info or info['bot_status'] not in ['administrator', 'creator']:
+                return False, f"Bot is not admin in {channel_name}"
         
         # Try to approve join request if exists
         try:
@@ -331,7 +3166,7 @@ def handle_private_channel(channel_id, user_id, channel_name):
         logger.error(f"Private channel error: {e}")
         return False, f"Error checking {channel_name}"
 
-# ==================== 5. BOT HANDLERS ====================
+# ==================== 19. BOT HANDLERS ====================
 @bot.chat_join_request_handler()
 def auto_approve(message):
     """Auto approve join requests for channels where bot is admin"""
@@ -362,11 +3197,11 @@ def handle_start(message):
         
         if is_new:
             user_refer_code = generate_refer_code()
-            while any(user.get('refer_code') == user_refer_code for user in users.values()):
+            while find_users('refer_code', user_refer_code):
                 user_refer_code = generate_refer_code()
             
             full_name = get_user_full_name(message.from_user)
-            users[uid] = {
+            new_user = {
                 "balance": 0.0,
                 "verified": False,
                 "name": full_name,
@@ -381,16 +3216,22 @@ def handle_start(message):
                 "claimed_gifts": [],
                 "last_channel_check": None
             }
-            save_json(USERS_FILE, users)
             
-            msg = f"🔔 *New User*\nName: {full_name}\nID: `{uid}`"
+            def create(txn):
+                # A second /start may have raced us here
+                if txn.get(uid) is not None:
+                    return False
+                txn.create(uid, new_user)
+                return True
+            is_new = run_user_transaction([uid], create)
+        
+        if is_new:
+            msg = f"🔔 *New User*\nName: {escape_markdown(full_name)}\nID: `{uid}`"
             if message.from_user.username:
-                msg += f"\nUsername: @{message.from_user.username}"
+                msg += f"\nUsername: @{escape_markdown(message.from_user.username)}"
             if refer_code:
                 msg += f"\nReferred by: `{refer_code}`"
-            safe_send_message(ADMIN_ID, msg)
-            for adm in settings.get('admins', []):
-                safe_send_message(adm, msg)
+            admin_event('new_user', msg)
         
         display_name = get_user_display_name(message.from_user)
         # Remove special characters for URL encoding
@@ -417,15 +3258,207 @@ def handle_start(message):
 
         cap = f"👋 *WELCOME {display_name}!*\n\n🚀 Complete the steps below to start earning ₹{settings['welcome_bonus']}!"
         
-        try:
-            bot.send_photo(message.chat.id, img_url, caption=cap, parse_mode="Markdown", reply_markup=markup)
-        except:
-            safe_send_message(message.chat.id, cap, reply_markup=markup)
+        # Text only if the banner can't be sent
+        chat_id = message.chat.id
+        schedule_send('send_photo', chat_id, img_url, caption=cap, parse_mode="Markdown", reply_markup=markup).add_done_callback(
+            lambda f: f.exception() and safe_send_message(chat_id, cap, reply_markup=markup)
+        )
             
     except Exception as e:
         logger.error(f"Start handler error: {e}")
 
-# ==================== 6. WEBAPP ROUTES ====================
+# ==================== 20. UPDATE QUEUE ====================
+# The webhook only parses and enqueues; handlers run on UPDATE_WORKERS
+# threads. Every chat is pinned to one worker (chat id modulo the pool
+# size), so updates from the same chat are still handled in order.
+UPDATES = {
+    'queues': [],
+    'threads': [],
+    'pid': None,
+    'stats': {
+        'enqueued': 0,
+        'processed': 0,
+        'errors': 0,
+        'rejected': 0,
+        'last_lag_ms': 0.0,
+        'max_lag_ms': 0.0,
+        'total_lag_ms': 0.0,
+        'last_handle_ms': 0.0
+    }
+}
+updates_lock = threading.Lock()
+
+# Telegram redelivers an update when the webhook was slow or failed. The
+# update_ids accepted lately sit in a ring buffer plus a set (O(1) check),
+# persisted through the flusher so a restart doesn't forget them. Worker
+# processes can't see each other's sets, so in MULTI_PROCESS mode the
+# table itself decides who gets an update. The seen_updates task trims the
+# table back to the window in either mode.
+SEEN_UPDATES = {
+    'ring': deque(),
+    'set': set(),
+    'loaded': False,
+    'suppressed': 0
+}
+seen_lock = threading.Lock()
+
+def remember_update(update_id):
+    ring = SEEN_UPDATES['ring']
+    ring.append(update_id)
+    SEEN_UPDATES['set'].add(update_id)
+    while len(ring) > UPDATE_DEDUP_WINDOW:
+        SEEN_UPDATES['set'].discard(ring.popleft())
+
+def claim_update(update_id):
+    """True the first time an update_id shows up, False for a redelivery"""
+    with seen_lock:
+        if not SEEN_UPDATES['loaded']:
+            rows = get_db().execute(
+                "SELECT update_id FROM seen_updates ORDER BY update_id DESC LIMIT ?", (UPDATE_DEDUP_WINDOW,)
+            ).fetchall()
+            for (seen,) in reversed(rows):
+                remember_update(seen)
+            SEEN_UPDATES['loaded'] = True
+        
+        if update_id in SEEN_UPDATES['set']:
+            SEEN_UPDATES['suppressed'] += 1
+            return False
+        if not MULTI_PROCESS:
+            remember_update(update_id)
+    if not MULTI_PROCESS:
+        mark_dirty('updates', update_id, True)
+        return True
+    
+    # The table decides between workers; the commit waits for the disk, so
+    # other updates keep going through the set meanwhile
+    conn = get_db()
+    with conn:
+        claimed = conn.execute("INSERT OR IGNORE INTO seen_updates (update_id) VALUES (?)", (update_id,)).rowcount
+    with seen_lock:
+        if not claimed:
+            SEEN_UPDATES['suppressed'] += 1
+        if update_id not in SEEN_UPDATES['set']:
+            remember_update(update_id)
+    return bool(claimed)
+
+def release_update(update_id):
+    """Forget a claimed update that couldn't be queued, so its redelivery gets in"""
+    with seen_lock:
+        SEEN_UPDATES['set'].discard(update_id)
+    with write_cond:
+        WRITE_BEHIND['updates'].pop(update_id, None)
+    if MULTI_PROCESS:
+        conn = get_db()
+        with conn:
+            conn.execute("DELETE FROM seen_updates WHERE update_id = ?", (update_id,))
+
+def prune_seen_updates():
+    """Periodic task: drop update_ids older than the newest window"""
+    conn = get_db()
+    with conn:
+        return conn.execute(
+            "DELETE FROM seen_updates WHERE update_id < (SELECT MIN(update_id) FROM (SELECT update_id FROM seen_updates ORDER BY update_id DESC LIMIT ?))",
+            (UPDATE_DEDUP_WINDOW,)
+        ).rowcount
+
+register_task('seen_updates', SEEN_UPDATES_PRUNE_INTERVAL, prune_seen_updates)
+
+def dedup_stats():
+    with seen_lock:
+        return {
+            'window': UPDATE_DEDUP_WINDOW,
+            'remembered': len(SEEN_UPDATES['set']),
+            'suppressed': SEEN_UPDATES['suppressed']
+        }
+
+def update_chat_id(update):
+    """Chat an update belongs to (falls back to the sender, then the update id)"""
+    for kind in ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                 'chat_join_request', 'my_chat_member', 'chat_member'):
+        obj = getattr(update, kind, None)
+        if obj is not None and getattr(obj, 'chat', None) is not None:
+            return obj.chat.id
+    for kind in ('callback_query', 'inline_query', 'chosen_inline_result', 'pre_checkout_query', 'shipping_query'):
+        obj = getattr(update, kind, None)
+        if obj is not None and getattr(obj, 'from_user', None) is not None:
+            return obj.from_user.id
+    return update.update_id
+
+def ensure_update_workers():
+    """Start the pool (again after a fork, threads don't survive it)"""
+    with updates_lock:
+        if UPDATES['pid'] == os.getpid() and all(t.is_alive() for t in UPDATES['threads']):
+            return
+        if UPDATES['pid'] != os.getpid():
+            per_worker = max(1, UPDATE_QUEUE_SIZE // UPDATE_WORKERS)
+            UPDATES['queues'] = [queue.Queue(maxsize=per_worker) for _ in range(UPDATE_WORKERS)]
+            UPDATES['threads'] = [None] * UPDATE_WORKERS
+            UPDATES['pid'] = os.getpid()
+        for i, t in enumerate(UPDATES['threads']):
+            if t is None or not t.is_alive():
+                UPDATES['threads'][i] = threading.Thread(target=update_worker, args=(i,), name=f"updates-{i}", daemon=True)
+                UPDATES['threads'][i].start()
+
+def enqueue_update(update, timeout=1.0):
+    """Queue an update for its chat's worker; False if that worker is backed up"""
+    ensure_update_workers()
+    q = UPDATES['queues'][hash(update_chat_id(update)) % UPDATE_WORKERS]
+    try:
+        q.put((time.time(), update), timeout=timeout)
+    except queue.Full:
+        with updates_lock:
+            UPDATES['stats']['rejected'] += 1
+        return False
+    with updates_lock:
+        UPDATES['stats']['enqueued'] += 1
+    return True
+
+def update_worker(i):
+    q = UPDATES['queues'][i]
+    while True:
+        queued_at, update = q.get()
+        started = time.time()
+        try:
+            bot.process_new_updates([update])
+            failed = False
+        except Exception as e:
+            logger.error(f"Update {update.update_id} error: {e}")
+            failed = True
+        finally:
+            q.task_done()
+        
+        lag = (started - queued_at) * 1000
+        with updates_lock:
+            stats = UPDATES['stats']
+            stats['processed'] += 1
+            stats['errors'] += failed
+            stats['last_lag_ms'] = round(lag, 2)
+            stats['max_lag_ms'] = round(max(stats['max_lag_ms'], lag), 2)
+            stats['total_lag_ms'] += lag
+            stats['last_handle_ms'] = round((time.time() - started) * 1000, 2)
+
+def drain_updates(timeout=5.0):
+    """Give queued updates a chance to finish (Telegram already got its 200)"""
+    deadline = time.time() + timeout
+    if UPDATES['pid'] != os.getpid():
+        return
+    for q in UPDATES['queues']:
+        while q.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+
+def update_stats():
+    with updates_lock:
+        stats = dict(UPDATES['stats'])
+    total_lag = stats.pop('total_lag_ms')
+    stats['avg_lag_ms'] = round(total_lag / stats['processed'], 2) if stats['processed'] else 0.0
+    stats['workers'] = UPDATE_WORKERS
+    stats['depth'] = [q.qsize() for q in UPDATES['queues']] if UPDATES['pid'] == os.getpid() else []
+    stats['queued'] = sum(stats['depth'])
+    return stats
+
+atexit.register(drain_updates)
+
+# ==================== 21. WEBAPP ROUTES ====================
 @app.route('/')
 def home():
     return "Telegram Bot is running! Use /start in Telegram."
@@ -446,39 +3479,46 @@ def mini_app():
         user = users.get(str(uid), {"name": "Guest", "balance": 0.0, "verified": False, "device_verified": False})
         
         # Determine user status
-        user_status = get_user_status(user, settings)
+        user_status = get_user_status(user, settings, uid)
         
         # Auto verify if channel verification is disabled
         if settings.get('disable_channel_verification', False) and not user.get('verified', False):
-            user['verified'] = True
-            user['last_channel_check'] = datetime.now().isoformat()
-            
             # Give welcome bonus if this is first verification
             try: 
                 bonus = float(settings.get('welcome_bonus', 50))
             except: 
                 bonus = 50.0
             
-            user['balance'] = float(user.get('balance', 0)) + bonus
+            changes = {'verified': True, 'last_channel_check': datetime.now().isoformat()}
             user_status = "verified"
             
-            # Save updated user data
-            save_json(USERS_FILE, users)
+            if str(uid) in users:
+                def verify(txn):
+                    # Another request may have verified this user meanwhile
+                    if txn.get(uid).get('verified'):
+                        return False
+                    txn.update(uid, changes)
+                    txn.add(uid, 'balance', bonus)
+                    return True
+                granted = run_user_transaction([uid], verify)
+                user = get_user(uid)
+            else:
+                granted = True
+                user = dict(user, balance=float(user.get('balance', 0)) + bonus, **changes)
             
             # Add bonus transaction
-            w_list = load_json_cached(WITHDRAWALS_FILE, [], 'withdrawals')
-            w_list.append({
-                "tx_id": "BONUS", 
-                "user_id": uid, 
-                "name": "Signup Bonus",
-                "amount": bonus, 
-                "upi": "-", 
-                "status": "completed",
-                "date": datetime.now().strftime("%Y-%m-%d %H:%M")
-            })
-            save_json(WITHDRAWALS_FILE, w_list)
+            if granted:
+                add_withdrawal({
+                    "tx_id": "BONUS", 
+                    "user_id": uid, 
+                    "name": "Signup Bonus",
+                    "amount": bonus, 
+                    "upi": "-", 
+                    "status": "completed",
+                    "date": datetime.now().strftime("%Y-%m-%d %H:%M")
+                })
         
-        return render_template_string(MINI_APP_TEMPLATE, 
+        return render_page('mini_app.html', 
             user=user, 
             user_id=uid, 
             settings=settings, 
@@ -494,14 +3534,13 @@ def mini_app():
 
 @app.route('/get_pfp')
 def get_pfp():
-    uid = request.args.get('uid')
+    uid = request.args.get('uid', '')
     try:
-        photos = bot.get_user_profile_photos(uid)
-        if photos.total_count > 0:
-            file_id = photos.photos[0][0].file_id
-            file_info = bot.get_file(file_id)
-            dl_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
-            return Response(requests.get(dl_url, timeout=3).content, mimetype='image/jpeg')
+        photo = get_profile_photo(uid) if uid.isdigit() else None
+        if photo:
+            path, etag = photo
+            # Streamed from disk; a matching If-None-Match gets a 304
+            return send_file(path, mimetype='image/jpeg', etag=etag, conditional=True, max_age=PFP_MAX_AGE)
     except Exception as e:
         logger.error(f"PFP error: {e}")
     return "No Image", 404
@@ -524,6 +3563,8 @@ def api_verify():
         if uid not in users:
             return jsonify({'ok': False, 'msg': 'User not found'})
         
+        user = dict(users[uid])
+        
         # Generate proper device fingerprint
         device_fingerprint = generate_device_fingerprint(client_ip, user_agent, fp)
         
@@ -536,13 +3577,11 @@ def api_verify():
         if needs_device_check and fp and fp != 'skip':
             verification_steps.append({"step": "device", "status": "checking", "message": "Checking device..."})
             
-            if not users[uid].get('device_verified'):
+            if not user.get('device_verified'):
                 # Check for same device across different accounts
                 device_error = None
-                for u_id, u_data in users.items():
-                    if u_id == uid: 
-                        continue
-                    if u_data.get('device_verified') and str(u_data.get('device_id', '')) == device_fingerprint:
+                for u_id in find_users('device_id', device_fingerprint) - {uid}:
+                    if users[u_id].get('device_verified'):
                         device_error = '⚠️ Device already used by another account! Please use a different device or clear browser data.'
                         break
                 
@@ -556,8 +3595,7 @@ def api_verify():
                         'retry': True
                     })
                 else:
-                    users[uid]['device_id'] = device_fingerprint
-                    users[uid]['device_verified'] = True
+                    user = dict(update_user(uid, {'device_id': device_fingerprint, 'device_verified': True}))
                     verification_steps.append({"step": "device", "status": "passed", "message": "Device verified ✓"})
             else:
                 verification_steps.append({"step": "device", "status": "passed", "message": "Device already verified ✓"})
@@ -568,6 +3606,7 @@ def api_verify():
         verification_steps.append({"step": "channels", "status": "checking", "message": "Checking channel memberships..."})
         
         if settings['channels'] and not settings.get('disable_channel_verification', False):
+            to_check = []
             for idx, ch in enumerate(settings['channels']):
                 channel_name = ch.get('btn_name', f'Channel {idx+1}')
                 channel_disabled = ch.get('disabled', False)
@@ -577,13 +3616,13 @@ def api_verify():
                     verification_steps.append({"step": f"channel_{idx}", "status": "passed", "message": f"{channel_name} - Verification disabled ✓"})
                     continue
                 
-                try:
-                    if ch.get('id'):
-                        # Try to get member status
-                        member = bot.get_chat_member(ch['id'], uid)
-                        if member.status not in ['member', 'administrator', 'creator', 'restricted']:
-                            channel_errors.append(channel_name)
-                except:
+                if ch.get('id'):
+                    to_check.append((channel_name, ch['id']))
+            
+            # Cached answers first, the rest in one concurrent round
+            members = check_memberships(uid, [channel_id for _, channel_id in to_check])
+            for channel_name, channel_id in to_check:
+                if not members[channel_id]:
                     channel_errors.append(channel_name)
         
         # Return specific errors
@@ -600,56 +3639,54 @@ def api_verify():
         verification_steps.append({"step": "channels", "status": "passed", "message": "All channels verified ✓"})
         
         # All checks passed
-        users[uid]['last_channel_check'] = datetime.now().isoformat()
-        
-        # Determine if this is first time verification
-        is_first_verification = not users[uid].get('verified', False)
+        try: 
+            bonus = float(settings.get('welcome_bonus', 50))
+        except: 
+            bonus = 50.0
+        
+        # Referral bonus goes to the referrer ONLY when the referred user verifies
+        referrer_id = find_user('refer_code', user['referred_by']) if user.get('referred_by') else None
+        reward = round(random.uniform(
+            float(settings.get('min_refer_reward', 10)),
+            float(settings.get('max_refer_reward', 50))
+        ), 2)
+        
+        def verify(txn):
+            """Returns (first verification, referrer credited)"""
+            txn.update(uid, {'last_channel_check': datetime.now().isoformat()})
+            # Decided under the lock, so concurrent calls can't both pay the bonus
+            if txn.get(uid).get('verified', False):
+                return False, False
+            txn.update(uid, {'verified': True, 'ip': client_ip})
+            txn.add(uid, 'balance', bonus)
+            
+            referrer = txn.get(referrer_id) if referrer_id else None
+            if referrer is None or uid in referrer.get('referred_users', []):
+                return True, False
+            txn.add(referrer_id, 'balance', reward)
+            txn.append(referrer_id, 'referred_users', uid)
+            return True, True
+        
+        is_first_verification, referrer_credited = run_user_transaction(
+            [uid, referrer_id] if referrer_id else [uid], verify
+        )
+        user = get_user(uid)
         
         if is_first_verification:
-            try: 
-                bonus = float(settings.get('welcome_bonus', 50))
-            except: 
-                bonus = 50.0
-            
-            users[uid].update({
-                'verified': True,
-                'ip': client_ip,
-                'balance': float(users[uid].get('balance', 0)) + bonus
-            })
-            
-            # Give referral bonus to referrer ONLY when referred user verifies
-            if users[uid].get('referred_by'):
-                refer_code = users[uid]['referred_by']
-                for referrer_id, referrer_data in users.items():
-                    if referrer_data.get('refer_code') == refer_code:
-                        if uid not in referrer_data.get('referred_users', []):
-                            min_reward = float(settings.get('min_refer_reward', 10))
-                            max_reward = float(settings.get('max_refer_reward', 50))
-                            reward = random.uniform(min_reward, max_reward)
-                            reward = round(reward, 2)
-                            
-                            referrer_data['balance'] = float(referrer_data.get('balance', 0)) + reward
-                            if 'referred_users' not in referrer_data:
-                                referrer_data['referred_users'] = []
-                            referrer_data['referred_users'].append(uid)
-                            
-                            w_list = load_json_cached(WITHDRAWALS_FILE, [], 'withdrawals')
-                            w_list.append({
-                                "tx_id": f"REF-VERIFY-{generate_code(5)}",
-                                "user_id": referrer_id,
-                                "name": "Referral Bonus (Verified)",
-                                "amount": reward,
-                                "upi": "-",
-                                "status": "completed",
-                                "date": datetime.now().strftime("%Y-%m-%d %H:%M")
-                            })
-                            save_json(WITHDRAWALS_FILE, w_list)
-                            
-                            safe_send_message(referrer_id, f"🎉 *Referral Bonus!*\nYou earned ₹{reward} for {users[uid]['name']}'s verification")
-                        break
+            if referrer_credited:
+                add_withdrawal({
+                    "tx_id": f"REF-VERIFY-{generate_code(5)}",
+                    "user_id": referrer_id,
+                    "name": "Referral Bonus (Verified)",
+                    "amount": reward,
+                    "upi": "-",
+                    "status": "completed",
+                    "date": datetime.now().strftime("%Y-%m-%d %H:%M")
+                })
+                
+                safe_send_message(referrer_id, f"🎉 *Referral Bonus!*\nYou earned ₹{reward} for {user['name']}'s verification", priority=PRIORITY_HIGH)
             
-            w_list = load_json_cached(WITHDRAWALS_FILE, [], 'withdrawals')
-            w_list.append({
+            add_withdrawal({
                 "tx_id": "BONUS", 
                 "user_id": uid, 
                 "name": "Signup Bonus",
@@ -658,20 +3695,17 @@ def api_verify():
                 "status": "completed",
                 "date": datetime.now().strftime("%Y-%m-%d %H:%M")
             })
-            save_json(WITHDRAWALS_FILE, w_list)
             
             verification_steps.append({"step": "bonus", "status": "passed", "message": f"₹{bonus} bonus added ✓"})
         else:
             verification_steps.append({"step": "bonus", "status": "passed", "message": "Already verified ✓"})
         
-        save_json(USERS_FILE, users)
-        
         return jsonify({
             'ok': True, 
             'bonus': bonus if is_first_verification else 0, 
-            'balance': users[uid]['balance'], 
+            'balance': user['balance'], 
             'verified': True,
-            'device_verified': users[uid].get('device_verified', False),
+            'device_verified': user.get('device_verified', False),
             'steps': verification_steps
         })
     
@@ -692,7 +3726,7 @@ def api_check_verification():
         
         user = users[uid]
         settings = get_settings()
-        status = get_user_status(user, settings)
+        status = get_user_status(user, settings, uid)
         
         return jsonify({
             'ok': True,
@@ -717,7 +3751,6 @@ def api_withdraw():
             return jsonify({'ok': False, 'msg': 'Invalid Amount'})
         upi = str(data.get('upi', ''))
         
-        users = load_json_cached(USERS_FILE, {}, 'users')
         settings = get_settings()
         
         if settings.get('withdraw_disabled'):
@@ -730,18 +3763,22 @@ def api_withdraw():
         if amt < min_w:
             return jsonify({'ok': False, 'msg': f'⚠️ Min Withdraw: ₹{min_w}'})
             
-        cur_bal = float(users.get(uid, {}).get('balance', 0))
-        if cur_bal < amt:
+        def debit(txn):
+            user = txn.get(uid)
+            # Checked under the lock, so two withdrawals can't spend the same balance
+            if user is None or float(user.get('balance', 0)) < amt:
+                return False
+            txn.add(uid, 'balance', -amt)
+            return True
+        if not run_user_transaction([uid], debit):
             return jsonify({'ok': False, 'msg': '❌ Insufficient Balance'})
-        
-        users[uid]['balance'] = cur_bal - amt
-        save_json(USERS_FILE, users)
+        user = get_user(uid)
         
         tx_id = generate_code(5)
         record = {
             "tx_id": tx_id, 
             "user_id": uid, 
-            "name": users[uid].get('name', 'User'), 
+            "name": user.get('name', 'User'), 
             "amount": amt, 
             "upi": upi, 
             "status": "pending", 
@@ -755,20 +3792,15 @@ def api_withdraw():
             record['status'] = 'completed'
             record['utr'] = f"AUTO-{int(time.time())}"
             msg_client = f"✅ PAID! UTR: {record['utr']}"
-            safe_send_message(uid, f"✅ *Auto-Withdrawal Paid!*\nAmt: ₹{amt}\nUTR: `{record['utr']}`\nTxID: `{tx_id}`")
+            safe_send_message(uid, f"✅ *Auto-Withdrawal Paid!*\nAmt: ₹{amt}\nUTR: `{record['utr']}`\nTxID: `{tx_id}`", priority=PRIORITY_HIGH)
         else:
             msg_client = "✅ Request Sent! Waiting for Admin..."
-            markup = InlineKeyboardMarkup()
-            markup.add(InlineKeyboardButton("Open Admin Panel", url=f"{BASE_URL}/admin_panel?user_id={ADMIN_ID}"))
-            
-            msg_adm = f"💸 *New Withdrawal*\nUser: {users[uid]['name']}\nAmt: ₹{amt}\nTxID: `{tx_id}`"
-            safe_send_message(ADMIN_ID, msg_adm, reply_markup=markup)
-            for adm in settings.get('admins', []):
-                safe_send_message(adm, msg_adm, reply_markup=markup)
+            msg_adm = f"💸 *New Withdrawal*\nUser: {escape_markdown(user['name'])}\nAmt: ₹{amt}\nTxID: `{tx_id}`"
+            admin_event('withdraw', msg_adm)
 
-        w_list = load_json_cached(WITHDRAWALS_FILE, [], 'withdrawals')
-        w_list.append(record)
-        save_json(WITHDRAWALS_FILE, w_list)
+        add_withdrawal(record)
+        if not flush_barrier():
+            logger.error(f"Withdrawal {tx_id} not yet durable after barrier timeout")
         
         return jsonify({
             'ok': True, 
@@ -776,7 +3808,7 @@ def api_withdraw():
             'auto': is_auto, 
             'utr': record.get('utr', ''), 
             'tx_id': tx_id,
-            'new_balance': users[uid]['balance']
+            'new_balance': user['balance']
         })
         
     except Exception as e:
@@ -809,8 +3841,14 @@ def api_history():
         if not uid:
             return jsonify([])
         
-        history = [w for w in load_json_cached(WITHDRAWALS_FILE, [], 'withdrawals') if w.get('user_id') == uid]
-        return jsonify(history[::-1][:10])
+        # Further pages: ?cursor=<X-Next-Cursor of the previous page>
+        limit = min(max(int(request.args.get('limit', 10)), 1), 100)
+        cursor = request.args.get('cursor')
+        page, next_cursor = user_history(uid, limit, int(cursor) if cursor else None)
+        response = jsonify(page)
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = str(next_cursor)
+        return response
     except Exception as e:
         logger.error(f"History error: {e}")
         return jsonify([])
@@ -825,10 +3863,11 @@ def api_contact():
         if not uid:
             return jsonify({'ok': False, 'msg': 'User ID required'})
             
-        cap = f"📩 *Message from {uid}*\n{msg}"
-        recipients = [ADMIN_ID] + get_settings().get('admins', [])
+        cap = f"📩 *Message from {uid}*\n{escape_markdown(msg)}"
+        recipients = admin_ids()
         
         if f:
+            # Photos can't go into a digest, so they're always sent right away
             filename = secure_filename(f.filename)
             path = os.path.join(UPLOAD_FOLDER, filename)
             f.save(path)
@@ -836,14 +3875,10 @@ def api_contact():
             with open(path, 'rb') as img:
                 file_data = img.read()
                 for adm in recipients:
-                    try: 
-                        bot.send_photo(adm, file_data, caption=cap, parse_mode="Markdown")
-                    except Exception as e:
-                        logger.error(f"Send photo error to {adm}: {e}")
+                    schedule_send('send_photo', adm, file_data, caption=cap, parse_mode="Markdown")
             os.remove(path)
         else:
-            for adm in recipients:
-                safe_send_message(adm, cap)
+            admin_event('contact', cap)
                 
         return jsonify({'ok': True})
     except Exception as e:
@@ -864,17 +3899,16 @@ def api_claim_gift():
         if uid not in users:
             return jsonify({'ok': False, 'msg': 'User not found'})
         
-        if 'claimed_gifts' not in users[uid]:
-            users[uid]['claimed_gifts'] = []
-        
-        if code in users[uid]['claimed_gifts']:
+        if code in users[uid].get('claimed_gifts', []):
             return jsonify({'ok': False, 'msg': 'Already claimed this code'})
         
-        gifts = check_gift_code_expiry()
+        # Expiry flags are kept up to date by the gift_expiry task; only this
+        # code needs a fresh look
+        gifts = load_json_cached(GIFTS_FILE, [], 'gifts')
         
         for gift in gifts:
             if gift.get('code') == code:
-                if gift.get('expired'):
+                if gift_expired(gift):
                     return jsonify({'ok': False, 'msg': '❌ Gift code expired'})
                 if not gift.get('is_active', True):
                     return jsonify({'ok': False, 'msg': 'Code is inactive'})
@@ -888,15 +3922,50 @@ def api_claim_gift():
                 )
                 amount = round(amount, 2)
                 
-                users[uid]['balance'] = float(users[uid].get('balance', 0)) + amount
-                users[uid]['claimed_gifts'].append(code)
+                # The cached copy may be stale: check and take a use on the
+                # current record under the gift's lock, credit only after that
+                refusal = {}
+                def take_use(current):
+                    if current is None:
+                        refusal['msg'] = 'Invalid gift code'
+                    elif gift_expired(current):
+                        refusal['msg'] = '❌ Gift code expired'
+                    elif not current.get('is_active', True):
+                        refusal['msg'] = 'Code is inactive'
+                    elif uid in current.get('used_by', []):
+                        refusal['msg'] = 'Already claimed this code'
+                    elif len(current.get('used_by', [])) >= current.get('total_uses', 1):
+                        refusal['msg'] = 'Code usage limit reached'
+                    else:
+                        return dict(current, used_by=list(current.get('used_by', [])) + [uid])
+                    return None
+                if not update_gift(code, take_use):
+                    return jsonify({'ok': False, 'msg': refusal['msg']})
                 
-                if 'used_by' not in gift:
-                    gift['used_by'] = []
-                gift['used_by'].append(uid)
-                
-                w_list = load_json_cached(WITHDRAWALS_FILE, [], 'withdrawals')
-                w_list.append({
+                def claim(txn):
+                    if code in txn.get(uid).get('claimed_gifts', []):
+                        return False
+                    txn.add(uid, 'balance', amount)
+                    txn.append(uid, 'claimed_gifts', code)
+                    return True
+                def give_back(current):
+                    if current is None:
+                        return None
+                    return dict(current, used_by=[u for u in current.get('used_by', []) if u != uid])
+                try:
+                    claimed = run_user_transaction([uid], claim)
+                except Exception:
+                    # Not credited (conflict, lock timeout, write error): the use
+                    # goes back unless the claim did land before the failure
+                    if code not in (get_user(uid) or {}).get('claimed_gifts', []):
+                        update_gift(code, give_back)
+                    raise
+                if not claimed:
+                    # Give the use back, this user already had the code
+                    update_gift(code, give_back)
+                    return jsonify({'ok': False, 'msg': 'Already claimed this code'})
+                user = get_user(uid)
+                add_withdrawal({
                     "tx_id": f"GIFT-{generate_code(5)}",
                     "user_id": uid,
                     "name": "Gift Code Reward",
@@ -906,15 +3975,11 @@ def api_claim_gift():
                     "date": datetime.now().strftime("%Y-%m-%d %H:%M")
                 })
                 
-                save_json(USERS_FILE, users)
-                save_json(GIFTS_FILE, gifts)
-                save_json(WITHDRAWALS_FILE, w_list)
-                
                 return jsonify({
                     'ok': True, 
                     'msg': f'🎉 Gift code claimed! ₹{amount} added to your balance',
                     'amount': amount,
-                    'new_balance': users[uid]['balance']
+                    'new_balance': user['balance']
                 })
         
         return jsonify({'ok': False, 'msg': 'Invalid gift code'})
@@ -938,15 +4003,11 @@ def api_get_refer_info():
         user = users[uid]
         
         if not user.get('refer_code'):
-            user['refer_code'] = generate_refer_code()
-            save_json(USERS_FILE, users)
+            user = update_user(uid, {'refer_code': generate_refer_code()})
         
         refer_code = user.get('refer_code', '')
         
-        try:
-            bot_username = bot.get_me().username
-        except:
-            bot_username = "telegram_bot"
+        bot_handle = bot_username()
         
         referred_users = user.get('referred_users', [])
         referred_details = []
@@ -956,7 +4017,7 @@ def api_get_refer_info():
         for ref_uid in referred_users[:20]:
             if ref_uid in users:
                 ref_user = users[ref_uid]
-                ref_status = get_user_status(ref_user, settings)
+                ref_status = get_user_status(ref_user, settings, ref_uid)
                 is_verified = ref_status == "verified"
                 status = "✅ VERIFIED" if is_verified else "⏳ PENDING"
                 
@@ -977,7 +4038,7 @@ def api_get_refer_info():
         return jsonify({
             'ok': True,
             'refer_code': refer_code,
-            'refer_link': f'https://t.me/{bot_username}?start={refer_code}',
+            'refer_link': f'https://t.me/{bot_handle}?start={refer_code}',
             'referred_users': referred_details,
             'total_refers': len(referred_users),
             'verified_refers': total_verified,
@@ -990,13 +4051,16 @@ def api_get_refer_info():
 @app.route('/api/leaderboard')
 def api_leaderboard():
     try:
-        data = update_leaderboard()
+        # Rebuilt by the leaderboard task; only built here before its first run
+        data = load_json_cached(LEADERBOARD_FILE, None, 'leaderboard')
+        if not data or data.get('last_updated') == "2000-01-01":
+            data = update_leaderboard()
         return jsonify(data)
     except Exception as e:
         logger.error(f"Leaderboard error: {e}")
         return jsonify({"last_updated": datetime.now().isoformat(), "data": []})
 
-# ==================== 7. ADMIN PANEL ====================
+# ==================== 22. ADMIN PANEL ====================
 @app.route('/admin_panel')
 def admin_panel():
     try:
@@ -1011,24 +4075,26 @@ def admin_panel():
             if tx_id != "BONUS" and not tx_id.startswith('REF-') and not tx_id.startswith('GIFT-'):
                 filtered_withdrawals.append(w)
         
-        gifts = check_gift_code_expiry()
-        
         current_time = datetime.now()
-        for gift in gifts:
+        gifts = [
+            dict(gift, expired=True) if gift_expired(gift, current_time) else gift
+            for gift in load_json_cached(GIFTS_FILE, [], 'gifts')
+        ]
+        for i, gift in enumerate(gifts):
             if 'expiry' in gift:
                 try:
                     expiry_time = datetime.fromisoformat(gift['expiry'])
                     remaining_minutes = max(0, int((expiry_time - current_time).total_seconds() / 60))
-                    gift['remaining_minutes'] = remaining_minutes
                 except:
-                    gift['remaining_minutes'] = 0
+                    remaining_minutes = 0
+                gifts[i] = dict(gift, remaining_minutes=remaining_minutes)
         
         users = load_json_cached(USERS_FILE, {}, 'users')
         settings = get_settings()
         
         user_list = []
         for user_id, user_data in users.items():
-            status = get_user_status(user_data, settings)
+            status = get_user_status(user_data, settings, user_id)
             user_list.append({
                 'id': user_id,
                 'name': user_data.get('name', 'Unknown'),
@@ -1042,7 +4108,7 @@ def admin_panel():
                 'joined_date': user_data.get('joined_date', '')
             })
         
-        return render_template_string(ADMIN_TEMPLATE, 
+        return render_page('admin.html', 
             settings=get_settings(), 
             users=user_list,
             withdrawals=filtered_withdrawals[::-1], 
@@ -1062,7 +4128,7 @@ def admin_panel():
 @app.route('/admin/update_basic', methods=['POST'])
 def admin_update_basic():
     try:
-        s = get_settings()
+        s = thaw(get_settings())
         d = request.json
         
         try:
@@ -1088,7 +4154,7 @@ def admin_update_basic():
 def admin_manage_admins():
     try:
         d = request.json
-        s = get_settings()
+        s = thaw(get_settings())
         if 'admins' not in s: 
             s['admins'] = []
         
@@ -1112,7 +4178,7 @@ def admin_manage_admins():
 def admin_channels():
     try:
         d = request.json
-        s = get_settings()
+        s = thaw(get_settings())
         action = d.get('action', '')
         
         if action == 'add':
@@ -1132,6 +4198,8 @@ def admin_channels():
                 s['channels'][index]['disabled'] = not s['channels'][index].get('disabled', False)
         
         save_json(SETTINGS_FILE, s)
+        if action == 'add':
+            refresh_bot_metadata_soon()
         return jsonify({'ok': True})
     except Exception as e:
         logger.error(f"Channels error: {e}")
@@ -1141,24 +4209,21 @@ def admin_channels():
 def admin_process_withdraw():
     try:
         d = request.json
-        w_list = load_json_cached(WITHDRAWALS_FILE, [], 'withdrawals')
+        w = update_withdrawal(d.get('tx_id'), {'status': d.get('status', ''), 'utr': d.get('utr', '')})
+        
+        if w:
+            if d.get('status') == 'completed': 
+                safe_send_message(w['user_id'], f"✅ *Withdrawal Paid!*\nAmt: ₹{w['amount']}\nUTR: `{w['utr']}`\nTxID: `{w['tx_id']}`", priority=PRIORITY_HIGH)
+            else:
+                def refund(txn):
+                    if txn.get(w['user_id']) is None:
+                        return False
+                    txn.add(w['user_id'], 'balance', float(w['amount']))
+                    return True
+                if run_user_transaction([w['user_id']], refund):
+                    safe_send_message(w['user_id'], f"❌ *Withdrawal Rejected*\nAmt: ₹{w['amount']}\nRefunded to balance.\nTxID: `{w['tx_id']}`", priority=PRIORITY_HIGH)
+            flush_barrier()
         
-        for w in w_list:
-            if w.get('tx_id') == d.get('tx_id') and w.get('status') == 'pending':
-                w['status'] = d.get('status', '')
-                w['utr'] = d.get('utr', '')
-                
-                if d.get('status') == 'completed': 
-                    safe_send_message(w['user_id'], f"✅ *Withdrawal Paid!*\nAmt: ₹{w['amount']}\nUTR: `{w['utr']}`\nTxID: `{w['tx_id']}`")
-                else:
-                    users = load_json_cached(USERS_FILE, {}, 'users')
-                    if w['user_id'] in users:
-                        users[w['user_id']]['balance'] = float(users[w['user_id']].get('balance', 0)) + float(w['amount'])
-                        save_json(USERS_FILE, users)
-                        safe_send_message(w['user_id'], f"❌ *Withdrawal Rejected*\nAmt: ₹{w['amount']}\nRefunded to balance.\nTxID: `{w['tx_id']}`")
-                break
-                
-        save_json(WITHDRAWALS_FILE, w_list)
         return jsonify({'ok': True})
     except Exception as e:
         logger.error(f"Process withdraw error: {e}")
@@ -1170,9 +4235,7 @@ def admin_logo():
         if 'logo' in request.files:
             f = request.files['logo']
             f.save(os.path.join(STATIC_DIR, "logo_custom.png"))
-            s = get_settings()
-            s['logo_filename'] = "logo_custom.png"
-            save_json(SETTINGS_FILE, s)
+            update_settings({'logo_filename': "logo_custom.png"})
             return jsonify({'ok': True})
         return jsonify({'ok': False, 'msg': 'No file uploaded'})
     except Exception as e:
@@ -1184,35 +4247,52 @@ def admin_broadcast():
     try:
         txt = request.form.get('text', '')
         f = request.files.get('image')
-        users = load_json_cached(USERS_FILE, {}, 'users')
-        cnt = 0
+        path = None
         
         if f:
+            # Kept until the job has uploaded it once
             filename = secure_filename(f.filename)
-            path = os.path.join(UPLOAD_FOLDER, filename)
+            path = os.path.join(UPLOAD_FOLDER, f"broadcast-{int(time.time() * 1000)}-{filename}")
             f.save(path)
-            
-            with open(path, 'rb') as img:
-                idata = img.read()
-                for u in users:
-                    try: 
-                        bot.send_photo(u, idata, caption=txt)
-                        cnt += 1
-                    except: 
-                        pass
-            os.remove(path)
-        else:
-            for u in users:
-                try: 
-                    bot.send_message(u, txt)
-                    cnt += 1
-                except: 
-                    pass
-        return jsonify({'count': cnt})
+        
+        job_id, cnt = create_broadcast(txt, path)
+        return jsonify({'ok': True, 'job_id': job_id, 'count': cnt})
     except Exception as e:
         logger.error(f"Broadcast error: {e}")
         return jsonify({'ok': False, 'msg': str(e)})
 
+@app.route('/admin/broadcasts')
+def admin_broadcasts():
+    try:
+        ensure_broadcast_runner()
+        return jsonify({'ok': True, 'jobs': list_broadcasts()})
+    except Exception as e:
+        logger.error(f"Broadcast list error: {e}")
+        return jsonify({'ok': False, 'msg': str(e)})
+
+@app.route('/admin/broadcast/<int:job_id>')
+def admin_broadcast_progress(job_id):
+    try:
+        job = get_broadcast(job_id)
+        if job is None:
+            return jsonify({'ok': False, 'msg': 'Broadcast not found'})
+        return jsonify({'ok': True, 'job': job})
+    except Exception as e:
+        logger.error(f"Broadcast progress error: {e}")
+        return jsonify({'ok': False, 'msg': str(e)})
+
+@app.route('/admin/broadcast/<int:job_id>/<action>', methods=['POST'])
+def admin_broadcast_action(job_id, action):
+    try:
+        if action not in ('pause', 'resume', 'cancel'):
+            return jsonify({'ok': False, 'msg': 'Unknown action'})
+        if not set_broadcast_status(job_id, action):
+            return jsonify({'ok': False, 'msg': f'Cannot {action} this broadcast'})
+        return jsonify({'ok': True, 'job': get_broadcast(job_id)})
+    except Exception as e:
+        logger.error(f"Broadcast {action} error: {e}")
+        return jsonify({'ok': False, 'msg': str(e)})
+
 @app.route('/admin/send_to_user', methods=['POST'])
 def admin_send_to_user():
     try:
@@ -1231,7 +4311,7 @@ def admin_send_to_user():
             with open(path, 'rb') as img:
                 idata = img.read()
                 try: 
-                    bot.send_photo(user_id, idata, caption=txt)
+                    schedule_send('send_photo', user_id, idata, caption=txt).result(timeout=30)
                     os.remove(path)
                     return jsonify({'ok': True, 'msg': 'Message sent successfully!'})
                 except Exception as e:
@@ -1239,7 +4319,7 @@ def admin_send_to_user():
                     return jsonify({'ok': False, 'msg': f'Error: {str(e)}'})
         else:
             try: 
-                bot.send_message(user_id, txt)
+                schedule_send('send_message', user_id, txt).result(timeout=30)
                 return jsonify({'ok': True, 'msg': 'Message sent successfully!'})
             except Exception as e:
                 return jsonify({'ok': False, 'msg': f'Error: {str(e)}'})
@@ -1279,8 +4359,7 @@ def admin_create_gift():
             'created_by': request.args.get('user_id', 'admin')
         }
         
-        gifts.append(gift)
-        save_json(GIFTS_FILE, gifts)
+        save_gift(gift)
         
         return jsonify({'ok': True, 'code': code})
     except Exception as e:
@@ -1299,20 +4378,45 @@ def admin_toggle_gift():
         for gift in gifts:
             if gift.get('code') == code:
                 if action == 'toggle':
-                    gift['is_active'] = not gift.get('is_active', True)
+                    update_gift(code, lambda g: dict(g, is_active=not g.get('is_active', True)) if g else None)
                 elif action == 'delete':
-                    gifts.remove(gift)
+                    delete_gift(code)
                 break
         
-        save_json(GIFTS_FILE, gifts)
         return jsonify({'ok': True})
     except Exception as e:
         logger.error(f"Toggle gift error: {e}")
         return jsonify({'ok': False, 'msg': str(e)})
 
-# ==================== 8. SETUP ====================
+# ==================== 23. SETUP ====================
+def warm_up():
+    """Load every store into the cache; run before gunicorn forks so the
+    workers start warm and share those pages.
+    
+    Only files and the database are read here: no Telegram calls, threads or
+    held locks may be around at fork time. Identity and channel info come
+    from the meta table; if nothing is stored yet, the bot_metadata task
+    fetches them in a worker (bot_identity asks on first use meanwhile)."""
+    get_settings()
+    load_json_cached(GIFTS_FILE, [], 'gifts')
+    load_json_cached(WITHDRAWALS_FILE, [], 'withdrawals')
+    load_json_cached(LEADERBOARD_FILE, {"last_updated": "2000-01-01", "data": []}, 'leaderboard')
+    for i in range(SHARDS['count']):
+        load_user_shard(i)
+    compile_templates()
+    bot_metadata()
+
+@app.before_request
+def start_background():
+    # Threads don't survive gunicorn's fork: the first request in each worker
+    # starts them, and broadcasts a restart left running resume
+    ensure_task_runner()
+    ensure_broadcast_runner()
+
 @app.route('/static/<path:filename>')
 def serve_static(filename): 
+    if filename in ASSETS.values():
+        return serve_asset(os.path.basename(filename))
     return send_from_directory(STATIC_DIR, filename)
 
 @app.route('/setup_webhooks')
@@ -1320,7 +4424,12 @@ def setup_webhooks():
     try:
         bot.remove_webhook()
         time.sleep(1)
-        bot.set_webhook(f"{BASE_URL}/webhook/main")
+        # chat_member isn't delivered unless asked for; it feeds the membership cache
+        bot.set_webhook(
+            f"{BASE_URL}/webhook/main",
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=telebot.util.update_types
+        )
         return "✅ Webhook Configured"
     except Exception as e:
         return f"Error: {str(e)}"
@@ -1328,21 +4437,53 @@ def setup_webhooks():
 @app.route('/webhook/main', methods=['POST'])
 def wm():
     if request.headers.get('content-type') == 'application/json':
+        if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return 'Forbidden', 403
         try:
             json_string = request.get_data().decode('utf-8')
             update = telebot.types.Update.de_json(json_string)
-            bot.process_new_updates([update])
-            return ''
+            if update is None or update.update_id is None:
+                return 'Bad Request', 400
         except Exception as e:
             logger.error(f"Webhook error: {e}")
-            return 'Error', 500
+            return 'Bad Request', 400
+        # A redelivery of something we already took: acknowledge and drop it
+        if not claim_update(update.update_id):
+            return ''
+        # Handled in the background; a full queue makes Telegram retry later
+        if not enqueue_update(update):
+            release_update(update.update_id)
+            return 'Busy', 503
+        return ''
     return 'OK', 200
 
 @app.route('/health')
 def health():
     return jsonify({"status": "healthy", "timestamp": datetime.now().isoformat()})
 
-# ==================== 9. HTML TEMPLATES ====================
+@app.route('/metrics')
+def metrics():
+    return jsonify({
+        "storage": write_stats(),
+        "cache": cache_stats(),
+        "snapshots": snapshot_stats(),
+        "user_index": index_stats(),
+        "transactions": txn_stats(),
+        "coherence": coherence_stats(),
+        "updates": update_stats(),
+        "dedup": dedup_stats(),
+        "telegram": telegram_stats(),
+        "sender": sender_stats(),
+        "broadcasts": broadcast_stats(),
+        "admin_digest": digest_stats(),
+        "tasks": task_stats(),
+        "membership": membership_stats(),
+        "pfp": pfp_stats(),
+        "templates": template_stats(),
+        "compression": compression_stats()
+    })
+
+# ==================== 24. HTML TEMPLATES ====================
 
 MINI_APP_TEMPLATE = """
 <!DOCTYPE html>
@@ -1353,166 +4494,7 @@ MINI_APP_TEMPLATE = """
     <link href="https://fonts.googleapis.com/css2?family=Rajdhani:wght@500;700&family=Poppins:wght@400;600;700&family=Orbitron:wght@400;700&display=swap" rel="stylesheet">
     <script src="https://cdn.jsdelivr.net/npm/canvas-confetti@1.6.0/dist/confetti.browser.min.js"></script>
     <script src="https://cdnjs.cloudflare.com/ajax/libs/three.js/r128/three.min.js"></script>
-    <style>
-        :root { 
-            --bg: #050508; 
-            --cyan: #00f3ff; 
-            --gold: #ffd700; 
-            --panel: rgba(255,255,255,0.05); 
-            --neon-pink: #ff00ff;
-            --neon-blue: #00ccff;
-            --neon-green: #00ffaa;
-            --neon-purple: #9d4edd;
-        }
-        * { box-sizing: border-box; margin: 0; padding: 0; }
-        body { background: radial-gradient(circle at top, #111122, var(--bg)); color: white; font-family: 'Poppins', sans-serif; margin: 0; padding: 0; min-height: 100vh; overflow-x: hidden; }
-        .hidden { display: none !important; }
-        .header { display: flex; align-items: center; justify-content: center; gap: 20px; margin: 20px 0; width: 100%; padding: 0 5%; animation: fadeInDown 0.8s ease-out; }
-        @keyframes fadeInDown { from { opacity: 0; transform: translateY(-30px); } to { opacity: 1; transform: translateY(0); } }
-        .logo { width: 70px; height: 70px; border-radius: 50%; border: 3px solid var(--cyan); box-shadow: 0 0 25px rgba(0,243,255,0.7), inset 0 0 15px rgba(0,243,255,0.3); object-fit: cover; animation: pulseLogo 3s infinite alternate; }
-        @keyframes pulseLogo { 0% { box-shadow: 0 0 25px rgba(0,243,255,0.7), inset 0 0 15px rgba(0,243,255,0.3); } 100% { box-shadow: 0 0 40px rgba(0,243,255,0.9), inset 0 0 20px rgba(0,243,255,0.5); } }
-        .title { font-size: 26px; font-weight: 800; text-shadow: 0 0 15px var(--cyan), 0 0 30px rgba(0,243,255,0.5); letter-spacing: 2px; font-family: 'Orbitron', monospace; background: linear-gradient(45deg, var(--cyan), var(--neon-blue)); -webkit-background-clip: text; -webkit-text-fill-color: transparent; animation: textGlow 2s infinite alternate; }
-        @keyframes textGlow { from { text-shadow: 0 0 15px var(--cyan), 0 0 30px rgba(0,243,255,0.5); } to { text-shadow: 0 0 20px var(--cyan), 0 0 40px rgba(0,243,255,0.7), 0 0 60px rgba(0,243,255,0.3); } }
-        .nav-bar { display: flex; width: 100%; max-width: 550px; background: rgba(0,0,0,0.8); border-radius: 20px; margin: 15px auto; padding: 8px; justify-content: space-around; border: 1px solid rgba(255,255,255,0.1); backdrop-filter: blur(10px); animation: slideUp 0.6s ease-out; }
-        @keyframes slideUp { from { opacity: 0; transform: translateY(30px); } to { opacity: 1; transform: translateY(0); } }
-        .nav-btn { background: transparent; border: none; color: #aaa; padding: 12px 5px; border-radius: 15px; font-weight: bold; font-size: 14px; display: flex; flex-direction: column; align-items: center; gap: 5px; cursor: pointer; transition: all 0.3s cubic-bezier(0.4, 0, 0.2, 1); width: 25%; position: relative; overflow: hidden; }
-        .nav-btn i { font-size: 24px; transition: all 0.3s; }
-        .nav-text { font-size: 11px; margin-top: 3px; color: #888; transition: all 0.3s; font-family: 'Rajdhani', sans-serif; }
-        .nav-btn::before { content: ''; position: absolute; top: 0; left: -100%; width: 100%; height: 100%; background: linear-gradient(90deg, transparent, rgba(255,255,255,0.2), transparent); transition: left 0.7s; }
-        .nav-btn:hover::before { left: 100%; }
-        .nav-btn.active { background: linear-gradient(135deg, rgba(0,243,255,0.2), rgba(0,136,255,0.2)); color: var(--cyan); box-shadow: 0 0 20px rgba(0,243,255,0.5), inset 0 1px 0 rgba(255,255,255,0.2); border: 1px solid rgba(0,243,255,0.3); transform: translateY(-3px); }
-        .nav-btn.active .nav-text { color: var(--cyan); text-shadow: 0 0 10px rgba(0,243,255,0.5); }
-        .nav-btn.active i { transform: scale(1.2); filter: drop-shadow(0 0 8px rgba(0,243,255,0.7)); }
-        .tab-content { width: 100%; max-width: 550px; padding: 0 5% 30px 5%; animation: fadeIn 0.5s ease-out; }
-        @keyframes fadeIn { from { opacity: 0; } to { opacity: 1; } }
-        .card-metal, .card-gold, .card-silver, .card-purple { width: 100%; border-radius: 20px; padding: 30px; margin-bottom: 25px; position: relative; overflow: hidden; animation: cardAppear 0.6s ease-out; }
-        @keyframes cardAppear { from { opacity: 0; transform: scale(0.9); } to { opacity: 1; transform: scale(1); } }
-        .card-metal { background: linear-gradient(135deg, #e0e0e0 0%, #bdc3c7 20%, #88929e 50%, #bdc3c7 80%, #e0e0e0 100%); border: 2px solid #fff; box-shadow: 0 15px 30px rgba(0,0,0,0.6), inset 0 0 20px rgba(255,255,255,0.7); display: flex; align-items: center; color: #222; animation: metalShine 4s infinite; }
-        @keyframes metalShine { 0%, 100% { background: linear-gradient(135deg, #e0e0e0 0%, #bdc3c7 20%, #88929e 50%, #bdc3c7 80%, #e0e0e0 100%); } 50% { background: linear-gradient(135deg, #f0f0f0 0%, #d0d0d0 20%, #a0a0a0 50%, #d0d0d0 80%, #f0f0f0 100%); } }
-        .card-metal::before { content: ''; position: absolute; top: 0; left: -150%; width: 60%; height: 100%; background: linear-gradient(90deg, transparent, rgba(255,255,255,0.9), transparent); animation: shine 3.5s infinite; transform: skewX(-20deg); }
-        @keyframes shine { 100% { left: 200%; } }
-        .p-pic-wrapper { position: relative; width: 80px; height: 80px; margin-right: 20px; z-index: 2; flex-shrink: 0; }
-        .p-pic { width: 100%; height: 100%; border-radius: 50%; border: 4px solid #333; object-fit: cover; box-shadow: 0 5px 15px rgba(0,0,0,0.5); transition: transform 0.5s; }
-        .p-pic:hover { transform: rotate(15deg) scale(1.05); }
-        .p-icon { display: none; width: 100%; height: 100%; border-radius: 50%; border: 4px solid #333; background: linear-gradient(135deg, #ddd, #aaa); align-items: center; justify-content: center; font-size: 32px; color: #333; }
-        .card-gold { background: radial-gradient(ellipse at center, #ffd700 0%, #d4af37 40%, #b8860b 100%); text-align: center; color: #2e2003; border: 3px solid #fff2ad; box-shadow: 0 0 35px rgba(255, 215, 0, 0.6), inset 0 0 15px rgba(255, 255, 255, 0.6); animation: pulseGold 3s infinite alternate, floatCard 6s infinite ease-in-out; position: relative; }
-        @keyframes pulseGold { 0% { box-shadow: 0 0 35px rgba(255,215,0,0.6), inset 0 0 15px rgba(255,255,255,0.6); } 100% { box-shadow: 0 0 50px rgba(255,215,0,0.8), inset 0 0 25px rgba(255,255,255,0.8); } }
-        @keyframes floatCard { 0%, 100% { transform: translateY(0); } 50% { transform: translateY(-10px); } }
-        .card-gold::after { content: ''; position: absolute; top: -50%; left: -50%; width: 200%; height: 200%; background: radial-gradient(circle, rgba(255,255,255,0.4) 0%, transparent 70%); transform: rotate(30deg); pointer-events: none; animation: rotateLight 20s linear infinite; }
-        @keyframes rotateLight { from { transform: rotate(0deg); } to { transform: rotate(360deg); } }
-        .glass-overlay { position: absolute; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0,0,0,0.9); backdrop-filter: blur(10px); display: flex; flex-direction: column; align-items: center; justify-content: center; border-radius: 20px; z-index: 10; animation: overlayAppear 0.5s ease-out; }
-        @keyframes overlayAppear { from { opacity: 0; backdrop-filter: blur(0); } to { opacity: 1; backdrop-filter: blur(10px); } }
-        .unlock-btn { background: linear-gradient(135deg, var(--neon-pink), var(--neon-purple), var(--neon-blue)); color: white; border: none; padding: 18px 40px; border-radius: 35px; font-weight: 800; font-size: 18px; cursor: pointer; display: inline-flex; align-items: center; gap: 12px; font-family: 'Orbitron', monospace; box-shadow: 0 8px 25px rgba(0,243,255,0.5), inset 0 1px 0 rgba(255,255,255,0.3); margin-top: 20px; position: relative; overflow: hidden; transition: all 0.3s; animation: buttonPulse 2s infinite; }
-        @keyframes buttonPulse { 0%, 100% { box-shadow: 0 8px 25px rgba(0,243,255,0.5), inset 0 1px 0 rgba(255,255,255,0.3); } 50% { box-shadow: 0 8px 35px rgba(0,243,255,0.7), inset 0 1px 0 rgba(255,255,255,0.5); } }
-        .unlock-btn::before { content: ''; position: absolute; top: 0; left: -100%; width: 100%; height: 100%; background: linear-gradient(90deg, transparent, rgba(255,255,255,0.4), transparent); transition: left 0.7s; }
-        .unlock-btn:hover::before { left: 100%; }
-        .unlock-btn:active { transform: scale(0.95); animation: none; }
-        .card-silver { background: linear-gradient(135deg, #c0c0c0 0%, #d0d0d0 30%, #e0e0e0 50%, #d0d0d0 70%, #c0c0c0 100%); border: 2px solid #fff; box-shadow: 0 15px 30px rgba(0,0,0,0.4); color: #222; text-align: center; aspect-ratio: 16/9; display: flex; flex-direction: column; justify-content: center; align-items: center; animation: silverShimmer 3s infinite alternate; }
-        @keyframes silverShimmer { from { background: linear-gradient(135deg, #c0c0c0 0%, #d0d0d0 30%, #e0e0e0 50%, #d0d0d0 70%, #c0c0c0 100%); } to { background: linear-gradient(135deg, #d0d0d0 0%, #e0e0e0 30%, #f0f0f0 50%, #e0e0e0 70%, #d0d0d0 100%); } }
-        .card-purple { background: linear-gradient(135deg, var(--neon-purple) 0%, #7b2cbf 50%, #5a189a 100%); border: 2px solid #c77dff; box-shadow: 0 0 30px rgba(157,78,221,0.7), inset 0 0 15px rgba(255,255,255,0.2); color: white; text-align: center; aspect-ratio: 16/9; display: flex; flex-direction: column; justify-content: center; align-items: center; position: relative; padding: 25px; animation: neonPulse 2s infinite alternate; }
-        @keyframes neonPulse { from { box-shadow: 0 0 30px rgba(157,78,221,0.7), inset 0 0 15px rgba(255,255,255,0.2); } to { box-shadow: 0 0 45px rgba(157,78,221,0.9), inset 0 0 20px rgba(255,255,255,0.3); } }
-        .card-purple::before { content: ''; position: absolute; top: -15px; left: -15px; right: -15px; bottom: -15px; background: linear-gradient(45deg, var(--neon-purple), #7b2cbf, #5a189a, var(--neon-purple)); z-index: -1; border-radius: 25px; opacity: 0.6; filter: blur(15px); animation: borderGlow 3s infinite alternate; }
-        @keyframes borderGlow { from { opacity: 0.4; filter: blur(12px); } to { opacity: 0.7; filter: blur(18px); } }
-        .btn { background: linear-gradient(135deg, #111, #222); color: var(--gold); border: none; padding: 16px 35px; border-radius: 35px; font-weight: 800; font-size: 18px; margin-top: 20px; cursor: pointer; display: inline-flex; align-items: center; justify-content: center; gap: 12px; font-family: 'Orbitron', monospace; box-shadow: 0 8px 20px rgba(0,0,0,0.4), inset 0 1px 0 rgba(255,255,255,0.1); transition: all 0.3s cubic-bezier(0.4, 0, 0.2, 1); position: relative; z-index: 5; overflow: hidden; }
-        .btn::before { content: ''; position: absolute; top: 0; left: -100%; width: 100%; height: 100%; background: linear-gradient(90deg, transparent, rgba(255,215,0,0.3), transparent); transition: left 0.7s; }
-        .btn:hover::before { left: 100%; }
-        .btn:active { transform: scale(0.95); }
-        .btn-purple { background: linear-gradient(135deg, #5a189a, var(--neon-purple)); color: white; }
-        .btn-cyan { background: linear-gradient(135deg, #00f3ff, #0088ff); color: #000; }
-        .popup { position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0,0,0,0.98); backdrop-filter: blur(15px); display: none; justify-content: center; align-items: center; z-index: 9999; padding: 20px; animation: popupAppear 0.3s ease-out; }
-        @keyframes popupAppear { from { opacity: 0; backdrop-filter: blur(0); } to { opacity: 1; backdrop-filter: blur(15px); } }
-        .popup-content { background: linear-gradient(135deg, #1a1a20, #2a2a30); padding: 35px; border-radius: 25px; width: 100%; max-width: 400px; border: 2px solid var(--cyan); text-align: center; box-shadow: 0 0 40px rgba(0,243,255,0.3), inset 0 0 20px rgba(0,243,255,0.1); animation: contentAppear 0.4s ease-out; }
-        @keyframes contentAppear { from { transform: scale(0.8); opacity: 0; } to { transform: scale(1); opacity: 1; } }
-        .popup-content h3 { margin-top: 0; color: var(--cyan); font-size: 24px; font-family: 'Orbitron', monospace; text-shadow: 0 0 15px rgba(0,243,255,0.7); }
-        input, textarea { width: 100%; padding: 15px; margin: 12px 0; background: rgba(42,42,48,0.8); border: 2px solid #444; color: white; border-radius: 12px; font-family: inherit; font-size: 16px; transition: all 0.3s; }
-        input:focus, textarea:focus { outline: none; border-color: var(--cyan); box-shadow: 0 0 15px rgba(0,243,255,0.3); background: rgba(42,42,48,1); }
-        .hist-item { background: var(--panel); border-radius: 12px; padding: 15px; margin-bottom: 10px; display: flex; justify-content: space-between; border-left: 5px solid #333; width: 100%; transition: all 0.3s; animation: itemAppear 0.5s ease-out; }
-        @keyframes itemAppear { from { opacity: 0; transform: translateX(-20px); } to { opacity: 1; transform: translateX(0); } }
-        .hist-item:hover { transform: translateX(5px); box-shadow: 0 5px 15px rgba(0,0,0,0.3); }
-        .status-completed { color: var(--neon-green); text-shadow: 0 0 10px rgba(0,255,170,0.5); } 
-        .status-pending { color: orange; text-shadow: 0 0 10px rgba(255,165,0,0.5); } 
-        .status-rejected { color: red; text-shadow: 0 0 10px rgba(255,0,0,0.5); }
-        .overlay-loader { position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0,0,0,0.98); z-index: 2000; display: flex; flex-direction: column; justify-content: center; align-items: center; }
-        .spinner { width: 60px; height: 60px; border: 6px solid #333; border-top: 6px solid var(--cyan); border-radius: 50%; animation: spin 1s linear infinite; margin: 25px; box-shadow: 0 0 20px rgba(0,243,255,0.5); }
-        @keyframes spin { to { transform: rotate(360deg); } }
-        .refer-code-box { background: rgba(255,255,255,0.15); border: 3px dashed var(--cyan); padding: 20px 15px; border-radius: 15px; margin: 15px 0; font-family: 'Orbitron', monospace; font-size: 28px; letter-spacing: 4px; cursor: pointer; text-align: center; word-break: break-all; margin-left: 25px; margin-right: 25px; transition: all 0.3s; animation: codePulse 2s infinite alternate; }
-        @keyframes codePulse { from { box-shadow: 0 0 20px rgba(0,243,255,0.3); } to { box-shadow: 0 0 30px rgba(0,243,255,0.6); } }
-        .refer-code-box:hover { transform: scale(1.05); background: rgba(255,255,255,0.2); }
-        .leaderboard-table { width: 100%; border-collapse: collapse; margin-top: 20px; font-size: 15px; border-radius: 15px; overflow: hidden; }
-        .leaderboard-table tr { border-bottom: 1px solid rgba(255,255,255,0.15); transition: background 0.3s; }
-        .leaderboard-table tr:hover { background: rgba(0,243,255,0.1); }
-        .leaderboard-table td { padding: 12px 8px; }
-        .leaderboard-table .highlight { background: rgba(0,243,255,0.2); border-left: 5px solid var(--cyan); animation: highlightPulse 2s infinite alternate; }
-        @keyframes highlightPulse { from { background: rgba(0,243,255,0.2); } to { background: rgba(0,243,255,0.3); } }
-        .code-input { font-size: 28px; letter-spacing: 8px; text-align: center; text-transform: uppercase; width: 100%; margin: 15px 0; padding: 20px; border-radius: 15px; border: 3px solid silver; background: white; color: #222; font-family: 'Orbitron', monospace; box-shadow: 0 0 20px rgba(192,192,192,0.5); transition: all 0.3s; }
-        .code-input:focus { outline: none; border-color: var(--cyan); box-shadow: 0 0 30px rgba(0,243,255,0.7); }
-        .gift-result { text-align: center; margin-top: 25px; padding: 20px; border-radius: 15px; background: rgba(0,0,0,0.4); backdrop-filter: blur(10px); animation: resultAppear 0.5s ease-out; }
-        @keyframes resultAppear { from { opacity: 0; transform: translateY(20px); } to { opacity: 1; transform: translateY(0); } }
-        .referrals-list { max-height: 350px; overflow-y: auto; padding-right: 8px; }
-        .referrals-list::-webkit-scrollbar { width: 8px; }
-        .referrals-list::-webkit-scrollbar-track { background: rgba(255,255,255,0.1); border-radius: 4px; }
-        .referrals-list::-webkit-scrollbar-thumb { background: var(--cyan); border-radius: 4px; box-shadow: inset 0 0 6px rgba(0,0,0,0.3); }
-        .verify-popup { z-index: 10000; }
-        .verify-popup .popup-content { max-width: 450px; }
-        .verify-actions { display: flex; gap: 15px; margin-top: 25px; }
-        .verify-actions button { flex: 1; }
-        .balance-loading { font-size: 56px; font-weight: 900; margin: 8px 0; text-shadow: 0 3px 8px rgba(0,0,0,0.3); color: #666; }
-        .skeleton { background: linear-gradient(90deg, #333 25%, #444 50%, #333 75%); background-size: 200% 100%; animation: loading 1.5s infinite; border-radius: 10px; }
-        @keyframes loading { 0% { background-position: 200% 0; } 100% { background-position: -200% 0; } }
-        .action-loading { display: none; position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0,0,0,0.95); z-index: 99999; justify-content: center; align-items: center; flex-direction: column; }
-        .action-loader { font-size: 18px; color: white; margin-top: 20px; font-weight: bold; font-family: 'Orbitron', monospace; }
-        .toast { position: fixed; bottom: 25px; left: 50%; transform: translateX(-50%); background: #333; color: white; padding: 15px 30px; border-radius: 12px; z-index: 10000; display: none; box-shadow: 0 6px 20px rgba(0,0,0,0.4); animation: toastSlide 0.3s ease-out; }
-        @keyframes toastSlide { from { transform: translateX(-50%) translateY(30px); opacity: 0; } to { transform: translateX(-50%) translateY(0); opacity: 1; } }
-        .toast-success { background: linear-gradient(135deg, #28a745, #20c997); }
-        .toast-error { background: linear-gradient(135deg, #dc3545, #fd7e14); }
-        .toast-info { background: linear-gradient(135deg, #17a2b8, #0dcaf0); }
-        .progress-bar { width: 100%; height: 6px; background: #333; border-radius: 3px; overflow: hidden; margin-top: 15px; }
-        .progress-fill { height: 100%; background: linear-gradient(90deg, #00f3ff, #0088ff, var(--neon-pink)); width: 0%; transition: width 0.4s cubic-bezier(0.4, 0, 0.2, 1); }
-        .verification-success { color: var(--neon-green); font-weight: bold; margin: 15px 0; font-size: 18px; text-shadow: 0 0 15px rgba(0,255,170,0.7); }
-        .verification-error { color: #ff4444; font-weight: bold; margin: 15px 0; font-size: 18px; text-shadow: 0 0 15px rgba(255,68,68,0.7); }
-        .loading-screen { position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: radial-gradient(circle at top, #111122, #050508); display: flex; flex-direction: column; justify-content: center; align-items: center; z-index: 99999; }
-        .loading-logo { width: 100px; height: 100px; border-radius: 50%; border: 4px solid var(--cyan); box-shadow: 0 0 30px rgba(0,243,255,0.8), inset 0 0 20px rgba(0,243,255,0.3); margin-bottom: 30px; animation: pulse 2s infinite alternate, rotate 20s linear infinite; }
-        @keyframes pulse { 0%, 100% { transform: scale(1) rotate(0deg); opacity: 1; } 50% { transform: scale(1.1) rotate(180deg); opacity: 0.9; } }
-        @keyframes rotate { from { transform: rotate(0deg); } to { transform: rotate(360deg); } }
-        .loading-text { color: var(--cyan); font-size: 22px; font-weight: bold; margin-top: 25px; font-family: 'Orbitron', monospace; text-shadow: 0 0 20px rgba(0,243,255,0.8); animation: textFlow 3s infinite alternate; }
-        @keyframes textFlow { from { letter-spacing: 2px; } to { letter-spacing: 4px; } }
-        .resource-bar { width: 85%; max-width: 350px; margin-top: 25px; }
-        .resource-text { color: #888; font-size: 14px; margin-top: 8px; font-family: 'Rajdhani', sans-serif; }
-        .verification-steps { background: rgba(255,255,255,0.08); border-radius: 15px; padding: 20px; margin-top: 20px; max-height: 250px; overflow-y: auto; backdrop-filter: blur(10px); }
-        .step-item { display: flex; align-items: center; gap: 15px; margin: 8px 0; padding: 12px; border-radius: 10px; background: rgba(255,255,255,0.05); transition: all 0.3s; animation: stepAppear 0.5s ease-out; }
-        @keyframes stepAppear { from { opacity: 0; transform: translateX(-20px); } to { opacity: 1; transform: translateX(0); } }
-        .step-checking { color: #ffaa00; }
-        .step-passed { color: var(--neon-green); }
-        .step-failed { color: #ff4444; }
-        .step-pending { color: #0088ff; }
-        .step-icon { font-size: 18px; width: 25px; text-align: center; }
-        .private-channel-info { background: rgba(0,136,255,0.15); border: 2px solid #0088ff; border-radius: 12px; padding: 15px; margin: 15px 0; animation: infoPulse 3s infinite alternate; }
-        @keyframes infoPulse { from { box-shadow: 0 0 15px rgba(0,136,255,0.3); } to { box-shadow: 0 0 25px rgba(0,136,255,0.6); } }
-        .device-error-retry { margin-top: 20px; }
-        .floating-particles { position: fixed; top: 0; left: 0; width: 100%; height: 100%; pointer-events: none; z-index: -1; }
-        .floating-coin { position: absolute; font-size: 24px; color: var(--gold); opacity: 0.7; animation: floatCoin 20s infinite linear; }
-        @keyframes floatCoin { 0% { transform: translateY(100vh) rotate(0deg); } 100% { transform: translateY(-100px) rotate(360deg); } }
-        .glitch-text { position: relative; animation: glitch 3s infinite; }
-        @keyframes glitch { 0%, 100% { text-shadow: 2px 2px 0 var(--neon-pink), -2px -2px 0 var(--neon-blue); } 50% { text-shadow: -2px 2px 0 var(--neon-blue), 2px -2px 0 var(--neon-pink); } }
-        .neon-border { position: relative; }
-        .neon-border::after { content: ''; position: absolute; top: -2px; left: -2px; right: -2px; bottom: -2px; border-radius: inherit; background: linear-gradient(45deg, var(--neon-pink), var(--neon-blue), var(--neon-green), var(--neon-purple)); z-index: -1; opacity: 0.7; filter: blur(5px); animation: borderRotate 4s linear infinite; }
-        @keyframes borderRotate { from { filter: hue-rotate(0deg) blur(5px); } to { filter: hue-rotate(360deg) blur(5px); } }
-        .typing-effect { overflow: hidden; border-right: 3px solid var(--cyan); white-space: nowrap; animation: typing 3.5s steps(40, end), blink-caret 0.75s step-end infinite; }
-        @keyframes typing { from { width: 0; } to { width: 100%; } }
-        @keyframes blink-caret { from, to { border-color: transparent; } 50% { border-color: var(--cyan); } }
-        .balance-number { font-family: 'Orbitron', monospace; font-size: 56px; font-weight: 900; margin: 10px 0; text-shadow: 0 0 20px rgba(255,215,0,0.8), 0 0 40px rgba(255,215,0,0.4); background: linear-gradient(45deg, #ffd700, #ffaa00, #ffd700); -webkit-background-clip: text; -webkit-text-fill-color: transparent; animation: balanceGlow 2s infinite alternate; }
-        @keyframes balanceGlow { from { text-shadow: 0 0 20px rgba(255,215,0,0.8), 0 0 40px rgba(255,215,0,0.4); } to { text-shadow: 0 0 30px rgba(255,215,0,1), 0 0 60px rgba(255,215,0,0.6), 0 0 90px rgba(255,215,0,0.3); } }
-        .channel-button { background: linear-gradient(135deg, #1a1a1a, #2a2a2a); border: 2px solid var(--cyan); border-radius: 15px; padding: 12px 20px; margin: 8px 0; display: flex; align-items: center; justify-content: space-between; cursor: pointer; transition: all 0.3s; animation: buttonAppear 0.6s ease-out; }
-        .channel-button:hover { transform: translateX(5px); background: linear-gradient(135deg, #2a2a2a, #3a3a3a); box-shadow: 0 0 20px rgba(0,243,255,0.4); }
-        .channel-button i { font-size: 20px; color: var(--cyan); }
-        .channel-button.disabled { opacity: 0.5; border-color: #888; }
-        .channel-button.disabled i { color: #888; }
-        .channel-button.disabled:hover { transform: none; box-shadow: none; }
-        .scan-line { position: absolute; top: 0; left: 0; width: 100%; height: 3px; background: linear-gradient(90deg, transparent, var(--cyan), transparent); animation: scan 3s infinite linear; }
-        @keyframes scan { 0% { top: 0; } 100% { top: 100%; } }
-        .holographic-effect { background: linear-gradient(45deg, rgba(0,243,255,0.1), rgba(157,78,221,0.1), rgba(255,0,255,0.1)); background-size: 400% 400%; animation: holographic 8s ease infinite; }
-        @keyframes holographic { 0% { background-position: 0% 50%; } 50% { background-position: 100% 50%; } 100% { background-position: 0% 50%; } }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('mini_app.css') }}">
 </head>
 <body>
     <div id="particles-container" class="floating-particles"></div>
@@ -1569,7 +4551,7 @@ MINI_APP_TEMPLATE = """
         
         <div id="tab-home" class="tab-content">
             <div class="card-metal">
-                <div class="p-pic-wrapper"><img src="/get_pfp?uid={{ user_id }}&v={{ timestamp }}" class="p-pic" onerror="this.style.display='none'; this.nextElementSibling.style.display='flex';"><div class="p-icon"><i class="fas fa-user"></i></div></div>
+                <div class="p-pic-wrapper"><img src="/get_pfp?uid={{ user_id }}" class="p-pic" onerror="this.style.display='none'; this.nextElementSibling.style.display='flex';"><div class="p-icon"><i class="fas fa-user"></i></div></div>
                 <div style="z-index:2;">
                     <div style="font-size:22px; font-weight:800; color: #222;">{{ user.name }}</div>
                     <div onclick="openPop('contact')" style="color:#0044cc; font-size:14px; margin-top:8px; cursor:pointer; text-decoration:underline; font-weight:bold;">Contact Admin</div>
@@ -1712,6 +4694,176 @@ MINI_APP_TEMPLATE = """
         const IS_VERIFIED = {{ user.verified|lower }};
         const DEVICE_VERIFIED = {{ user.device_verified|lower }};
         const HIDE_VERIFY_BUTTON = {{ settings.hide_verify_button|lower }};
+        const BOT_NAME = "{{ settings.bot_name }}";
+    </script>
+    <script src="{{ asset_url('mini_app.js') }}"></script>
+</body>
+</html>
+"""
+
+# Static parts of the mini app, built into static/assets (see build_assets)
+MINI_APP_CSS = """
+        :root { 
+            --bg: #050508; 
+            --cyan: #00f3ff; 
+            --gold: #ffd700; 
+            --panel: rgba(255,255,255,0.05); 
+            --neon-pink: #ff00ff;
+            --neon-blue: #00ccff;
+            --neon-green: #00ffaa;
+            --neon-purple: #9d4edd;
+        }
+        * { box-sizing: border-box; margin: 0; padding: 0; }
+        body { background: radial-gradient(circle at top, #111122, var(--bg)); color: white; font-family: 'Poppins', sans-serif; margin: 0; padding: 0; min-height: 100vh; overflow-x: hidden; }
+        .hidden { display: none !important; }
+        .header { display: flex; align-items: center; justify-content: center; gap: 20px; margin: 20px 0; width: 100%; padding: 0 5%; animation: fadeInDown 0.8s ease-out; }
+        @keyframes fadeInDown { from { opacity: 0; transform: translateY(-30px); } to { opacity: 1; transform: translateY(0); } }
+        .logo { width: 70px; height: 70px; border-radius: 50%; border: 3px solid var(--cyan); box-shadow: 0 0 25px rgba(0,243,255,0.7), inset 0 0 15px rgba(0,243,255,0.3); object-fit: cover; animation: pulseLogo 3s infinite alternate; }
+        @keyframes pulseLogo { 0% { box-shadow: 0 0 25px rgba(0,243,255,0.7), inset 0 0 15px rgba(0,243,255,0.3); } 100% { box-shadow: 0 0 40px rgba(0,243,255,0.9), inset 0 0 20px rgba(0,243,255,0.5); } }
+        .title { font-size: 26px; font-weight: 800; text-shadow: 0 0 15px var(--cyan), 0 0 30px rgba(0,243,255,0.5); letter-spacing: 2px; font-family: 'Orbitron', monospace; background: linear-gradient(45deg, var(--cyan), var(--neon-blue)); -webkit-background-clip: text; -webkit-text-fill-color: transparent; animation: textGlow 2s infinite alternate; }
+        @keyframes textGlow { from { text-shadow: 0 0 15px var(--cyan), 0 0 30px rgba(0,243,255,0.5); } to { text-shadow: 0 0 20px var(--cyan), 0 0 40px rgba(0,243,255,0.7), 0 0 60px rgba(0,243,255,0.3); } }
+        .nav-bar { display: flex; width: 100%; max-width: 550px; background: rgba(0,0,0,0.8); border-radius: 20px; margin: 15px auto; padding: 8px; justify-content: space-around; border: 1px solid rgba(255,255,255,0.1); backdrop-filter: blur(10px); animation: slideUp 0.6s ease-out; }
+        @keyframes slideUp { from { opacity: 0; transform: translateY(30px); } to { opacity: 1; transform: translateY(0); } }
+        .nav-btn { background: transparent; border: none; color: #aaa; padding: 12px 5px; border-radius: 15px; font-weight: bold; font-size: 14px; display: flex; flex-direction: column; align-items: center; gap: 5px; cursor: pointer; transition: all 0.3s cubic-bezier(0.4, 0, 0.2, 1); width: 25%; position: relative; overflow: hidden; }
+        .nav-btn i { font-size: 24px; transition: all 0.3s; }
+        .nav-text { font-size: 11px; margin-top: 3px; color: #888; transition: all 0.3s; font-family: 'Rajdhani', sans-serif; }
+        .nav-btn::before { content: ''; position: absolute; top: 0; left: -100%; width: 100%; height: 100%; background: linear-gradient(90deg, transparent, rgba(255,255,255,0.2), transparent); transition: left 0.7s; }
+        .nav-btn:hover::before { left: 100%; }
+        .nav-btn.active { background: linear-gradient(135deg, rgba(0,243,255,0.2), rgba(0,136,255,0.2)); color: var(--cyan); box-shadow: 0 0 20px rgba(0,243,255,0.5), inset 0 1px 0 rgba(255,255,255,0.2); border: 1px solid rgba(0,243,255,0.3); transform: translateY(-3px); }
+        .nav-btn.active .nav-text { color: var(--cyan); text-shadow: 0 0 10px rgba(0,243,255,0.5); }
+        .nav-btn.active i { transform: scale(1.2); filter: drop-shadow(0 0 8px rgba(0,243,255,0.7)); }
+        .tab-content { width: 100%; max-width: 550px; padding: 0 5% 30px 5%; animation: fadeIn 0.5s ease-out; }
+        @keyframes fadeIn { from { opacity: 0; } to { opacity: 1; } }
+        .card-metal, .card-gold, .card-silver, .card-purple { width: 100%; border-radius: 20px; padding: 30px; margin-bottom: 25px; position: relative; overflow: hidden; animation: cardAppear 0.6s ease-out; }
+        @keyframes cardAppear { from { opacity: 0; transform: scale(0.9); } to { opacity: 1; transform: scale(1); } }
+        .card-metal { background: linear-gradient(135deg, #e0e0e0 0%, #bdc3c7 20%, #88929e 50%, #bdc3c7 80%, #e0e0e0 100%); border: 2px solid #fff; box-shadow: 0 15px 30px rgba(0,0,0,0.6), inset 0 0 20px rgba(255,255,255,0.7); display: flex; align-items: center; color: #222; animation: metalShine 4s infinite; }
+        @keyframes metalShine { 0%, 100% { background: linear-gradient(135deg, #e0e0e0 0%, #bdc3c7 20%, #88929e 50%, #bdc3c7 80%, #e0e0e0 100%); } 50% { background: linear-gradient(135deg, #f0f0f0 0%, #d0d0d0 20%, #a0a0a0 50%, #d0d0d0 80%, #f0f0f0 100%); } }
+        .card-metal::before { content: ''; position: absolute; top: 0; left: -150%; width: 60%; height: 100%; background: linear-gradient(90deg, transparent, rgba(255,255,255,0.9), transparent); animation: shine 3.5s infinite; transform: skewX(-20deg); }
+        @keyframes shine { 100% { left: 200%; } }
+        .p-pic-wrapper { position: relative; width: 80px; height: 80px; margin-right: 20px; z-index: 2; flex-shrink: 0; }
+        .p-pic { width: 100%; height: 100%; border-radius: 50%; border: 4px solid #333; object-fit: cover; box-shadow: 0 5px 15px rgba(0,0,0,0.5); transition: transform 0.5s; }
+        .p-pic:hover { transform: rotate(15deg) scale(1.05); }
+        .p-icon { display: none; width: 100%; height: 100%; border-radius: 50%; border: 4px solid #333; background: linear-gradient(135deg, #ddd, #aaa); align-items: center; justify-content: center; font-size: 32px; color: #333; }
+        .card-gold { background: radial-gradient(ellipse at center, #ffd700 0%, #d4af37 40%, #b8860b 100%); text-align: center; color: #2e2003; border: 3px solid #fff2ad; box-shadow: 0 0 35px rgba(255, 215, 0, 0.6), inset 0 0 15px rgba(255, 255, 255, 0.6); animation: pulseGold 3s infinite alternate, floatCard 6s infinite ease-in-out; position: relative; }
+        @keyframes pulseGold { 0% { box-shadow: 0 0 35px rgba(255,215,0,0.6), inset 0 0 15px rgba(255,255,255,0.6); } 100% { box-shadow: 0 0 50px rgba(255,215,0,0.8), inset 0 0 25px rgba(255,255,255,0.8); } }
+        @keyframes floatCard { 0%, 100% { transform: translateY(0); } 50% { transform: translateY(-10px); } }
+        .card-gold::after { content: ''; position: absolute; top: -50%; left: -50%; width: 200%; height: 200%; background: radial-gradient(circle, rgba(255,255,255,0.4) 0%, transparent 70%); transform: rotate(30deg); pointer-events: none; animation: rotateLight 20s linear infinite; }
+        @keyframes rotateLight { from { transform: rotate(0deg); } to { transform: rotate(360deg); } }
+        .glass-overlay { position: absolute; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0,0,0,0.9); backdrop-filter: blur(10px); display: flex; flex-direction: column; align-items: center; justify-content: center; border-radius: 20px; z-index: 10; animation: overlayAppear 0.5s ease-out; }
+        @keyframes overlayAppear { from { opacity: 0; backdrop-filter: blur(0); } to { opacity: 1; backdrop-filter: blur(10px); } }
+        .unlock-btn { background: linear-gradient(135deg, var(--neon-pink), var(--neon-purple), var(--neon-blue)); color: white; border: none; padding: 18px 40px; border-radius: 35px; font-weight: 800; font-size: 18px; cursor: pointer; display: inline-flex; align-items: center; gap: 12px; font-family: 'Orbitron', monospace; box-shadow: 0 8px 25px rgba(0,243,255,0.5), inset 0 1px 0 rgba(255,255,255,0.3); margin-top: 20px; position: relative; overflow: hidden; transition: all 0.3s; animation: buttonPulse 2s infinite; }
+        @keyframes buttonPulse { 0%, 100% { box-shadow: 0 8px 25px rgba(0,243,255,0.5), inset 0 1px 0 rgba(255,255,255,0.3); } 50% { box-shadow: 0 8px 35px rgba(0,243,255,0.7), inset 0 1px 0 rgba(255,255,255,0.5); } }
+        .unlock-btn::before { content: ''; position: absolute; top: 0; left: -100%; width: 100%; height: 100%; background: linear-gradient(90deg, transparent, rgba(255,255,255,0.4), transparent); transition: left 0.7s; }
+        .unlock-btn:hover::before { left: 100%; }
+        .unlock-btn:active { transform: scale(0.95); animation: none; }
+        .card-silver { background: linear-gradient(135deg, #c0c0c0 0%, #d0d0d0 30%, #e0e0e0 50%, #d0d0d0 70%, #c0c0c0 100%); border: 2px solid #fff; box-shadow: 0 15px 30px rgba(0,0,0,0.4); color: #222; text-align: center; aspect-ratio: 16/9; display: flex; flex-direction: column; justify-content: center; align-items: center; animation: silverShimmer 3s infinite alternate; }
+        @keyframes silverShimmer { from { background: linear-gradient(135deg, #c0c0c0 0%, #d0d0d0 30%, #e0e0e0 50%, #d0d0d0 70%, #c0c0c0 100%); } to { background: linear-gradient(135deg, #d0d0d0 0%, #e0e0e0 30%, #f0f0f0 50%, #e0e0e0 70%, #d0d0d0 100%); } }
+        .card-purple { background: linear-gradient(135deg, var(--neon-purple) 0%, #7b2cbf 50%, #5a189a 100%); border: 2px solid #c77dff; box-shadow: 0 0 30px rgba(157,78,221,0.7), inset 0 0 15px rgba(255,255,255,0.2); color: white; text-align: center; aspect-ratio: 16/9; display: flex; flex-direction: column; justify-content: center; align-items: center; position: relative; padding: 25px; animation: neonPulse 2s infinite alternate; }
+        @keyframes neonPulse { from { box-shadow: 0 0 30px rgba(157,78,221,0.7), inset 0 0 15px rgba(255,255,255,0.2); } to { box-shadow: 0 0 45px rgba(157,78,221,0.9), inset 0 0 20px rgba(255,255,255,0.3); } }
+        .card-purple::before { content: ''; position: absolute; top: -15px; left: -15px; right: -15px; bottom: -15px; background: linear-gradient(45deg, var(--neon-purple), #7b2cbf, #5a189a, var(--neon-purple)); z-index: -1; border-radius: 25px; opacity: 0.6; filter: blur(15px); animation: borderGlow 3s infinite alternate; }
+        @keyframes borderGlow { from { opacity: 0.4; filter: blur(12px); } to { opacity: 0.7; filter: blur(18px); } }
+        .btn { background: linear-gradient(135deg, #111, #222); color: var(--gold); border: none; padding: 16px 35px; border-radius: 35px; font-weight: 800; font-size: 18px; margin-top: 20px; cursor: pointer; display: inline-flex; align-items: center; justify-content: center; gap: 12px; font-family: 'Orbitron', monospace; box-shadow: 0 8px 20px rgba(0,0,0,0.4), inset 0 1px 0 rgba(255,255,255,0.1); transition: all 0.3s cubic-bezier(0.4, 0, 0.2, 1); position: relative; z-index: 5; overflow: hidden; }
+        .btn::before { content: ''; position: absolute; top: 0; left: -100%; width: 100%; height: 100%; background: linear-gradient(90deg, transparent, rgba(255,215,0,0.3), transparent); transition: left 0.7s; }
+        .btn:hover::before { left: 100%; }
+        .btn:active { transform: scale(0.95); }
+        .btn-purple { background: linear-gradient(135deg, #5a189a, var(--neon-purple)); color: white; }
+        .btn-cyan { background: linear-gradient(135deg, #00f3ff, #0088ff); color: #000; }
+        .popup { position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0,0,0,0.98); backdrop-filter: blur(15px); display: none; justify-content: center; align-items: center; z-index: 9999; padding: 20px; animation: popupAppear 0.3s ease-out; }
+        @keyframes popupAppear { from { opacity: 0; backdrop-filter: blur(0); } to { opacity: 1; backdrop-filter: blur(15px); } }
+        .popup-content { background: linear-gradient(135deg, #1a1a20, #2a2a30); padding: 35px; border-radius: 25px; width: 100%; max-width: 400px; border: 2px solid var(--cyan); text-align: center; box-shadow: 0 0 40px rgba(0,243,255,0.3), inset 0 0 20px rgba(0,243,255,0.1); animation: contentAppear 0.4s ease-out; }
+        @keyframes contentAppear { from { transform: scale(0.8); opacity: 0; } to { transform: scale(1); opacity: 1; } }
+        .popup-content h3 { margin-top: 0; color: var(--cyan); font-size: 24px; font-family: 'Orbitron', monospace; text-shadow: 0 0 15px rgba(0,243,255,0.7); }
+        input, textarea { width: 100%; padding: 15px; margin: 12px 0; background: rgba(42,42,48,0.8); border: 2px solid #444; color: white; border-radius: 12px; font-family: inherit; font-size: 16px; transition: all 0.3s; }
+        input:focus, textarea:focus { outline: none; border-color: var(--cyan); box-shadow: 0 0 15px rgba(0,243,255,0.3); background: rgba(42,42,48,1); }
+        .hist-item { background: var(--panel); border-radius: 12px; padding: 15px; margin-bottom: 10px; display: flex; justify-content: space-between; border-left: 5px solid #333; width: 100%; transition: all 0.3s; animation: itemAppear 0.5s ease-out; }
+        @keyframes itemAppear { from { opacity: 0; transform: translateX(-20px); } to { opacity: 1; transform: translateX(0); } }
+        .hist-item:hover { transform: translateX(5px); box-shadow: 0 5px 15px rgba(0,0,0,0.3); }
+        .status-completed { color: var(--neon-green); text-shadow: 0 0 10px rgba(0,255,170,0.5); } 
+        .status-pending { color: orange; text-shadow: 0 0 10px rgba(255,165,0,0.5); } 
+        .status-rejected { color: red; text-shadow: 0 0 10px rgba(255,0,0,0.5); }
+        .overlay-loader { position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0,0,0,0.98); z-index: 2000; display: flex; flex-direction: column; justify-content: center; align-items: center; }
+        .spinner { width: 60px; height: 60px; border: 6px solid #333; border-top: 6px solid var(--cyan); border-radius: 50%; animation: spin 1s linear infinite; margin: 25px; box-shadow: 0 0 20px rgba(0,243,255,0.5); }
+        @keyframes spin { to { transform: rotate(360deg); } }
+        .refer-code-box { background: rgba(255,255,255,0.15); border: 3px dashed var(--cyan); padding: 20px 15px; border-radius: 15px; margin: 15px 0; font-family: 'Orbitron', monospace; font-size: 28px; letter-spacing: 4px; cursor: pointer; text-align: center; word-break: break-all; margin-left: 25px; margin-right: 25px; transition: all 0.3s; animation: codePulse 2s infinite alternate; }
+        @keyframes codePulse { from { box-shadow: 0 0 20px rgba(0,243,255,0.3); } to { box-shadow: 0 0 30px rgba(0,243,255,0.6); } }
+        .refer-code-box:hover { transform: scale(1.05); background: rgba(255,255,255,0.2); }
+        .leaderboard-table { width: 100%; border-collapse: collapse; margin-top: 20px; font-size: 15px; border-radius: 15px; overflow: hidden; }
+        .leaderboard-table tr { border-bottom: 1px solid rgba(255,255,255,0.15); transition: background 0.3s; }
+        .leaderboard-table tr:hover { background: rgba(0,243,255,0.1); }
+        .leaderboard-table td { padding: 12px 8px; }
+        .leaderboard-table .highlight { background: rgba(0,243,255,0.2); border-left: 5px solid var(--cyan); animation: highlightPulse 2s infinite alternate; }
+        @keyframes highlightPulse { from { background: rgba(0,243,255,0.2); } to { background: rgba(0,243,255,0.3); } }
+        .code-input { font-size: 28px; letter-spacing: 8px; text-align: center; text-transform: uppercase; width: 100%; margin: 15px 0; padding: 20px; border-radius: 15px; border: 3px solid silver; background: white; color: #222; font-family: 'Orbitron', monospace; box-shadow: 0 0 20px rgba(192,192,192,0.5); transition: all 0.3s; }
+        .code-input:focus { outline: none; border-color: var(--cyan); box-shadow: 0 0 30px rgba(0,243,255,0.7); }
+        .gift-result { text-align: center; margin-top: 25px; padding: 20px; border-radius: 15px; background: rgba(0,0,0,0.4); backdrop-filter: blur(10px); animation: resultAppear 0.5s ease-out; }
+        @keyframes resultAppear { from { opacity: 0; transform: translateY(20px); } to { opacity: 1; transform: translateY(0); } }
+        .referrals-list { max-height: 350px; overflow-y: auto; padding-right: 8px; }
+        .referrals-list::-webkit-scrollbar { width: 8px; }
+        .referrals-list::-webkit-scrollbar-track { background: rgba(255,255,255,0.1); border-radius: 4px; }
+        .referrals-list::-webkit-scrollbar-thumb { background: var(--cyan); border-radius: 4px; box-shadow: inset 0 0 6px rgba(0,0,0,0.3); }
+        .verify-popup { z-index: 10000; }
+        .verify-popup .popup-content { max-width: 450px; }
+        .verify-actions { display: flex; gap: 15px; margin-top: 25px; }
+        .verify-actions button { flex: 1; }
+        .balance-loading { font-size: 56px; font-weight: 900; margin: 8px 0; text-shadow: 0 3px 8px rgba(0,0,0,0.3); color: #666; }
+        .skeleton { background: linear-gradient(90deg, #333 25%, #444 50%, #333 75%); background-size: 200% 100%; animation: loading 1.5s infinite; border-radius: 10px; }
+        @keyframes loading { 0% { background-position: 200% 0; } 100% { background-position: -200% 0; } }
+        .action-loading { display: none; position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0,0,0,0.95); z-index: 99999; justify-content: center; align-items: center; flex-direction: column; }
+        .action-loader { font-size: 18px; color: white; margin-top: 20px; font-weight: bold; font-family: 'Orbitron', monospace; }
+        .toast { position: fixed; bottom: 25px; left: 50%; transform: translateX(-50%); background: #333; color: white; padding: 15px 30px; border-radius: 12px; z-index: 10000; display: none; box-shadow: 0 6px 20px rgba(0,0,0,0.4); animation: toastSlide 0.3s ease-out; }
+        @keyframes toastSlide { from { transform: translateX(-50%) translateY(30px); opacity: 0; } to { transform: translateX(-50%) translateY(0); opacity: 1; } }
+        .toast-success { background: linear-gradient(135deg, #28a745, #20c997); }
+        .toast-error { background: linear-gradient(135deg, #dc3545, #fd7e14); }
+        .toast-info { background: linear-gradient(135deg, #17a2b8, #0dcaf0); }
+        .progress-bar { width: 100%; height: 6px; background: #333; border-radius: 3px; overflow: hidden; margin-top: 15px; }
+        .progress-fill { height: 100%; background: linear-gradient(90deg, #00f3ff, #0088ff, var(--neon-pink)); width: 0%; transition: width 0.4s cubic-bezier(0.4, 0, 0.2, 1); }
+        .verification-success { color: var(--neon-green); font-weight: bold; margin: 15px 0; font-size: 18px; text-shadow: 0 0 15px rgba(0,255,170,0.7); }
+        .verification-error { color: #ff4444; font-weight: bold; margin: 15px 0; font-size: 18px; text-shadow: 0 0 15px rgba(255,68,68,0.7); }
+        .loading-screen { position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: radial-gradient(circle at top, #111122, #050508); display: flex; flex-direction: column; justify-content: center; align-items: center; z-index: 99999; }
+        .loading-logo { width: 100px; height: 100px; border-radius: 50%; border: 4px solid var(--cyan); box-shadow: 0 0 30px rgba(0,243,255,0.8), inset 0 0 20px rgba(0,243,255,0.3); margin-bottom: 30px; animation: pulse 2s infinite alternate, rotate 20s linear infinite; }
+        @keyframes pulse { 0%, 100% { transform: scale(1) rotate(0deg); opacity: 1; } 50% { transform: scale(1.1) rotate(180deg); opacity: 0.9; } }
+        @keyframes rotate { from { transform: rotate(0deg); } to { transform: rotate(360deg); } }
+        .loading-text { color: var(--cyan); font-size: 22px; font-weight: bold; margin-top: 25px; font-family: 'Orbitron', monospace; text-shadow: 0 0 20px rgba(0,243,255,0.8); animation: textFlow 3s infinite alternate; }
+        @keyframes textFlow { from { letter-spacing: 2px; } to { letter-spacing: 4px; } }
+        .resource-bar { width: 85%; max-width: 350px; margin-top: 25px; }
+        .resource-text { color: #888; font-size: 14px; margin-top: 8px; font-family: 'Rajdhani', sans-serif; }
+        .verification-steps { background: rgba(255,255,255,0.08); border-radius: 15px; padding: 20px; margin-top: 20px; max-height: 250px; overflow-y: auto; backdrop-filter: blur(10px); }
+        .step-item { display: flex; align-items: center; gap: 15px; margin: 8px 0; padding: 12px; border-radius: 10px; background: rgba(255,255,255,0.05); transition: all 0.3s; animation: stepAppear 0.5s ease-out; }
+        @keyframes stepAppear { from { opacity: 0; transform: translateX(-20px); } to { opacity: 1; transform: translateX(0); } }
+        .step-checking { color: #ffaa00; }
+        .step-passed { color: var(--neon-green); }
+        .step-failed { color: #ff4444; }
+        .step-pending { color: #0088ff; }
+        .step-icon { font-size: 18px; width: 25px; text-align: center; }
+        .private-channel-info { background: rgba(0,136,255,0.15); border: 2px solid #0088ff; border-radius: 12px; padding: 15px; margin: 15px 0; animation: infoPulse 3s infinite alternate; }
+        @keyframes infoPulse { from { box-shadow: 0 0 15px rgba(0,136,255,0.3); } to { box-shadow: 0 0 25px rgba(0,136,255,0.6); } }
+        .device-error-retry { margin-top: 20px; }
+        .floating-particles { position: fixed; top: 0; left: 0; width: 100%; height: 100%; pointer-events: none; z-index: -1; }
+        .floating-coin { position: absolute; font-size: 24px; color: var(--gold); opacity: 0.7; animation: floatCoin 20s infinite linear; }
+        @keyframes floatCoin { 0% { transform: translateY(100vh) rotate(0deg); } 100% { transform: translateY(-100px) rotate(360deg); } }
+        .glitch-text { position: relative; animation: glitch 3s infinite; }
+        @keyframes glitch { 0%, 100% { text-shadow: 2px 2px 0 var(--neon-pink), -2px -2px 0 var(--neon-blue); } 50% { text-shadow: -2px 2px 0 var(--neon-blue), 2px -2px 0 var(--neon-pink); } }
+        .neon-border { position: relative; }
+        .neon-border::after { content: ''; position: absolute; top: -2px; left: -2px; right: -2px; bottom: -2px; border-radius: inherit; background: linear-gradient(45deg, var(--neon-pink), var(--neon-blue), var(--neon-green), var(--neon-purple)); z-index: -1; opacity: 0.7; filter: blur(5px); animation: borderRotate 4s linear infinite; }
+        @keyframes borderRotate { from { filter: hue-rotate(0deg) blur(5px); } to { filter: hue-rotate(360deg) blur(5px); } }
+        .typing-effect { overflow: hidden; border-right: 3px solid var(--cyan); white-space: nowrap; animation: typing 3.5s steps(40, end), blink-caret 0.75s step-end infinite; }
+        @keyframes typing { from { width: 0; } to { width: 100%; } }
+        @keyframes blink-caret { from, to { border-color: transparent; } 50% { border-color: var(--cyan); } }
+        .balance-number { font-family: 'Orbitron', monospace; font-size: 56px; font-weight: 900; margin: 10px 0; text-shadow: 0 0 20px rgba(255,215,0,0.8), 0 0 40px rgba(255,215,0,0.4); background: linear-gradient(45deg, #ffd700, #ffaa00, #ffd700); -webkit-background-clip: text; -webkit-text-fill-color: transparent; animation: balanceGlow 2s infinite alternate; }
+        @keyframes balanceGlow { from { text-shadow: 0 0 20px rgba(255,215,0,0.8), 0 0 40px rgba(255,215,0,0.4); } to { text-shadow: 0 0 30px rgba(255,215,0,1), 0 0 60px rgba(255,215,0,0.6), 0 0 90px rgba(255,215,0,0.3); } }
+        .channel-button { background: linear-gradient(135deg, #1a1a1a, #2a2a2a); border: 2px solid var(--cyan); border-radius: 15px; padding: 12px 20px; margin: 8px 0; display: flex; align-items: center; justify-content: space-between; cursor: pointer; transition: all 0.3s; animation: buttonAppear 0.6s ease-out; }
+        .channel-button:hover { transform: translateX(5px); background: linear-gradient(135deg, #2a2a2a, #3a3a3a); box-shadow: 0 0 20px rgba(0,243,255,0.4); }
+        .channel-button i { font-size: 20px; color: var(--cyan); }
+        .channel-button.disabled { opacity: 0.5; border-color: #888; }
+        .channel-button.disabled i { color: #888; }
+        .channel-button.disabled:hover { transform: none; box-shadow: none; }
+        .scan-line { position: absolute; top: 0; left: 0; width: 100%; height: 3px; background: linear-gradient(90deg, transparent, var(--cyan), transparent); animation: scan 3s infinite linear; }
+        @keyframes scan { 0% { top: 0; } 100% { top: 100%; } }
+        .holographic-effect { background: linear-gradient(45deg, rgba(0,243,255,0.1), rgba(157,78,221,0.1), rgba(255,0,255,0.1)); background-size: 400% 400%; animation: holographic 8s ease infinite; }
+        @keyframes holographic { 0% { background-position: 0% 50%; } 50% { background-position: 100% 50%; } 100% { background-position: 0% 50%; } }
+"""
+
+MINI_APP_JS = """
         let referData = null;
         let isVerified = IS_VERIFIED;
         let deviceVerified = DEVICE_VERIFIED;
@@ -2183,7 +5335,7 @@ MINI_APP_TEMPLATE = """
         function shareReferLink() {
             if (!referData) return;
             
-            const text = `🎉 Join {{ settings.bot_name }} and earn money! Use my refer code: ${referData.refer_code}\n${referData.refer_link}`;
+            const text = `🎉 Join ${BOT_NAME} and earn money! Use my refer code: ${referData.refer_code}\n${referData.refer_link}`;
             const url = `https://t.me/share/url?url=${encodeURIComponent(referData.refer_link)}&text=${encodeURIComponent(text)}`;
             window.open(url, '_blank');
         }
@@ -2279,9 +5431,6 @@ MINI_APP_TEMPLATE = """
                 showToast('Data refreshed!', 'info', 1000);
             }
         });
-    </script>
-</body>
-</html>
 """
 
 ADMIN_TEMPLATE = """
@@ -2290,59 +5439,7 @@ ADMIN_TEMPLATE = """
 <head>
     <title>Admin Panel</title>
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <style>
-        body { background: #111; color: #ddd; font-family: sans-serif; margin: 0; padding-bottom: 50px; }
-        .nav { background: #222; padding: 10px; display: flex; overflow-x: auto; gap: 10px; position: sticky; top: 0; z-index: 100; border-bottom: 1px solid #333; }
-        .nav button { background: none; border: none; color: #888; padding: 10px; font-weight: bold; cursor: pointer; white-space: nowrap; border-radius: 5px; }
-        .nav button.active { background: #007bff; color: white; }
-        .tab { display: none; padding: 15px; } .tab.active { display: block; }
-        .card { background: #222; padding: 15px; border-radius: 8px; margin-bottom: 15px; border: 1px solid #333; }
-        input, select, textarea { width: 100%; padding: 10px; background: #333; border: 1px solid #444; color: white; margin: 5px 0; border-radius: 5px; box-sizing: border-box; }
-        .btn { width: 100%; padding: 12px; background: #007bff; color: white; border: none; border-radius: 5px; margin-top: 10px; font-weight: bold; cursor: pointer;}
-        .btn-del { width: auto; background: #dc3545; padding: 5px 10px; margin: 0; font-size: 12px; cursor: pointer;}
-        .btn-icon { width:35px; height:35px; border-radius:5px; border:none; cursor:pointer; font-weight:bold; font-size:16px; margin-left:5px; display:inline-flex; align-items:center; justify-content:center; }
-        .check { background:#28a745; color:white; } .cross { background:#dc3545; color:white; }
-        .channel-toggle { background:#ff9800; color:white; margin-right:5px; }
-        .channel-disabled { opacity:0.5; }
-        table { width: 100%; border-collapse: collapse; font-size: 13px; } 
-        th { text-align: left; color: #888; border-bottom: 1px solid #444; padding:8px; } 
-        td { padding: 8px; border-bottom: 1px solid #333; vertical-align: middle; }
-        .tx-id { font-weight:bold; color:#007bff; display:block; }
-        .u-info { font-size:11px; color:#aaa; display:block; }
-        .paid-utr { font-family:monospace; color:#28a745; background:rgba(40,167,69,0.1); padding:2px 5px; border-radius:4px; font-size:11px; }
-        .modal { display:none; position:fixed; top:0; left:0; width:100%; height:100%; background:rgba(0,0,0,0.9); justify-content:center; align-items:center; z-index:999; }
-        .m-content { background:#222; padding:20px; border-radius:10px; border:1px solid #444; width:90%; max-width:300px; text-align:center; }
-        .gift-row { background: rgba(157,78,221,0.1); margin: 5px 0; padding: 10px; border-radius: 5px; display: flex; justify-content: space-between; align-items: center; }
-        .gift-code { font-family: monospace; font-weight: bold; color: #9d4edd; }
-        .expiry { font-size: 11px; color: #ff9800; }
-        .usage { font-size: 12px; color: #aaa; }
-        .nowrap { white-space: nowrap; }
-        .expired { opacity: 0.5; text-decoration: line-through; }
-        .gen-btn { background: #9d4edd; color: white; border: none; padding: 8px 15px; border-radius: 5px; cursor: pointer; font-size: 12px; margin-left: 10px; }
-        .admin-loader { display: none; position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0,0,0,0.9); z-index: 9999; justify-content: center; align-items: center; flex-direction: column; }
-        .admin-spinner { width: 40px; height: 40px; border: 5px solid #333; border-top: 5px solid #007bff; border-radius: 50%; animation: spin 1s linear infinite; margin: 20px; }
-        @keyframes spin { to { transform: rotate(360deg); } }
-        .admin-loader-text { color: white; font-weight: bold; font-size: 16px; margin-top: 15px; }
-        .user-card { background: #2a2a2a; border-radius: 8px; padding: 12px; margin-bottom: 10px; display: flex; justify-content: space-between; align-items: center; cursor: pointer; transition: background 0.3s; }
-        .user-card:hover { background: #333; }
-        .user-id { font-family: monospace; font-size: 11px; color: #888; }
-        .user-name { font-weight: bold; margin: 5px 0; }
-        .user-balance { color: #ffd700; font-weight: bold; font-size: 16px; }
-        .user-status { font-size: 11px; padding: 2px 6px; border-radius: 10px; }
-        .status-verified { background: rgba(40,167,69,0.2); color: #28a745; }
-        .status-pending { background: rgba(255,193,7,0.2); color: #ffc107; }
-        .channel-details { font-size: 11px; color: #888; margin-top: 5px; }
-        .channel-id { font-family: monospace; }
-        .config-options { display: flex; flex-wrap: wrap; gap: 15px; margin: 15px 0; }
-        .config-option { flex: 1; min-width: 200px; background: #2a2a2a; padding: 15px; border-radius: 8px; }
-        .toggle-switch { position: relative; display: inline-block; width: 50px; height: 24px; margin-left: 10px; }
-        .toggle-switch input { opacity: 0; width: 0; height: 0; }
-        .toggle-slider { position: absolute; cursor: pointer; top: 0; left: 0; right: 0; bottom: 0; background-color: #ccc; transition: .4s; border-radius: 24px; }
-        .toggle-slider:before { position: absolute; content: ""; height: 16px; width: 16px; left: 4px; bottom: 4px; background-color: white; transition: .4s; border-radius: 50%; }
-        input:checked + .toggle-slider { background-color: #007bff; }
-        input:checked + .toggle-slider:before { transform: translateX(26px); }
-        .toggle-label { display: flex; align-items: center; justify-content: space-between; margin: 10px 0; }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('admin.css') }}">
 </head>
 <body>
     <div id="adminLoader" class="admin-loader">
@@ -2645,6 +5742,70 @@ ADMIN_TEMPLATE = """
     </div>
     
     <script>
+        const TOTAL_USERS = {{ stats.total_users }};
+        const ADMIN_ID = "{{ admin_id }}";
+    </script>
+    <script src="{{ asset_url('admin.js') }}"></script>
+</body>
+</html>
+"""
+
+# Static parts of the admin panel, built into static/assets (see build_assets)
+ADMIN_CSS = """
+        body { background: #111; color: #ddd; font-family: sans-serif; margin: 0; padding-bottom: 50px; }
+        .nav { background: #222; padding: 10px; display: flex; overflow-x: auto; gap: 10px; position: sticky; top: 0; z-index: 100; border-bottom: 1px solid #333; }
+        .nav button { background: none; border: none; color: #888; padding: 10px; font-weight: bold; cursor: pointer; white-space: nowrap; border-radius: 5px; }
+        .nav button.active { background: #007bff; color: white; }
+        .tab { display: none; padding: 15px; } .tab.active { display: block; }
+        .card { background: #222; padding: 15px; border-radius: 8px; margin-bottom: 15px; border: 1px solid #333; }
+        input, select, textarea { width: 100%; padding: 10px; background: #333; border: 1px solid #444; color: white; margin: 5px 0; border-radius: 5px; box-sizing: border-box; }
+        .btn { width: 100%; padding: 12px; background: #007bff; color: white; border: none; border-radius: 5px; margin-top: 10px; font-weight: bold; cursor: pointer;}
+        .btn-del { width: auto; background: #dc3545; padding: 5px 10px; margin: 0; font-size: 12px; cursor: pointer;}
+        .btn-icon { width:35px; height:35px; border-radius:5px; border:none; cursor:pointer; font-weight:bold; font-size:16px; margin-left:5px; display:inline-flex; align-items:center; justify-content:center; }
+        .check { background:#28a745; color:white; } .cross { background:#dc3545; color:white; }
+        .channel-toggle { background:#ff9800; color:white; margin-right:5px; }
+        .channel-disabled { opacity:0.5; }
+        table { width: 100%; border-collapse: collapse; font-size: 13px; } 
+        th { text-align: left; color: #888; border-bottom: 1px solid #444; padding:8px; } 
+        td { padding: 8px; border-bottom: 1px solid #333; vertical-align: middle; }
+        .tx-id { font-weight:bold; color:#007bff; display:block; }
+        .u-info { font-size:11px; color:#aaa; display:block; }
+        .paid-utr { font-family:monospace; color:#28a745; background:rgba(40,167,69,0.1); padding:2px 5px; border-radius:4px; font-size:11px; }
+        .modal { display:none; position:fixed; top:0; left:0; width:100%; height:100%; background:rgba(0,0,0,0.9); justify-content:center; align-items:center; z-index:999; }
+        .m-content { background:#222; padding:20px; border-radius:10px; border:1px solid #444; width:90%; max-width:300px; text-align:center; }
+        .gift-row { background: rgba(157,78,221,0.1); margin: 5px 0; padding: 10px; border-radius: 5px; display: flex; justify-content: space-between; align-items: center; }
+        .gift-code { font-family: monospace; font-weight: bold; color: #9d4edd; }
+        .expiry { font-size: 11px; color: #ff9800; }
+        .usage { font-size: 12px; color: #aaa; }
+        .nowrap { white-space: nowrap; }
+        .expired { opacity: 0.5; text-decoration: line-through; }
+        .gen-btn { background: #9d4edd; color: white; border: none; padding: 8px 15px; border-radius: 5px; cursor: pointer; font-size: 12px; margin-left: 10px; }
+        .admin-loader { display: none; position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0,0,0,0.9); z-index: 9999; justify-content: center; align-items: center; flex-direction: column; }
+        .admin-spinner { width: 40px; height: 40px; border: 5px solid #333; border-top: 5px solid #007bff; border-radius: 50%; animation: spin 1s linear infinite; margin: 20px; }
+        @keyframes spin { to { transform: rotate(360deg); } }
+        .admin-loader-text { color: white; font-weight: bold; font-size: 16px; margin-top: 15px; }
+        .user-card { background: #2a2a2a; border-radius: 8px; padding: 12px; margin-bottom: 10px; display: flex; justify-content: space-between; align-items: center; cursor: pointer; transition: background 0.3s; }
+        .user-card:hover { background: #333; }
+        .user-id { font-family: monospace; font-size: 11px; color: #888; }
+        .user-name { font-weight: bold; margin: 5px 0; }
+        .user-balance { color: #ffd700; font-weight: bold; font-size: 16px; }
+        .user-status { font-size: 11px; padding: 2px 6px; border-radius: 10px; }
+        .status-verified { background: rgba(40,167,69,0.2); color: #28a745; }
+        .status-pending { background: rgba(255,193,7,0.2); color: #ffc107; }
+        .channel-details { font-size: 11px; color: #888; margin-top: 5px; }
+        .channel-id { font-family: monospace; }
+        .config-options { display: flex; flex-wrap: wrap; gap: 15px; margin: 15px 0; }
+        .config-option { flex: 1; min-width: 200px; background: #2a2a2a; padding: 15px; border-radius: 8px; }
+        .toggle-switch { position: relative; display: inline-block; width: 50px; height: 24px; margin-left: 10px; }
+        .toggle-switch input { opacity: 0; width: 0; height: 0; }
+        .toggle-slider { position: absolute; cursor: pointer; top: 0; left: 0; right: 0; bottom: 0; background-color: #ccc; transition: .4s; border-radius: 24px; }
+        .toggle-slider:before { position: absolute; content: ""; height: 16px; width: 16px; left: 4px; bottom: 4px; background-color: white; transition: .4s; border-radius: 50%; }
+        input:checked + .toggle-slider { background-color: #007bff; }
+        input:checked + .toggle-slider:before { transform: translateX(26px); }
+        .toggle-label { display: flex; align-items: center; justify-content: space-between; margin: 10px 0; }
+"""
+
+ADMIN_JS = """
         let curTx = '';
         let selectedUserId = '';
         
@@ -2958,7 +6119,7 @@ ADMIN_TEMPLATE = """
                 return;
             }
             
-            if (!confirm(`Send this message to {{ stats.total_users }} users?`)) return;
+            if (!confirm(`Send this message to ${TOTAL_USERS} users?`)) return;
             
             showAdminLoader('Broadcasting message...');
             
@@ -2977,7 +6138,7 @@ ADMIN_TEMPLATE = """
             .then(data => {
                 hideAdminLoader();
                 if (data.ok !== false) {
-                    alert(`Message sent to ${data.count || data} users!`);
+                    alert(`Broadcast started for ${data.count} users!`);
                     document.getElementById('bcMsg').value = '';
                     document.getElementById('bcFile').value = '';
                 } else {
@@ -3062,7 +6223,7 @@ ADMIN_TEMPLATE = """
                 total_uses: uses
             };
             
-            fetch('/admin/create_gift?user_id={{ admin_id }}', {
+            fetch(`/admin/create_gift?user_id=${ADMIN_ID}`, {
                 method: 'POST',
                 headers: {'Content-Type': 'application/json'},
                 body: JSON.stringify(data)
@@ -3135,13 +6296,185 @@ ADMIN_TEMPLATE = """
         
         // Generate initial code
         generateCode();
-    </script>
-</body>
-</html>
 """
 
-# ==================== 10. START APP ====================
+# ==================== 25. TEMPLATE CACHE ====================
+# The pages are named templates compiled once (warm_up does it before the
+# fork) and kept by Jinja's cache; requests only render. They hold just the
+# markup and the few values that change per request.
+TEMPLATE_SOURCES = {
+    'mini_app.html': MINI_APP_TEMPLATE,
+    'admin.html': ADMIN_TEMPLATE
+}
+app.jinja_env.loader = jinja2.ChoiceLoader([jinja2.DictLoader(TEMPLATE_SOURCES), app.jinja_env.loader])
+
+TEMPLATE_STATS = {}
+template_lock = threading.Lock()
+
+# The CSS and JS go out as separate files named after a hash of their
+# content (static/assets/mini_app.<hash>.js), next to gzip and, when the
+# brotli package is installed, brotli copies. Their URLs change whenever
+# the content does, so browsers may keep them forever and a repeat visit
+# only downloads the page itself. Built at import, which gunicorn does
+# once before forking.
+ASSET_SOURCES = {
+    'mini_app.css': MINI_APP_CSS,
+    'mini_app.js': MINI_APP_JS,
+    'admin.css': ADMIN_CSS,
+    'admin.js': ADMIN_JS
+}
+ASSETS = {}
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+def build_assets():
+    """Write the fingerprinted bundles (and compressed copies) that aren't there
+    yet, and remove the ones left over from earlier builds"""
+    for name, source in ASSET_SOURCES.items():
+        data = source.encode('utf-8')
+        stem, ext = os.path.splitext(name)
+        filename = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+        path = os.path.join(ASSETS_DIR, filename)
+        variants = [(path, lambda: data), (path + '.gz', lambda: gzip.compress(data, 9, mtime=0))]
+        if brotli is not None:
+            variants.append((path + '.br', lambda: brotli.compress(data)))
+        for target, encode in variants:
+            if not os.path.exists(target):
+                tmp = f"{target}.{os.getpid()}.tmp"
+                with open(tmp, 'wb') as f:
+                    f.write(encode())
+                os.replace(tmp, target)
+        ASSETS[name] = f"assets/{filename}"
+    
+    current = [os.path.basename(path) for path in ASSETS.values()]
+    for entry in os.listdir(ASSETS_DIR):
+        # Compressed copies and another worker's temp files share the prefix
+        if not any(entry == f or entry.startswith(f + '.') for f in current):
+            try:
+                os.remove(os.path.join(ASSETS_DIR, entry))
+            except OSError:
+                pass
+
+def asset_url(name):
+    return f"/static/{ASSETS[name]}"
+
+def serve_asset(filename):
+    """A fingerprinted bundle, precompressed if the client takes it"""
+    path = os.path.join(ASSETS_DIR, filename)
+    mimetype = 'text/css' if filename.endswith('.css') else 'application/javascript'
+    encoding = None
+    if STATIC_PRECOMPRESSED:
+        available = [c for c, suffix in (('br', '.br'), ('gzip', '.gz')) if os.path.exists(path + suffix)]
+        encoding = request.accept_encodings.best_match(available) if available else None
+        if encoding:
+            path += '.br' if encoding == 'br' else '.gz'
+    response = send_file(path, mimetype=mimetype, download_name=filename, conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    elif not STATIC_PRECOMPRESSED:
+        # Buffer it so compress_response handles it like any other body
+        response.direct_passthrough = False
+        response.make_sequence()
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    return response
+
+build_assets()
+app.jinja_env.globals['asset_url'] = asset_url
+
+def compile_templates():
+    for name in TEMPLATE_SOURCES:
+        app.jinja_env.get_template(name)
+
+def render_page(name, **context):
+    """render_template plus a Server-Timing header and per-page render stats"""
+    started = time.time()
+    response = app.response_class(render_template(name, **context))
+    ms = (time.time() - started) * 1000
+    response.headers['Server-Timing'] = f"render;dur={ms:.1f}"
+    with template_lock:
+        stats = TEMPLATE_STATS.setdefault(name, {'renders': 0, 'total_ms': 0.0, 'last_ms': 0.0, 'max_ms': 0.0})
+        stats['renders'] += 1
+        stats['total_ms'] += ms
+        stats['last_ms'] = round(ms, 2)
+        stats['max_ms'] = round(max(stats['max_ms'], ms), 2)
+    return response
+
+def template_stats():
+    with template_lock:
+        return {
+            name: {
+                'renders': stats['renders'],
+                'avg_ms': round(stats['total_ms'] / stats['renders'], 2),
+                'last_ms': stats['last_ms'],
+                'max_ms': stats['max_ms']
+            }
+            for name, stats in TEMPLATE_STATS.items()
+        }
+
+# ==================== 26. RESPONSE COMPRESSION ====================
+# HTML, JSON and other text bodies of at least COMPRESS_MIN_SIZE bytes are
+# compressed with whatever the client prefers of brotli (if installed) and
+# gzip. Files streamed from disk are left alone: the asset bundles already
+# come precompressed and photos don't shrink.
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/plain', 'text/css', 'application/json',
+    'application/javascript', 'image/svg+xml'
+}
+COMPRESSION = {'responses': 0, 'bytes_in': 0, 'bytes_out': 0}
+compression_lock = threading.Lock()
+
+@app.after_request
+def compress_response(response):
+    # Only full 200 bodies: a 206's Content-Range describes the uncompressed bytes
+    if (response.status_code != 200
+            or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or 'Content-Range' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    encoding = request.accept_encodings.best_match(offered)
+    if encoding is None:
+        response.vary.add('Accept-Encoding')
+        return response
+    if encoding == 'br':
+        compressed = brotli.compress(data, quality=BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(data, GZIP_LEVEL)
+    
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        # Same entity, different bytes
+        response.headers['ETag'] = 'W/' + etag
+    with compression_lock:
+        COMPRESSION['responses'] += 1
+        COMPRESSION['bytes_in'] += len(data)
+        COMPRESSION['bytes_out'] += len(compressed)
+    return response
+
+def compression_stats():
+    with compression_lock:
+        stats = dict(COMPRESSION)
+    stats['ratio'] = round(stats['bytes_out'] / stats['bytes_in'], 3) if stats['bytes_in'] else None
+    stats['brotli'] = brotli is not None
+    stats['static_precompressed'] = STATIC_PRECOMPRESSED
+    return stats
+
+# ==================== 27. START APP ====================
 if __name__ == '__main__':
-    init_default_files()
-    port = int(os.environ.get("PORT", 8080))
-    app.run(host='0.0.0.0', port=port, debug=False)
+    if len(sys.argv) > 1 and sys.argv[1] == 'reshard':
+        # python app.py reshard <shards> [users.json]  (run with the bot stopped)
+        if len(sys.argv) < 3:
+            sys.exit("usage: python app.py reshard <shards> [users.json]")
+        reshard_users(int(sys.argv[2]), sys.argv[3] if len(sys.argv) > 3 else None)
+        sys.exit(0)
+    # Development server; production runs gunicorn (see gunicorn.conf.py).
+    # init_default_files() already ran at import.
+    warm_up()
+    app.run(host='0.0.0.0', port=PORT, debug=False)
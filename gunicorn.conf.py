@@ -0,0 +1,47 @@
+# gunicorn settings for the bot (Procfile / railway.json: gunicorn -c gunicorn.conf.py app:app)
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# app.py reads WEB_CONCURRENCY too: more than one worker turns on its
+# cross-process locking, so keep the two in step
+workers = int(os.environ.setdefault('WEB_CONCURRENCY', '2'))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Telegram keeps webhook connections open between deliveries
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 75))
+# Webhooks return right after queueing; only uploads/broadcasts take long
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+
+# Import the app (recovery, migration, caches) once in the master and fork
+# workers from it; background threads start lazily in each worker
+preload_app = True
+
+accesslog = '-' if os.environ.get('GUNICORN_ACCESS_LOG') == '1' else None
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+
+def when_ready(server):
+    import threading
+    import app
+    app.warm_up()
+    # Threads don't survive the fork and a lock one of them held would stay
+    # held in every worker, so the master must still be single-threaded here
+    others = [t.name for t in threading.enumerate() if t is not threading.main_thread()]
+    if others:
+        server.log.warning("Threads running before fork: %s", ", ".join(others))
+    server.log.info("Caches warmed, forking workers")
+
+
+def worker_exit(server, worker):
+    import app
+    # Let queued webhook updates, their replies and the admin digest go out,
+    # then make pending writes durable
+    app.drain_updates()
+    app.flush_admin_digest()
+    app.drain_sends()
+    app.release_broadcasts()
+    app.flush_writes()